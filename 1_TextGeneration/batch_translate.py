@@ -0,0 +1,197 @@
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
+# the bedrock model classes live in the knowledge bases project
+import knowledge_bases  # noqa: F401
+from fmodels import TitanText
+from translation_memory import TranslationMemory
+
+# Batch translation of a JSONL or CSV file into one or more languages
+# requests are sent concurrently, short strings are translated several at a time, and every translation is appended to the
+# output file as soon as it is done. the output file doubles as the checkpoint: running the same command again skips
+# every (id, language) already in it
+# run with: python batch_translate.py input.jsonl output.jsonl --languages French Spanish
+
+# same prompt as translate_app.py
+prompt = "You are a translator. \n\nHuman: Translate '{input_text}' to {language} \n\nTranslation in {language}: "
+# several strings in one request, the strings go in and come back as a json list so they can be matched up again
+pack_prompt = (
+    "You are a translator. \n\nHuman: Translate every string in this JSON list to {language}. "
+    "Reply with only a JSON list of the translations, in the same order. \n\n{input_list} \n\nJSON list in {language}: "
+)
+
+
+def read_input(path, text_field='text', id_field='id'):
+    # yields (id, text) from a jsonl file (one object per line) or a csv file with a header row
+    # rows without an id are numbered by their position in the file
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        rows = csv.DictReader(f) if path.endswith('.csv') else (json.loads(line) for line in f if line.strip())
+        for i, row in enumerate(rows):
+            yield str(row.get(id_field, i)), row[text_field]
+
+
+def read_checkpoint(path):
+    # (id, language) of every translation already in the output file
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a line cut short by an interrupted run, it is translated again
+                continue
+            done.add((record['id'], record['language']))
+    return done
+
+
+def open_output(path):
+    # opens the output file for appending, a line cut short by an interrupted run is finished so the next record starts on its own line
+    out = open(path, 'a', encoding='utf-8')
+    if out.tell() > 0:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                out.write('\n')
+    return out
+
+
+def make_requests(items, languages, pack_size, pack_chars):
+    # groups the items into requests of (language, [(id, text), ...])
+    # strings up to pack_chars long without line breaks are packed pack_size to a request, anything else is sent on its own
+    requests = []
+    for language in languages:
+        pack = []
+        for item_id, text in items[language]:
+            if pack_size > 1 and len(text) <= pack_chars and '\n' not in text:
+                pack.append((item_id, text))
+                if len(pack) == pack_size:
+                    requests.append((language, pack))
+                    pack = []
+            else:
+                requests.append((language, [(item_id, text)]))
+        if pack:
+            requests.append((language, pack))
+    return requests
+
+
+class BatchTranslator():
+    def __init__(self, model, memory=None):
+        self.model = model
+        # optional TranslationMemory, strings this script translated before with the same settings don't cost a request
+        # (the memory is scoped by model parameters and prompt, so translations made by the app at its own temperature aren't shared)
+        self.memory = memory
+
+    def generate(self, text):
+        # throttled requests are retried with backoff by fmodels.bedrock_call (BEDROCK_MAX_RETRIES)
+        return self.model.generate_response(text)[0]
+
+    def translate_one(self, text, language):
+        return self.generate(prompt.format(input_text=text, language=language)).strip()
+
+    def translate(self, language, items):
+        # returns [(id, translation), ...] for a request made by make_requests, using and filling the translation memory
+        if self.memory is None:
+            return self.translate_items(language, items)[0]
+        # translations are stored under the prompt that produced them: a string translated on its own (because it missed the
+        # memory alone in its pack, or its pack's reply couldn't be matched up) under the single string prompt, otherwise the pack prompt
+        # either is good enough for any request, the one this request is sent with is looked up first
+        request_prompt, other_prompt = (pack_prompt, prompt) if len(items) > 1 else (prompt, pack_prompt)
+        params = self.memory_params(request_prompt)
+        alternatives = [self.memory_params(other_prompt)]
+        translations = {}
+        missing = []
+        for item_id, text in items:
+            translation = self.memory.get(text, language, self.model.model_id, params, alternatives)
+            if translation is None:
+                missing.append((item_id, text))
+            else:
+                translations[item_id] = translation
+        if missing:
+            texts = dict(missing)
+            translated, used_prompt = self.translate_items(language, missing)
+            for item_id, translation in translated:
+                self.memory.put(texts[item_id], language, self.model.model_id, self.memory_params(used_prompt), translation)
+                translations[item_id] = translation
+        return [(item_id, translations[item_id]) for item_id, _ in items]
+
+    def memory_params(self, item_prompt):
+        # everything that changes the translation is part of the memory key
+        return dict(self.model.model_params, prompt=item_prompt)
+
+    def translate_items(self, language, items):
+        # returns ([(id, translation), ...], prompt the translations were made with)
+        if len(items) == 1:
+            item_id, text = items[0]
+            return [(item_id, self.translate_one(text, language))], prompt
+
+        output = self.generate(pack_prompt.format(input_list=json.dumps([text for _, text in items], ensure_ascii=False), language=language))
+        try:
+            translations = json.loads(output[output.index('['):output.rindex(']') + 1])
+        except ValueError:
+            translations = None
+        # if the reply can't be matched up with the input the strings are translated one by one instead
+        if not isinstance(translations, list) or len(translations) != len(items) or not all(isinstance(t, str) for t in translations):
+            return [(item_id, self.translate_one(text, language)) for item_id, text in items], prompt
+        return [(item_id, translation.strip()) for (item_id, _), translation in zip(items, translations)], pack_prompt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate a JSONL or CSV file of strings with Amazon Titan Text")
+    parser.add_argument("input", help="jsonl or csv file")
+    parser.add_argument("output", help="jsonl file the translations are appended to, also used to resume")
+    parser.add_argument("--languages", nargs="+", default=["French"])
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--workers", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--pack-size", type=int, default=10, help="short strings per request, 1 to send every string on its own")
+    parser.add_argument("--pack-chars", type=int, default=200, help="longest string that is packed with others")
+    parser.add_argument("--max-tokens", type=int, default=3072)
+    parser.add_argument("--no-memory", action="store_true", help="don't read or fill the translation memory")
+    args = parser.parse_args()
+
+    done = read_checkpoint(args.output)
+    rows = list(read_input(args.input, args.text_field, args.id_field))
+    items = {language: [(item_id, text) for item_id, text in rows if (item_id, language) not in done] for language in args.languages}
+    requests = make_requests(items, args.languages, args.pack_size, args.pack_chars)
+    total = sum(len(pending) for pending in items.values())
+    print(f"{len(rows)} strings x {len(args.languages)} languages, {len(done)} already translated, {total} to go in {len(requests)} requests")
+
+    memory = None if args.no_memory else TranslationMemory()
+    translator = BatchTranslator(TitanText(maxTokenCount=args.max_tokens, temp=0.0, topP=0.9), memory=memory)
+    sources = dict(rows)
+    completed = failed = 0
+    start = time.perf_counter()
+    with open_output(args.output) as out, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(translator.translate, language, request): (language, request) for language, request in requests}
+        for future in as_completed(futures):
+            language, request = futures[future]
+            try:
+                translations = future.result()
+            except Exception as e:
+                # left out of the output, so the next run picks them up again
+                failed += len(request)
+                print(f"\nFailed {len(request)} strings to {language}: {e}")
+                continue
+            # only this thread writes, every finished request is flushed so an interrupted run loses nothing that completed
+            for item_id, translation in translations:
+                out.write(json.dumps({'id': item_id, 'language': language, 'source': sources[item_id], 'translation': translation},
+                                     ensure_ascii=False) + '\n')
+            out.flush()
+            completed += len(translations)
+            elapsed = time.perf_counter() - start
+            print(f"\r{completed}/{total} translated ({completed / elapsed:.1f}/s), {failed} failed", end="", flush=True)
+    print()
+    if memory is not None:
+        memory_stats = memory.stats()
+        print(f"Translation memory: {memory_stats['hits']} hits, {memory_stats['misses']} misses ({memory_stats['hit_rate']:.0%})")
+
+
+if __name__ == "__main__":
+    main()
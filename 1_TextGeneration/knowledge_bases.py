@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The bedrock model classes (fmodels.py) live in the knowledge bases project
+# importing this module makes them importable by name from the scripts in this folder:
+#   import knowledge_bases  # noqa: F401
+#   from fmodels import TitanText
+KNOWLEDGE_BASES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "2_KnowledgeBases")
+
+if KNOWLEDGE_BASES_DIR not in sys.path:
+    sys.path.insert(0, KNOWLEDGE_BASES_DIR)
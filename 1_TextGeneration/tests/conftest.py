@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules under test import each other by name, like the scripts do when run from 1_TextGeneration
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,106 @@
+import json
+
+from batch_translate import BatchTranslator
+from batch_translate import make_requests
+from batch_translate import open_output
+from batch_translate import pack_prompt
+from batch_translate import prompt
+from batch_translate import read_checkpoint
+from batch_translate import read_input
+from translation_memory import TranslationMemory
+
+
+class FakeModel():
+    # translates to 'fr:<text>', a pack is answered with a json list unless reply is set
+    model_id = "model"
+    model_params = {"temperature": 0.0}
+
+    def __init__(self, reply=None):
+        self.reply = reply
+        self.prompts = []
+
+    def generate_response(self, text):
+        self.prompts.append(text)
+        if "JSON list" in text:
+            if self.reply is not None:
+                return self.reply, None
+            strings = json.loads(text[text.index('['):text.rindex(']') + 1])
+            return "Sure: " + json.dumps([f"fr:{string}" for string in strings]), None
+        return f" fr:{text.split(chr(39))[1]} ", None
+
+
+def test_read_input_jsonl_and_csv(tmp_path):
+    jsonl = tmp_path / "input.jsonl"
+    jsonl.write_text('{"id": "a", "text": "one"}\n\n{"text": "two"}\n', encoding='utf-8')
+    assert list(read_input(str(jsonl))) == [("a", "one"), ("1", "two")]
+    csv_path = tmp_path / "input.csv"
+    csv_path.write_text("key,body\nk1,\"one, two\"\n", encoding='utf-8')
+    assert list(read_input(str(csv_path), text_field='body', id_field='key')) == [("k1", "one, two")]
+
+
+def test_make_requests_packs_short_single_line_strings():
+    items = {
+        'French': [("1", "a"), ("2", "b"), ("3", "long string"), ("4", "two\nlines"), ("5", "c")],
+        'Spanish': [("1", "a")]
+    }
+    requests = make_requests(items, ['French', 'Spanish'], pack_size=2, pack_chars=5)
+    assert requests == [
+        ('French', [("1", "a"), ("2", "b")]),
+        ('French', [("3", "long string")]),
+        ('French', [("4", "two\nlines")]),
+        ('French', [("5", "c")]),
+        ('Spanish', [("1", "a")])
+    ]
+    # pack_size 1 sends every string on its own
+    assert len(make_requests(items, ['French'], pack_size=1, pack_chars=5)) == 5
+
+
+def test_resume_skips_done_records_and_finishes_a_cut_off_line(tmp_path):
+    path = str(tmp_path / "output.jsonl")
+    assert read_checkpoint(path) == set()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'id': '1', 'language': 'French', 'translation': 'un'}) + '\n')
+        f.write('{"id": "2", "lang')
+    assert read_checkpoint(path) == {('1', 'French')}
+
+    with open_output(path) as out:
+        out.write(json.dumps({'id': '2', 'language': 'French', 'translation': 'deux'}) + '\n')
+    assert read_checkpoint(path) == {('1', 'French'), ('2', 'French')}
+    # a complete file gets no extra line
+    with open_output(path):
+        pass
+    assert open(path, encoding='utf-8').read().count('\n') == 3
+
+
+def test_translate_items_falls_back_to_one_by_one_when_the_reply_does_not_match():
+    for reply in ["no json here", json.dumps(["only one"]), json.dumps(["un", 2])]:
+        model = FakeModel(reply=reply)
+        translations, used_prompt = BatchTranslator(model).translate_items("French", [("1", "one"), ("2", "two")])
+        assert translations == [("1", "fr:one"), ("2", "fr:two")]
+        assert used_prompt == prompt
+        assert len(model.prompts) == 3
+
+
+def test_packed_translations_are_stored_under_the_pack_prompt(tmp_path):
+    memory = TranslationMemory(path=str(tmp_path / "memory.db"))
+    model = FakeModel()
+    translator = BatchTranslator(model, memory=memory)
+    assert translator.translate("French", [("1", "one"), ("2", "two")]) == [("1", "fr:one"), ("2", "fr:two")]
+    assert memory.get("one", "French", "model", translator.memory_params(pack_prompt)) == "fr:one"
+    assert memory.get("one", "French", "model", translator.memory_params(prompt)) is None
+    # the same strings packed again come from the memory
+    assert translator.translate("French", [("3", "one"), ("4", "two")]) == [("3", "fr:one"), ("4", "fr:two")]
+    assert len(model.prompts) == 1
+
+
+def test_string_translated_alone_is_found_by_later_packs(tmp_path):
+    memory = TranslationMemory(path=str(tmp_path / "memory.db"))
+    model = FakeModel()
+    translator = BatchTranslator(model, memory=memory)
+    translator.translate("French", [("1", "one"), ("2", "two")])
+    # only 'three' misses, so it is sent with the single string prompt and stored under it
+    assert translator.translate("French", [("1", "one"), ("3", "three")]) == [("1", "fr:one"), ("3", "fr:three")]
+    assert "JSON list" not in model.prompts[-1]
+    # a later pack still finds it
+    assert translator.translate("French", [("3", "three"), ("2", "two")]) == [("3", "fr:three"), ("2", "fr:two")]
+    assert len(model.prompts) == 2
@@ -0,0 +1,60 @@
+import numpy as np
+
+from translation_memory import TranslationMemory
+
+PARAMS = {"temperature": 0.0, "prompt": "translate {input_text}"}
+
+
+def letter_embed(text):
+    # one dimension per letter, texts with the same letters point the same way
+    vector = np.zeros(26, dtype=np.float32)
+    for letter in text.lower():
+        if 'a' <= letter <= 'z':
+            vector[ord(letter) - ord('a')] += 1
+    return vector
+
+
+def test_get_put_and_scope(tmp_path):
+    memory = TranslationMemory(path=str(tmp_path / "memory.db"))
+    memory.put("Hello  world", "French", "model", PARAMS, "Bonjour le monde")
+    assert memory.get("Hello world", "French", "model", PARAMS) == "Bonjour le monde"
+    assert memory.get("Hello world", "Spanish", "model", PARAMS) is None
+    assert memory.get("Hello world", "French", "model", dict(PARAMS, temperature=0.7)) is None
+
+
+def test_count_and_eviction(tmp_path):
+    path = str(tmp_path / "memory.db")
+    memory = TranslationMemory(path=path, max_entries=3)
+    for i in range(5):
+        memory.put(f"text {i}", "French", "model", PARAMS, f"texte {i}")
+    # replacing an entry doesn't add one
+    memory.put("text 4", "French", "model", PARAMS, "texte quatre")
+    assert memory.stats()["size"] == 3
+    assert memory.get("text 0", "French", "model", PARAMS) is None
+    assert memory.get("text 4", "French", "model", PARAMS) == "texte quatre"
+    # the count is read back from the file
+    assert TranslationMemory(path=path, max_entries=3).stats()["size"] == 3
+
+
+def test_near_match_sees_entries_put_after_the_scope_was_loaded(tmp_path):
+    memory = TranslationMemory(path=str(tmp_path / "memory.db"), embed=letter_embed)
+    memory.put("abc", "French", "model", PARAMS, "first")
+    assert memory.get("cba", "French", "model", PARAMS) == "first"
+    # the scope is loaded now, new entries are appended to it (past the initial capacity) instead of reloading it
+    for i in range(20):
+        memory.put("xyz" + "q" * i, "French", "model", PARAMS, f"entry {i}")
+    keys, matrix, n_rows = memory.embeddings[memory.scope("French", "model", PARAMS)]
+    assert n_rows == len(keys) == 21 and len(matrix) >= 21
+    assert memory.get("zyx" + "q" * 19, "French", "model", PARAMS) == "entry 19"
+    assert memory.stats()["near_hits"] == 2
+
+
+def test_get_tries_alternative_scopes_in_order(tmp_path):
+    memory = TranslationMemory(path=str(tmp_path / "memory.db"))
+    other = dict(PARAMS, prompt="other {input_text}")
+    memory.put("Hello", "French", "model", other, "Salut")
+    assert memory.get("Hello", "French", "model", PARAMS) is None
+    assert memory.get("Hello", "French", "model", PARAMS, [other]) == "Salut"
+    memory.put("Hello", "French", "model", PARAMS, "Bonjour")
+    assert memory.get("Hello", "French", "model", PARAMS, [other]) == "Bonjour"
+    assert memory.stats()["hits"] == 2 and memory.stats()["misses"] == 1
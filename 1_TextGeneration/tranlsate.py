@@ -1,11 +1,15 @@
 import json
-import os
 
-import boto3
 from langchain_aws.chat_models.bedrock import ChatBedrock
 
-# first create the bedrock client
-bedrock_client = boto3.client('bedrock-runtime', region_name=os.environ.get("AWS_DEFAULT_REGION", None))
+# the bedrock model classes live in the knowledge bases project
+import knowledge_bases  # noqa: F401
+from fmodels import BedrockCallProxy
+from fmodels import get_bedrock_client
+
+# first get the shared bedrock client (connection pool), wrapped so langchain's calls go through the same concurrency limit
+# and throttling retries as the other apps
+bedrock_client = BedrockCallProxy(get_bedrock_client())
 
 # define the model id
 modelId = "amazon.titan-text-premier-v1:0"
@@ -18,7 +22,7 @@ kwargs = {"temperature": 0.7,
           "maxTokenCount": 999}
 
 # creating the model
-chat = ChatBedrock(model_id=modelId, model_kwargs=kwargs)
+chat = ChatBedrock(client=bedrock_client, model_id=modelId, model_kwargs=kwargs)
 
 # create the prompt structure
 input_text = input("Type the phrase you would like to translate: \n")
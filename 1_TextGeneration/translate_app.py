@@ -4,29 +4,49 @@ import numpy as np
 
 import json
 import os
-import boto3
-from langchain_aws.chat_models.bedrock import ChatBedrock
-
-# initialize bedrock client
-bedrock_client = boto3.client("bedrock-runtime", region_name=os.environ.get("AWS_DEFAULT_REGION", None))
-# define the model id
-model_id = "amazon.titan-text-premier-v1:0"
-# define the model kwargs
-kwargs = {"temperature":0.7,
-          "topP":0.9,
-          "maxTokenCount":500
-}
-# create the model
-translator = ChatBedrock(model_id=model_id, model_kwargs=kwargs)
+import time
+
+# the bedrock model classes live in the knowledge bases project
+import knowledge_bases  # noqa: F401
+from fmodels import ResponseError
+from fmodels import TitanText
+from fmodels import get_bedrock_client
+from translation_memory import TranslationMemory
+
 # create the prompt template
 prompt = "You are a translator. \n\nHuman: Translate '{input_text}' to {language} \n\nTranslation in {language}: "
 
+@st.cache_resource
+def load_resources():
+    # created once per process and shared by every rerun and session, returns (translator, memory, seconds it took)
+    start = time.perf_counter()
+    # shared bedrock client (connection pool), calls get retries and a concurrency limit from fmodels.bedrock_call
+    bedrock_client = get_bedrock_client()
+    # create the model (amazon.titan-text-premier-v1:0), streaming responses so the translation shows up as it is generated
+    translator = TitanText(bedrock_client, maxTokenCount=500, temp=0.7, topP=0.9)
+    # translations are stored in the translation memory and repeated phrases are answered from it without calling the model
+    # TRANSLATION_MEMORY_NEAR=1 also reuses the translation of a near identical phrase (MiniLM sentence embeddings)
+    embed = None
+    if os.environ.get("TRANSLATION_MEMORY_NEAR", "0") == "1":
+        from embedmodels import registry
+        embed = registry.sentence_transformer().encode
+    memory = TranslationMemory(embed=embed)
+    return translator, memory, time.perf_counter() - start
+
+rerun_start = time.perf_counter()
+translator, memory, load_seconds = load_resources()
+# everything that changes the translation is part of the memory key
+memory_params = dict(translator.model_params, prompt=prompt)
+rerun_seconds = time.perf_counter() - rerun_start
+
 # Create the GUI Interface
 st.title("Amazon Titan Text as a Translator")
 
 # Use selectbox in sidebar to choose language to translate to
 with st.sidebar:
     language = st.selectbox("Choose a language to translate text to", ["French", "Spanish", "Italian"])
+    # cold start (first run in the process) vs this rerun
+    st.caption(f"Cold start: {load_seconds*1000:.0f}ms | This rerun: {rerun_seconds*1000:.1f}ms")
 
 # initialize chat history
 if "messages" not in st.session_state:
@@ -43,10 +63,30 @@ if input_text := st.chat_input("Enter text to translate"):
     # append the message to session_state.messages
     st.session_state.messages.append({"role":"user", "content":input_text})
 
-    response = translator.invoke(prompt.format(input_text=input_text, language=language))
-    with st.chat_message("ai"):
-        st.write(response.content)
-    # optoken = response.response_metadata.usage_metadata.output_tokens
-    # st.write(f"Input Tokens: {iptoken}, Output Tokens: {optoken}")
+    translation = memory.get(input_text, language, translator.model_id, memory_params)
+    if translation is not None:
+        with st.chat_message("ai"):
+            st.write(translation)
+        memory_stats = memory.stats()
+        st.caption(f"From translation memory | Hit rate: {memory_stats['hit_rate']:.0%} ({memory_stats['size']} entries)")
+    else:
+        stream = translator.generate_response_stream(prompt.format(input_text=input_text, language=language))
+        with st.chat_message("ai"):
+            try:
+                st.write_stream(stream)
+            except ResponseError as e:
+                # a cut off translation is neither stored nor added to the chat history
+                st.error(f"The translation was cut off, please try again ({e.message})")
+                st.session_state.messages.pop()
+                st.stop()
+        translation = stream.text
+        memory.put(input_text, language, translator.model_id, memory_params, translation)
+        metrics = stream.metrics()
+        memory_stats = memory.stats()
+        st.caption(
+            f"Input Tokens: {metrics['input_tokens']}, Output Tokens: {metrics['output_tokens']} | "
+            f"Time to first token: {metrics['time_to_first_token'] or 0:.2f}s | {metrics['tokens_per_second'] or 0:.0f} tokens/s | "
+            f"Translation memory hit rate: {memory_stats['hit_rate']:.0%}"
+        )
 
-    st.session_state.messages.append({"role":"ai", "content":response.content})
+    st.session_state.messages.append({"role":"ai", "content":translation})
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+# Persistent translation memory, translations are stored in a sqlite file and looked up before calling the model
+# entries are keyed by the normalized text, target language, model id and model parameters (including the prompt), so a
+# change to any of them never returns a stale translation. with an embedding function, a miss can also be served by a
+# near duplicate of a stored text (same language, model and parameters)
+
+
+def content_hash(*parts):
+    # sha256 over the parts, with a separator so ('ab', 'c') and ('a', 'bc') get different keys
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def normalize_text(text):
+    # unicode normal form and collapsed whitespace, so strings that only differ in spacing share an entry
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+class TranslationMemory():
+    def __init__(self, path=None, max_entries=100000, embed=None, near_threshold=0.97):
+        if path is None:
+            path = os.environ.get("TRANSLATION_MEMORY_PATH", os.path.join(os.path.expanduser("~"), ".cache", "translator", "translation_memory.db"))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        # least recently used entries are deleted once there are more than max_entries
+        self.max_entries = max_entries
+        # optional embed(text) -> vector for near duplicate matching, and the cosine similarity a match needs
+        self.embed = embed
+        self.near_threshold = near_threshold
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "key TEXT PRIMARY KEY, scope TEXT, text TEXT, translation TEXT, embedding BLOB, last_used REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS translations_scope ON translations (scope)")
+        self.connection.commit()
+        # number of entries, kept up to date by put and evict so put doesn't have to count the table
+        self.count = self.connection.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+        # scope -> (keys, unit length embedding matrix, number of rows used), loaded on the first near duplicate lookup in a scope
+        # the matrix has spare rows so put can append to it
+        self.embeddings = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def scope(self, language, model_id, params):
+        # entries that can stand in for each other: same target language, model and parameters
+        return content_hash(language.lower(), model_id, json.dumps(params, sort_keys=True))
+
+    def key(self, text, language, model_id, params):
+        return content_hash(self.scope(language, model_id, params), normalize_text(text))
+
+    def get(self, text, language, model_id, params, alternatives=()):
+        # returns the stored translation or None
+        # alternatives are the params of other scopes whose translations are just as good, tried in order after params
+        scopes = [self.scope(language, model_id, scope_params) for scope_params in (params, *alternatives)]
+        with self.lock:
+            for scope in scopes:
+                key = content_hash(scope, normalize_text(text))
+                row = self.connection.execute("SELECT translation FROM translations WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.connection.execute("UPDATE translations SET last_used = ? WHERE key = ?", (time.time(), key))
+                    self.connection.commit()
+                    self.hits += 1
+                    return row[0]
+
+        translation = self.get_near(text, scopes) if self.embed is not None else None
+        with self.lock:
+            if translation is None:
+                self.misses += 1
+            else:
+                self.near_hits += 1
+        return translation
+
+    def get_near(self, text, scopes):
+        # translation of the most similar stored text in the first of the scopes that has one at least near_threshold similar
+        query = np.asarray(self.embed(normalize_text(text)), dtype=np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        for scope in scopes:
+            translation = self.get_near_in_scope(query, scope)
+            if translation is not None:
+                return translation
+        return None
+
+    def get_near_in_scope(self, query, scope):
+        # translation of the stored text in the scope most similar to a unit length query embedding, if it is similar enough
+        with self.lock:
+            if scope not in self.embeddings:
+                rows = self.connection.execute(
+                    "SELECT key, embedding FROM translations WHERE scope = ? AND embedding IS NOT NULL", (scope,)
+                ).fetchall()
+                matrix = np.stack([np.frombuffer(embedding, dtype=np.float32) for _, embedding in rows]) if rows else np.zeros((0, len(query)), dtype=np.float32)
+                self.embeddings[scope] = ([key for key, _ in rows], matrix, len(rows))
+            keys, matrix, n_rows = self.embeddings[scope]
+            if not keys:
+                return None
+            similarities = matrix[:n_rows] @ query
+            best = int(similarities.argmax())
+            if similarities[best] < self.near_threshold:
+                return None
+            row = self.connection.execute("SELECT translation FROM translations WHERE key = ?", (keys[best],)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE translations SET last_used = ? WHERE key = ?", (time.time(), keys[best]))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, text, language, model_id, params, translation):
+        scope = self.scope(language, model_id, params)
+        embedding = None
+        if self.embed is not None:
+            embedding = np.asarray(self.embed(normalize_text(text)), dtype=np.float32)
+            embedding = (embedding / max(np.linalg.norm(embedding), 1e-12)).tobytes()
+        key = self.key(text, language, model_id, params)
+        with self.lock:
+            exists = self.connection.execute("SELECT 1 FROM translations WHERE key = ?", (key,)).fetchone() is not None
+            self.connection.execute(
+                "INSERT OR REPLACE INTO translations (key, scope, text, translation, embedding, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, scope, normalize_text(text), translation, embedding, time.time())
+            )
+            if not exists:
+                self.count += 1
+            self.evict()
+            self.connection.commit()
+            if scope in self.embeddings:
+                if exists or embedding is None:
+                    # a replaced entry, the scope's embedding matrix is reloaded on the next near duplicate lookup
+                    self.embeddings.pop(scope)
+                else:
+                    self.append_embedding(scope, key, np.frombuffer(embedding, dtype=np.float32))
+
+    def append_embedding(self, scope, key, embedding):
+        # adds a row to the scope's loaded embedding matrix, doubling its capacity when it is full so appends are cheap
+        keys, matrix, n_rows = self.embeddings[scope]
+        if n_rows == len(matrix):
+            grown = np.zeros((max(2 * len(matrix), 16), len(embedding)), dtype=np.float32)
+            grown[:n_rows] = matrix[:n_rows]
+            matrix = grown
+        matrix[n_rows] = embedding
+        keys.append(key)
+        self.embeddings[scope] = (keys, matrix, n_rows + 1)
+
+    def evict(self):
+        # deletes the least recently used entries over max_entries, called with the lock held
+        if self.count > self.max_entries:
+            # other processes sharing the file may have added or evicted entries, count them before deleting any
+            self.count = self.connection.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+        if self.count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM translations WHERE key IN (SELECT key FROM translations ORDER BY last_used LIMIT ?)", (self.count - self.max_entries,)
+            )
+            self.count = self.max_entries
+            self.embeddings.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.near_hits + self.misses
+            size = self.count
+            return {
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "size": size,
+                "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+# benchmarks live one folder below the modules they import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chunker import pool_spans
+
+# Micro benchmark for span pooling in late chunking
+# compares the original per chunk loop against the batched segment pooling (index_add_) in chunker.pool_spans
+# run with: python benchmarks/bench_pooling.py, on a single cpu thread so the timings compare the algorithms and not the threading
+
+
+def loop_pooling(embeddings, annotations):
+    # the original implementation: one tensor op and one host copy per chunk
+    pooled_embeddings = [
+        embeddings[start:end].sum(dim=0) / (end - start)
+        for start, end in annotations
+        if (end - start) >= 1
+    ]
+    return [embedding.detach().cpu().numpy() for embedding in pooled_embeddings]
+
+
+def random_spans(n_tokens, min_length=20, max_length=200, seed=0):
+    # contiguous spans covering the whole document, like the ones returned by the segmenter
+    rng = np.random.default_rng(seed)
+    spans = []
+    start = 1
+    while start < n_tokens - 1:
+        end = min(start + int(rng.integers(min_length, max_length)), n_tokens - 1)
+        spans.append((start, end))
+        start = end
+    return spans
+
+
+def best_of(fn, repeats=5):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    torch.set_num_threads(1)
+    torch.manual_seed(0)
+    print(f"{'tokens':>8} {'chunks':>7} {'loop (ms)':>10} {'batched (ms)':>13} {'speedup':>8}")
+    # long chunks like the ones from the segmenter, then many short chunks where the per chunk overhead dominates
+    cases = [(n_tokens, 20, 200) for n_tokens in [8192, 32768, 131072]] + [(n_tokens, 4, 24) for n_tokens in [32768, 131072]]
+    for n_tokens, min_length, max_length in cases:
+        embeddings = torch.randn(n_tokens, 768)
+        spans = random_spans(n_tokens, min_length, max_length)
+
+        # both implementations must give the same chunk embeddings
+        expected = np.stack(loop_pooling(embeddings, spans))
+        np.testing.assert_allclose(pool_spans(embeddings, spans), expected, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(pool_spans(embeddings, spans, 'max'), np.stack([embeddings[start:end].max(dim=0).values.numpy() for start, end in spans]))
+
+        loop_time = best_of(lambda: loop_pooling(embeddings, spans))
+        batched_time = best_of(lambda: pool_spans(embeddings, spans))
+        print(f"{n_tokens:>8} {len(spans):>7} {loop_time*1000:>10.1f} {batched_time*1000:>13.1f} {loop_time/batched_time:>7.1f}x")
+
+    # the other pooling strategies, for reference
+    embeddings = torch.randn(32768, 768)
+    spans = random_spans(32768)
+    for pooling in ['mean', 'max', 'cls']:
+        pool_time = best_of(lambda: pool_spans(embeddings, spans, pooling))
+        print(f"{pooling} pooling, 32768 tokens: {pool_time*1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# benchmarks live one folder below the modules they import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from localdb import LocalVectorStore
+from quantize import get_quantizer
+
+# Recall vs memory benchmark for compressed embedding storage
+# compares float16, int8 and product quantized embeddings against the uncompressed float32 vectors,
+# both on their own and with full precision re-ranking of the top candidates (LocalVectorStore)
+# run with: python benchmarks/bench_quantization.py
+
+
+def synthetic_embeddings(n_vectors, dimensions=768, n_topics=200, seed=0):
+    # clustered unit vectors, closer to real document embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(n_topics, dimensions))
+    data = topics[rng.integers(n_topics, size=n_vectors)] + 0.8 * rng.normal(size=(n_vectors, dimensions))
+    return (data / np.linalg.norm(data, axis=1, keepdims=True)).astype(np.float32)
+
+
+def recall(results, truth):
+    return np.mean([len(set(r) & set(t)) / len(t) for r, t in zip(results, truth)])
+
+
+def bson_bytes_per_vector(dimensions):
+    # size of one embedding inside a mongodb document, as an array of doubles and as a packed float32 vector
+    try:
+        import bson
+        from bson.binary import Binary
+        from bson.binary import BinaryVectorDtype
+    except ImportError:
+        return None, None
+    vector = [0.1] * dimensions
+    return len(bson.encode({'e': vector})), len(bson.encode({'e': Binary.from_vector(vector, BinaryVectorDtype.FLOAT32)}))
+
+
+def main(n_vectors=20000, n_queries=200, k=10):
+    data = synthetic_embeddings(n_vectors)
+    rng = np.random.default_rng(1)
+    queries = data[rng.integers(n_vectors, size=n_queries)] + 0.05 * rng.normal(size=(n_queries, data.shape[1])).astype(np.float32)
+
+    # exact top k with float32 as the ground truth
+    truth = [np.argsort(-(data @ q))[:k] for q in queries]
+
+    array_bytes, binary_bytes = bson_bytes_per_vector(data.shape[1])
+    if array_bytes is not None:
+        print(f"mongodb document size per embedding: {array_bytes} bytes as an array, {binary_bytes} bytes as a float32 vector\n")
+
+    print(f"{n_vectors} vectors, {data.shape[1]} dimensions, recall@{k} over {n_queries} queries")
+    print(f"{'format':>8} {'bytes/vec':>10} {'memory (MB)':>12} {'recall':>7} {'recall (rerank)':>16} {'query (ms)':>11}")
+    print(f"{'float32':>8} {4*data.shape[1]:>10} {data.nbytes/1e6:>12.1f} {1.0:>7.3f} {'-':>16} {'-':>11}")
+
+    chunks = [{'_id': str(i), 'text': str(i), 'embedding': vector} for i, vector in enumerate(data)]
+    with tempfile.TemporaryDirectory() as path:
+        for compression in ['float16', 'int8', 'pq']:
+            quantizer = get_quantizer(compression).fit(data[:10000])
+            codes = quantizer.encode(data)
+            # top k straight from the compressed scores
+            approximate = [np.argsort(-quantizer.scores(codes, q))[:k] for q in queries]
+
+            # top k after re-ranking 4*k candidates with full precision
+            store = LocalVectorStore('bench', compression, path=path, compression=compression, rerank_factor=4)
+            store.load_chunks(chunks)
+            store.create_index('vector_index', data.shape[1], 'cosine', 'embedding')
+            start = time.perf_counter()
+            reranked = [[int(r['text']) for r in store.retrieve('vector_index', q, limit=k)] for q in queries]
+            query_ms = (time.perf_counter() - start) * 1000 / n_queries
+
+            bytes_per_vector = quantizer.bytes_per_vector(data.shape[1])
+            print(f"{compression:>8} {bytes_per_vector:>10} {bytes_per_vector*n_vectors/1e6:>12.1f} "
+                  f"{recall(approximate, truth):>7.3f} {recall(reranked, truth):>16.3f} {query_ms:>11.2f}")
+            store.drop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+
+import numpy as np
+from sentence_transformers.util import cos_sim
+
+# benchmarks live one folder below the modules they import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chunker import SemanticChunker
+
+# Benchmark for the SemanticChunker pipeline from sentence embeddings to chunks
+# compares the original python loops (pairwise cos_sim, breakpoint loop, += concatenation)
+# against the numpy implementation on synthetic documents with 1k to 100k sentences
+# run with: python benchmarks/bench_semantic_chunker.py
+
+
+def loop_chunking(sentences, embeddings, breakpointPercentile=95):
+    # the original implementation
+    distances = []
+    for i in range(len(sentences)-1):
+        similarity = cos_sim(embeddings[i], embeddings[i+1])
+        distances.append(1-(similarity[0].item()))
+
+    breakpoint_distance = np.percentile(distances, breakpointPercentile)
+    breakpoint_indices = []
+    for i in range(len(distances)):
+        if distances[i] > breakpoint_distance:
+            breakpoint_indices.append(i)
+
+    chunks = []
+    start_index = 0
+    for index in breakpoint_indices + [len(sentences)-1]:
+        chunk_text = ''
+        for sentence in sentences[start_index:index+1]:
+            chunk_text += (' ' + sentence['text'])
+        chunks.append(chunk_text)
+        start_index = index+1
+    return chunks
+
+
+def vectorized_chunking(chunker, sentences, embeddings):
+    distances = chunker.calculate_distances(embeddings)
+    breakpoint_indices = chunker.find_breakpoints(distances)
+    return chunker.build_chunks(sentences, breakpoint_indices, 'synthetic.pdf')
+
+
+def synthetic_document(n_sentences, dimensions=384, seed=0):
+    # random sentences with embeddings that drift slowly with occasional topic changes
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(n_sentences // 20 + 1, dimensions))
+    embeddings = topics[np.arange(n_sentences) // 20] + 0.5 * rng.normal(size=(n_sentences, dimensions))
+    sentences = [{'text': f"Sentence number {i} of the document.", 'page': i // 40, 'file': 'synthetic.pdf'} for i in range(n_sentences)]
+    return sentences, embeddings.astype(np.float32)
+
+
+def main():
+    chunker = SemanticChunker()
+    print(f"{'sentences':>10} {'chunks':>7} {'loop (s)':>9} {'numpy (s)':>10} {'speedup':>8}")
+    for n_sentences in [1000, 10000, 100000]:
+        sentences, embeddings = synthetic_document(n_sentences)
+
+        start = time.perf_counter()
+        expected = loop_chunking(sentences, embeddings)
+        loop_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        chunks = vectorized_chunking(chunker, sentences, embeddings)
+        numpy_time = time.perf_counter() - start
+
+        # both implementations must find the same chunks (the original adds a leading space to every chunk)
+        assert [chunk['text'] for chunk in chunks] == [text[1:] for text in expected]
+        print(f"{n_sentences:>10} {len(chunks):>7} {loop_time:>9.3f} {numpy_time:>10.3f} {loop_time/numpy_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Caches used to avoid recomputing embeddings
+
+
+def content_hash(*parts):
+    # sha256 over any number of str or bytes parts, used as cache keys
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(part)
+        # separator so ('ab', 'c') and ('a', 'bc') get different keys
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def chunk_hash(chunk, embedding_field='embedding'):
+    # hash of everything stored for a chunk except its _id, vector stores use it to skip rewriting unchanged chunks
+    fields = {key: value for key, value in chunk.items() if key not in ('_id', 'content_hash', embedding_field)}
+    embedding = np.asarray(chunk[embedding_field], dtype=np.float32)
+    return content_hash(json.dumps(fields, sort_keys=True, default=str), embedding.tobytes())
+
+
+class EmbeddingCache():
+    # fraction of max_bytes left after an eviction
+    EVICT_TO = 0.9
+
+    def __init__(self, cache_dir=None, max_bytes=1024**3):
+        # persistent on disk cache, every entry is a json file with the metadata (chunk texts, etc.) and an optional
+        # .npy file with a float32 embedding matrix, entries are evicted least recently used first once the cache is over max_bytes
+        if cache_dir is None:
+            cache_dir = os.environ.get("EMBEDDING_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "chatpdf", "embeddings"))
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # running estimate of the size of the cache, the directory is only scanned when it goes over max_bytes
+        # (None until the first put), eviction then goes down to EVICT_TO of max_bytes so the next scan is a while away
+        self.total_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+    def _paths(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json"), os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key):
+        # returns (data, embeddings) or None, embeddings is None for entries stored without them
+        json_path, npy_path = self._paths(key)
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            embeddings = np.load(npy_path) if data.get('has_embeddings') else None
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # touch the entry so it counts as recently used for eviction
+        for path in (json_path, npy_path):
+            if os.path.exists(path):
+                os.utime(path)
+        with self.lock:
+            self.hits += 1
+        return data, embeddings
+
+    def contains(self, key):
+        return os.path.exists(self._paths(key)[0])
+
+    def put(self, key, data, embeddings=None):
+        json_path, npy_path = self._paths(key)
+        data = dict(data, has_embeddings=embeddings is not None)
+        # write to temporary files first and rename them, so readers never see a half written entry
+        # the json file is written last since it marks the entry as complete
+        written = 0
+        if embeddings is not None:
+            with open(npy_path + '.tmp', 'wb') as f:
+                np.save(f, np.ascontiguousarray(embeddings, dtype=np.float32))
+                written += f.tell()
+            os.replace(npy_path + '.tmp', npy_path)
+        with open(json_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+            written += f.tell()
+        os.replace(json_path + '.tmp', json_path)
+        with self.lock:
+            # overwritten entries are counted twice until the next scan, which only makes the scan come a bit early
+            if self.total_bytes is not None:
+                self.total_bytes += written
+            over = self.total_bytes is None or self.total_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self):
+        # scans the cache directory and removes the least recently used entries until the cache fits in EVICT_TO of max_bytes
+        with self.lock:
+            entries = {}
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                key = os.path.splitext(name)[0]
+                size, last_used = entries.get(key, (0, 0.0))
+                entries[key] = (size + stat.st_size, max(last_used, stat.st_mtime))
+                total += stat.st_size
+
+            if total > self.max_bytes:
+                for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+                    if total <= self.max_bytes * self.EVICT_TO:
+                        break
+                    for path in self._paths(key):
+                        if os.path.exists(path):
+                            os.remove(path)
+                    total -= size
+            self.total_bytes = total
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+class LRUCache():
+    def __init__(self, maxsize=1024, ttl=None):
+        # in memory least recently used cache, entries older than ttl seconds are treated as missing
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        # returns the cached value or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.entries),
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+# version of every (database, collection) in this process, bumped on every write so caches keyed on it are invalidated
+_collection_versions = {}
+_collection_versions_lock = threading.Lock()
+
+def collection_version(namespace):
+    return _collection_versions.get(namespace, 0)
+
+def bump_collection_version(namespace):
+    with _collection_versions_lock:
+        _collection_versions[namespace] = _collection_versions.get(namespace, 0) + 1
+
+
+# query text -> query embedding
+query_embedding_cache = LRUCache(maxsize=1024, ttl=3600)
+# (query embedding, index, limit, collection version) -> retrieved chunks
+# the collection version changes whenever chunks are loaded or deleted, and once the search indexes have caught up with the writes
+# (an index becomes queryable, an ingestion job finishes), so stale results are never looked up again
+# the ttl bounds staleness from writes made by other processes
+retrieval_cache = LRUCache(maxsize=256, ttl=600)
+
+# one embedding cache per process so the hit and miss counters add up across uploads
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+def get_embedding_cache():
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache()
+        return _embedding_cache
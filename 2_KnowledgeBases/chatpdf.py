@@ -1,24 +1,138 @@
+import hashlib
+import json
 import os
+import re
+import tempfile
+import time
+import uuid
 
-import boto3
-import pymupdf
 import streamlit as st
+from cache import content_hash
+from cache import get_embedding_cache
+from cache import query_embedding_cache
+from cache import retrieval_cache
 from chunker import LateChunker
+from context import ContextAssembler
+from context import message_text
+from embedmodels import JINA_MODEL_ID
+from embedmodels import RERANKER_MODEL_ID
+from embedmodels import registry
 from fmodels import Claude3_Haiku
-from vectordb import MongoDB
+from fmodels import ResponseError
+from fmodels import get_bedrock_client
+from jobs import IngestionQueue
+from retrieval import HybridRetriever
+from retrieval import Reranker
+from retrieval import RetrievalPipeline
+from vectordb import connect
 
-from transformers import AutoModel
+
+class Resources():
+    # everything the app needs that is slow to create: the bedrock client and model, the vector store, the embedding and
+    # re-ranking models and the retrieval pipeline. built once per process by load_resources and shared by every rerun and session
+    def __init__(self):
+        # shared pooled bedrock client, calls are retried on throttling by fmodels.bedrock_call
+        self.bedrock_client = get_bedrock_client()
+        self.llm = Claude3_Haiku(self.bedrock_client)
+        self.vectordb = connect(database_name="chatwpdf", collection_name="uploaded_docs")
+        self.chunker = LateChunker()
+        # RETRIEVAL_MODE='hybrid' merges a keyword search with the vector search (reciprocal rank fusion) instead of the vector search alone
+        # RETRIEVAL_CANDIDATES is the number of results taken from each search before fusion
+        self.retrieval_mode = os.environ.get("RETRIEVAL_MODE", "vector")
+        self.retrieval_candidates = int(os.environ.get("RETRIEVAL_CANDIDATES", 20))
+        self.retriever = HybridRetriever(
+            self.vectordb, num_candidates=100, vector_limit=self.retrieval_candidates, text_limit=self.retrieval_candidates
+        )
+        # search results are re-ranked with a cpu cross-encoder (RERANK=0 turns it off), RETRIEVAL_OVER_FETCH is the number of candidates re-ranked
+        reranker = Reranker(registry.cross_encoder(RERANKER_MODEL_ID)) if os.environ.get("RERANK", "1") != "0" else None
+        self.tokenizer = registry.tokenizer(JINA_MODEL_ID)
+        self.retrieval = RetrievalPipeline(
+            self.vectordb,
+            count_tokens=self.count_tokens,
+            hybrid_retriever=self.retriever if self.retrieval_mode == 'hybrid' else None,
+            reranker=reranker,
+            over_fetch=int(os.environ.get("RETRIEVAL_OVER_FETCH", 20)),
+            token_budget=None,
+            max_chunks=None
+        )
+        # uploads are ingested in the background, INGEST_JOBS documents at a time with the forward pass in INGEST_EMBED_PROCESSES
+        # worker processes (0 runs it on the job threads)
+        self.jobs = IngestionQueue(
+            self.chunker,
+            self.vectordb,
+            cache=get_embedding_cache(),
+            max_jobs=int(os.environ.get("INGEST_JOBS", 2)),
+            embed_processes=int(os.environ.get("INGEST_EMBED_PROCESSES", 1)),
+            create_indexes=self.create_indexes,
+            index_names=self.index_names()
+        )
+        # seconds load_resources took, i.e. the cold start of the process
+        self.load_seconds = None
+
+    def index_names(self):
+        return ['vector_index', 'text_index'] if self.retrieval_mode == 'hybrid' else ['vector_index']
+
+    def create_indexes(self):
+        # create the vector search index, returns straight away while atlas builds it (skipped if it already exists unchanged)
+        self.vectordb.create_index(
+            index_name='vector_index',
+            dimensions=768,
+            similarity='cosine',
+            embedding_field='embedding'
+        )
+        # keyword index for hybrid retrieval
+        if self.retrieval_mode == 'hybrid':
+            self.vectordb.create_text_index(index_name='text_index', text_field='text')
+
+    def count_tokens(self, text):
+        return len(self.tokenizer(text, add_special_tokens=False)['input_ids'])
+
+
+@st.cache_resource
+def load_resources():
+    # runs once per process, later reruns and other sessions get the same Resources back
+    start = time.perf_counter()
+    # load the embedding model at startup instead of on the first upload or question
+    registry.warm_up()
+    resources = Resources()
+    resources.load_seconds = time.perf_counter() - start
+    return resources
 
 
 class App():
     # TODO
     def __init__(self):
+        start = time.perf_counter()
         st.title("Chat with PDF")
-        self.bedrock_client = boto3.client("bedrock-runtime", region_name=os.environ.get("AWS_DEFAULT_REGION", None))
-        self.llm = Claude3_Haiku(self.bedrock_client)
-        self.mongodb = MongoDB(database_name="chatwpdf", collection_name="uploaded_docs")
+        resources = load_resources()
+        self.llm = resources.llm
+        self.vectordb = resources.vectordb
+        self.chunker = resources.chunker
+        self.retrieval_mode = resources.retrieval_mode
+        self.retrieval_candidates = resources.retrieval_candidates
+        self.retrieval = resources.retrieval
+        self.index_names = resources.index_names
+        self.jobs = resources.jobs
+        self.load_seconds = resources.load_seconds
+        # the prompt gets the best chunks that fit in CONTEXT_CHUNK_TOKENS and the recent turns that fit in CONTEXT_HISTORY_TOKENS
+        # older turns are dropped, or summarized with CONTEXT_SUMMARIZE=1
+        self.assembler = ContextAssembler(
+            resources.count_tokens,
+            chunk_budget=int(os.environ.get("CONTEXT_CHUNK_TOKENS", 1500)),
+            history_budget=int(os.environ.get("CONTEXT_HISTORY_TOKENS", 1000)),
+            summarize=self.summarize if os.environ.get("CONTEXT_SUMMARIZE", "0") == "1" else None
+        )
+        # time to get the app ready on this rerun, the first run in the process includes load_resources
+        self.init_seconds = time.perf_counter() - start
         self.prompt = ''
         # st.session_state.file = None
+        # every browser tab is its own tenant, its uploads are namespaced and searches only see its own documents
+        # the tenant id is kept in the url, so a reload keeps the documents instead of orphaning them, and uploading the same file
+        # again finds its chunks already stored (the chunk ids include the tenant, see IngestionPipeline.entries)
+        if "tenant" not in st.session_state:
+            tenant = st.query_params.get("tenant", "")
+            st.session_state.tenant = tenant if re.fullmatch(r"[0-9a-f]{32}", tenant) else uuid.uuid4().hex
+        st.query_params["tenant"] = st.session_state.tenant
         self.sidebar()
         self.chat()
 
@@ -36,65 +150,142 @@ class App():
             with st.chat_message("user"):
                 st.write(input_text)
 
-            self.prompt = input_text
+            chunks = []
+            retrieval_stats = None
 
             # update the model parameters from the toggles in the sidebar
             self.llm.model_params = st.session_state.model_params
 
-            # if pdf has been added
-            if st.session_state.file is not None:
+            # if some of this session's uploads can be searched, otherwise the question is answered without context
+            if self.documents_searchable():
                 # st.success('Document Uploaded!', icon="✅")
 
-                # initialize the embedding model and embed the query
-                model = AutoModel.from_pretrained('jinaai/jina-embeddings-v2-base-en', trust_remote_code=True)
-                query_embed = model.encode(input_text)
-                # perform a vector search on the database and return the 3 most relevant chunks
-                vector_search = self.mongodb.retrieve(
-                    index_name='vector_index',
-                    query_embedding=query_embed.tolist(),
-                    embedding_field='embedding',
-                    num_neighbors=100,
-                    limit=3
+                # embed the query using the shared embedding model (loaded once per process), repeated questions reuse the cached embedding
+                query_key = (JINA_MODEL_ID, input_text)
+                query_embed = query_embedding_cache.get(query_key)
+                if query_embed is None:
+                    query_embed = registry.model(JINA_MODEL_ID).encode(input_text)
+                    query_embedding_cache.put(query_key, query_embed)
+                # search the database (vector or hybrid) and re-rank the candidates
+                # the search is pre-filtered to this session's documents (or the ones picked in the sidebar), so other tenants'
+                # chunks never take up candidate slots. results are cached until the collection changes
+                search_filter = self.search_filter()
+                retrieval_key = (
+                    content_hash(query_embed.tobytes(), input_text), self.retrieval_mode, self.retrieval_candidates,
+                    self.retrieval.over_fetch, self.retrieval.reranker is not None, json.dumps(search_filter, sort_keys=True),
+                    self.vectordb.namespace, self.vectordb.version
                 )
-                # add the relevant context to the prompt
-                context = []
-                for results in vector_search:
-                    context.append(results['text'])
-                context_to_add = f"chunk 1:{context[0]}, chunk 2:{context[1]}, chunk 3:{context[2]}"
-                self.prompt = f"Answer <{input_text}> using relevant context from <Context from pdf->{context_to_add}>"
-
-            # add user prompt to chat history
+                cached = retrieval_cache.get(retrieval_key)
+                if cached is None:
+                    cached = self.retrieval.retrieve(input_text, query_embed.tolist(), filter=search_filter)
+                    retrieval_cache.put(retrieval_key, cached)
+                chunks, retrieval_stats = cached
+            elif st.session_state.get("ingestion_jobs"):
+                st.caption("The uploaded documents are still being indexed, this answer doesn't use them")
+
+            # the question with the chunks that fit in the budget, after the recent chat history
+            # the context is only sent for this turn, the history keeps the plain question (save input token costs down the line)
+            messages, context_stats = self.assembler.build(input_text, chunks, st.session_state.messages)
+            self.prompt = message_text(messages[-1])
+            # converse (send prompt along with chat history), the answer is written out as it is generated
+            stream = self.llm.converse_stream(messages, st.session_state.model_params)
+            with st.chat_message("assistant"):
+                try:
+                    st.write_stream(stream)
+                except ResponseError as e:
+                    # a cut off answer isn't added to the chat history, the question can simply be asked again
+                    st.error(f"The answer was cut off, please try again ({e.message})")
+                    return
+            stream_metrics = stream.metrics()
+            input_tokens, output_tokens = stream_metrics['input_tokens'], stream_metrics['output_tokens']
+            # add user prompt and response to chat history
             st.session_state.messages.append({
                 'role':'user',
-                'content':[{'text':self.prompt}]
+                'content':[{'text':input_text}]
             })
-            # converse (send prompt along with chat history)
-            output, input_tokens, output_tokens = self.llm.converse(st.session_state.messages, st.session_state.model_params)
-            # remove the context from the message history after the model output has been received (save input token costs down the line)
-            st.session_state.messages[-1]['content'][0]['text'] = input_text
-            # append response to chat history
-            st.session_state.messages.append(output)
-            with st.chat_message("assistant"):
-                st.write(output['content'][0]['text'])
-            st.info(f"Input Tokens: {input_tokens} | Output Tokens: {output_tokens}")
+            st.session_state.messages.append({
+                'role':'assistant',
+                'content':[{'text':stream.text}]
+            })
+            query_stats = query_embedding_cache.stats()
+            cache_stats = retrieval_cache.stats()
+            info = (
+                f"Input Tokens: {input_tokens} | Output Tokens: {output_tokens} | Tokens saved: {context_stats['tokens_saved']} | "
+                f"Time to first token: {stream_metrics['time_to_first_token'] or 0:.2f}s | {stream_metrics['tokens_per_second'] or 0:.0f} tokens/s | "
+                f"{context_stats['chunks']} chunks ({context_stats['chunk_tokens']} tokens) | "
+                f"{context_stats['history_messages']} history messages ({context_stats['dropped_messages']} dropped) | "
+                f"Query cache hit rate: {query_stats['hit_rate']:.0%} | Retrieval cache hit rate: {cache_stats['hit_rate']:.0%}"
+            )
+            if retrieval_stats is not None:
+                info += f" | Search: {retrieval_stats['search_seconds']*1000:.0f}ms | Re-rank: {retrieval_stats['rerank_seconds']*1000:.0f}ms"
+            st.info(info)
+
+    def documents_searchable(self):
+        # whether a search can find any of this session's documents, without waiting for anything
+        # a document is searchable once its job is done, or once a batch is written and the search indexes (built in the background
+        # after the first batch) are ready. remembered for the session, finished jobs are eventually forgotten by the queue
+        if st.session_state.get('documents_searchable'):
+            return True
+        jobs = [job for job in map(self.jobs.get, st.session_state.get("ingestion_jobs", {}).values()) if job is not None]
+        searchable = any(job.status == 'done' for job in jobs) or (
+            any(job.searchable for job in jobs) and all(self.vectordb.index_status(index_name)['ready'] for index_name in self.index_names())
+        )
+        st.session_state.documents_searchable = searchable
+        return searchable
+
+    def search_filter(self):
+        # metadata filter of the chunks this session can search (see vectordb.FILTER_FIELDS)
+        search_filter = {'metadata.tenant': st.session_state.tenant}
+        if st.session_state.get('selected_files'):
+            search_filter['metadata.file'] = {'$in': st.session_state.selected_files}
+        return search_filter
+
+    def summarize(self, messages):
+        # short summary of the turns that no longer fit in the history budget
+        # kept in the session until more turns are dropped, so the summary is only regenerated when it changes
+        if st.session_state.get('summary', (0, None))[0] == len(messages):
+            return st.session_state.summary[1]
+        conversation = "\n".join(f"{message['role']}: {message_text(message)}" for message in messages)
+        request = [{'role': 'user', 'content': [{'text': f"Summarize this conversation in a few sentences:\n{conversation}"}]}]
+        output, _, _ = self.llm.converse(request, dict(st.session_state.model_params, maxTokenCount=200))
+        st.session_state.summary = (len(messages), output['content'][0]['text'])
+        return st.session_state.summary[1]
 
 
     def sidebar(self):
         with st.sidebar:
             # upload file
             # uploaded_file = st.file_uploader("Select file to chat with:", type='pdf', key='file', on_change=self.process_document) #noqa
-            uploaded_file = st.file_uploader("Select file to chat with:", type='pdf', key='file', on_change=self.process_document) #noqa
+            uploaded_file = st.file_uploader("Select files to chat with:", type='pdf', key='file', accept_multiple_files=True, on_change=self.process_document) #noqa
+            self.ingestion_status()
+            # restrict the chat to some of the uploaded documents, all of them when nothing is picked
+            file_names = sorted({job.file_name for job in map(self.jobs.get, st.session_state.get("ingestion_jobs", {}).values()) if job is not None})
+            if len(file_names) > 1:
+                st.multiselect("Chat with:", file_names, key='selected_files', placeholder="All documents")
 
             # model parameters
             st.subheader("Model Parameteres")
             self.configure_params_claude()
 
-            # options to clear chat history and pdf in the database
+            # warn if the vector database can't be reached (checked at most every 30 seconds)
+            if not self.vectordb.health_check():
+                st.warning("Can't reach the vector database")
+
+            # load time and memory used by the embedding models
+            with st.expander("Embedding Models"):
+                st.dataframe(registry.get_metrics())
+
+            # cold start (first run in the process) vs this rerun
+            with st.expander("Startup"):
+                st.write(f"Cold start: {self.load_seconds:.2f}s")
+                st.write(f"This rerun: {self.init_seconds*1000:.0f}ms")
+
+            # options to clear chat history and this tenant's pdfs in the database
             with st.expander("Clear"):
                 # clear chat
                 if st.button("Clear chat history"):
                     self.clear('chat')
-                if st.button("Clear Database"):
+                if st.button("Clear my documents"):
                     self.clear('collection')
 
     def configure_params_claude(self):
@@ -124,54 +315,64 @@ class App():
         }
 
     def process_document(self):
-        # check if file has been uploaded
-        if st.session_state.file is not None:
-            # initialize the pymupdf doc
-            with st.spinner('Opening Document...'):
-                doc = pymupdf.open(stream=st.session_state.file.read(), filetype='pdf')
-
-            # perform late chunking on the document
-            with st.spinner('Chunking Document'):
-                late_chunker = LateChunker()
-                chunks, chunk_embeddings = late_chunker.get_chunk_embeddings(doc)
-
-            # upload the chunks and their embeddings to mongo db
-            with st.spinner('Uploading to MongoDB'):
-                db_entries = []
-                chunk_index = 0
-                for chunk_text, chunk_embedding in zip(chunks, chunk_embeddings):
-                    db_entries.append({
-                        "_id": f"{st.session_state.file.name}:{chunk_index}",
-                        "text":  chunk_text,
-                        "embedding": chunk_embedding.tolist(),
-                        "metadata": {
-                            "file": st.session_state.file.name
-                        }
-                    })
-                    chunk_index += 1
-                self.mongodb = MongoDB(database_name="chatwpdf", collection_name='uploaded_docs')
-                db_load_result = self.mongodb.load_chunks(db_entries)
-                print(db_load_result)
-
-            # create the vector search index on the uploaded data
-            with st.spinner("Creating Search Index"):
-                # create the vector search index
-                self.mongodb.create_index(
-                    index_name='vector_index',
-                    dimensions=768,
-                    similarity='cosine',
-                    embedding_field='embedding'
+        # queues every newly uploaded file for background ingestion, chat keeps working while they are processed
+        if "ingestion_jobs" not in st.session_state:
+            st.session_state.ingestion_jobs = {}
+        for uploaded_file in st.session_state.file or []:
+            if uploaded_file.file_id in st.session_state.ingestion_jobs:
+                continue
+            # copy the upload to a temporary file in small pieces so pymupdf can load pages lazily from disk
+            # the content hash is computed on the way, re-uploads of the same pdf are read back from the embedding cache
+            uploaded_file.seek(0)
+            pdf_hash = hashlib.sha256()
+            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
+                while piece := uploaded_file.read(1024*1024):
+                    pdf_hash.update(piece)
+                    pdf_file.write(piece)
+            st.session_state.ingestion_jobs[uploaded_file.file_id] = self.jobs.submit(
+                pdf_file.name, uploaded_file.name, pdf_hash.hexdigest(), tenant=st.session_state.tenant
+            )
+
+    @st.fragment(run_every=1)
+    def ingestion_status(self):
+        # progress of this session's uploads, refreshed every second without rerunning the rest of the app
+        for job_id in st.session_state.get("ingestion_jobs", {}).values():
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            if job.status == 'failed':
+                st.error(f"{job.file_name}: {job.error}")
+                if job.traceback:
+                    with st.expander("Details"):
+                        st.code(job.traceback)
+                continue
+            if job.status == 'done':
+                text = f"{job.file_name}: done, {job.chunks_done} chunks"
+            elif job.status == 'indexing':
+                text = f"{job.file_name}: waiting for the search index, {job.chunks_done} chunks"
+            else:
+                text = f"{job.file_name}: {job.status}, {job.chunks_done} chunks ({job.pages_done}/{job.page_count} pages read)"
+            st.progress(job.progress, text=text)
+            if job.status == 'done':
+                # time spent queued, ingesting and waiting for the index, and the database write throughput
+                stages = " | ".join(f"{stage} {seconds:.1f}s" for stage, seconds in job.stage_seconds.items())
+                throughput = job.chunks_written / job.write_seconds if job.write_seconds else 0
+                st.caption(
+                    f"{stages} | {job.chunks_written} chunks written, {job.chunks_skipped} unchanged, {throughput:.0f} chunks/s"
+                    + (" | from embedding cache" if job.cached else "")
                 )
 
     def clear(self, item:str):
-        # clear chat history or mongodb database
+        # clear chat history or this tenant's chunks in the vector database, other tenants' documents are left alone
         if item == 'chat':
             st.session_state.messages=[]
+            st.session_state.summary=(0, None)
             for x in st.session_state.messages:
                 with st.chat_message(x['role']):
                     st.write(x['content'])
         elif item == 'collection':
-            self.mongodb.database.drop_collection(self.mongodb.collection)
+            self.vectordb.delete_many({'metadata.tenant': st.session_state.tenant})
+            st.session_state.documents_searchable = False
 
 
 def main():
@@ -1,24 +1,113 @@
 # RegEx to split text
 import re
-# Sentence Transformers for quick embedding model
-from sentence_transformers import SentenceTransformer
+import json
 from fmodels import TitanEmbeddings
-import boto3
-import os
-# similarity to comapare embeddings
-from sentence_transformers.util import cos_sim
+# shared, lazily loaded embedding models
+from embedmodels import registry
 import numpy as np
+import torch
+
+from segmenter import LocalSegmenter
+
+
+def clean_text(text):
+    # remove unnecesary line breaks to clean up the text and chunk it better
+    # pdf text has a line break after every line, only the ones after punctuation (end of a paragraph) are kept
+    text = text.replace(' \n ', '')
+    pattern = r"(?<![.!?])\n"
+    return re.sub(pattern, "", text)
+
+
+def pool_spans(embeddings, annotations, pooling='mean'):
+    # pools the token embeddings of every span (start, end) into a single chunk embedding, all spans at once
+    # embeddings is a (n_tokens, hidden_size) tensor, returns a contiguous float32 numpy array of shape (n_chunks, hidden_size)
+    # 'sum' adds up the token embeddings instead of averaging them, late_chunking_windows uses it to average spans over several windows
+    hidden_size = embeddings.shape[-1]
+    spans = [(start, end) for start, end in annotations if (end - start) >= 1]
+    if not spans:
+        return np.zeros((0, hidden_size), dtype=np.float32)
+
+    bounds = torch.tensor(spans, dtype=torch.long, device=embeddings.device)
+    starts, ends = bounds[:, 0], bounds[:, 1]
+    lengths = ends - starts
+
+    with torch.no_grad():
+        if pooling in ('mean', 'sum', 'max'):
+            # the tokens to reduce and the row of the span each one goes into (segment ids)
+            if bool((starts[1:] >= ends[:-1]).all()):
+                # spans in order without overlaps (the segmenter's): the covered range is reduced in place, without copying tokens out,
+                # tokens in the gaps between spans go into an extra row that is dropped
+                gaps = torch.cat([starts[1:] - ends[:-1], torch.zeros(1, dtype=torch.long, device=embeddings.device)])
+                row_ids = torch.stack([torch.arange(len(spans), device=embeddings.device), torch.full_like(gaps, len(spans))], dim=1)
+                span_ids = torch.repeat_interleave(row_ids.flatten(), torch.stack([lengths, gaps], dim=1).flatten())
+                tokens = embeddings[int(starts[0]):int(ends[-1])]
+            else:
+                # index of every token covered by a span, spans are laid out one after the other
+                offsets = torch.cumsum(lengths, dim=0) - lengths
+                token_ids = torch.arange(int(lengths.sum()), device=embeddings.device) + torch.repeat_interleave(starts - offsets, lengths)
+                span_ids = torch.repeat_interleave(torch.arange(len(spans), device=embeddings.device), lengths)
+                tokens = embeddings[token_ids]
+
+        if pooling == 'mean' or pooling == 'sum':
+            # dense segment sum, every token is added to the row of its span
+            pooled = torch.zeros((len(spans) + 1, hidden_size), dtype=embeddings.dtype, device=embeddings.device)
+            pooled = pooled.index_add_(0, span_ids, tokens)[:len(spans)]
+            if pooling == 'mean':
+                pooled = pooled / lengths.unsqueeze(1).to(embeddings.dtype)
+        elif pooling == 'max':
+            # scatter every token into the row of its span and keep the max
+            pooled = torch.full((len(spans) + 1, hidden_size), float('-inf'), dtype=embeddings.dtype, device=embeddings.device)
+            pooled = pooled.scatter_reduce(0, span_ids.unsqueeze(1).expand(-1, hidden_size), tokens, reduce='amax')[:len(spans)]
+        elif pooling == 'cls':
+            # embedding of the first token of each span
+            pooled = embeddings[starts]
+        else:
+            raise ValueError(f"Unknown pooling strategy {pooling}, expected 'mean', 'sum', 'max' or 'cls'")
+
+        # one device to host copy for all the chunks
+        return np.ascontiguousarray(pooled.to(torch.float32).cpu().numpy())
+
+
+def join_token_inputs(tokenizer, input_ids, offsets):
+    # model inputs for text that was tokenized in pieces (without special tokens), in the same form as tokenizer(text, return_tensors='pt',
+    # return_offsets_mapping=True): [CLS] and [SEP] are added around the ids and get the offset (0, 0)
+    # offsets are the character offsets of the tokens in the whole text
+    input_ids = [tokenizer.cls_token_id] + list(input_ids) + [tokenizer.sep_token_id]
+    offsets = [(0, 0)] + list(offsets) + [(0, 0)]
+    return {
+        'input_ids': torch.tensor([input_ids]),
+        'attention_mask': torch.ones((1, len(input_ids)), dtype=torch.long),
+        'offset_mapping': torch.tensor([offsets], dtype=torch.long)
+    }
+
+
+def merge_empty_spans(chunks, span_annotations):
+    # merges the text of chunks with an empty token span into a neighbouring chunk, returns the chunks and spans without them
+    merged_chunks, merged_spans = [], []
+    prefix = ''
+    for chunk, (start, end) in zip(chunks, span_annotations):
+        if end > start:
+            merged_chunks.append(prefix + chunk)
+            merged_spans.append((start, end))
+            prefix = ''
+        elif merged_chunks:
+            merged_chunks[-1] += chunk
+        else:
+            prefix += chunk
+    return merged_chunks, merged_spans
 
-from transformers import AutoModel
-from transformers import AutoTokenizer
-import requests
 
 class SemanticChunker():
-    def __init__(self, bufferSize=1, breakpointPercentile=95) -> None:
+    def __init__(self, bufferSize=1, breakpointPercentile=95, batchSize=64, maxWorkers=8, maxRequestsPerSecond=None) -> None:
         # how many sentences before and after to provide as context when creating embeddings
         self.bufferSize = bufferSize
         # percentile threshold to determine when to break a chunk
         self.breakpointPercentile = breakpointPercentile
+        # number of sentences encoded together by the local model
+        self.batchSize = batchSize
+        # number of titan requests in flight at once, optionally capped to a number of requests per second
+        self.maxWorkers = maxWorkers
+        self.maxRequestsPerSecond = maxRequestsPerSecond
 
     def sentence_splitter(self, text_data):
         # RegEx pattern splits text based on punctuation marks (.?!) followed by 1 or more whitespace
@@ -26,49 +115,74 @@ class SemanticChunker():
         return sentence_list
 
     def combine_sentences(self, sentences):
+        texts = [sentence['text'] for sentence in sentences]
         for i in range(len(sentences)):
-            sentence_with_context = ''
-
-            # add sentences before the current sentence based on buffer size
-            for j in range(i-self.bufferSize, i):
-                # if j < 0, there are not enough sentences before the current sentence to include as a buffer
-                if j >= 0:
-                    sentence_with_context += sentences[j]['text'] + ' '
-
-            # add the current sentence
-            sentence_with_context += sentences[i]['text']
-
-            # add sentences after the current sentence based on buffer size
-            for j in range(i+1, i+1+self.bufferSize):
-                if j < len(sentences):
-                    sentence_with_context += ' ' + sentences[j]['text']
-
-            sentences[i]['sentence_with_context'] = sentence_with_context
+            # bufferSize sentences before and after the current sentence, clipped at the start and end of the document
+            window = texts[max(0, i-self.bufferSize):i+1+self.bufferSize]
+            sentences[i]['sentence_with_context'] = ' '.join(window)
 
     def generateEmbeddings(self, sentences):
-        model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-        for i in range(len(sentences)):
-            sentences[i]['embedding'] = model.encode(sentences[i]['sentence_with_context'])
-
+        # encode all the sentences in batches, returns a (n_sentences, dimensions) matrix
+        model = registry.sentence_transformer("sentence-transformers/all-MiniLM-L6-v2")
+        embeddings = model.encode(
+            [sentence['sentence_with_context'] for sentence in sentences],
+            batch_size=self.batchSize,
+            convert_to_numpy=True
+        )
+        return embeddings
 
     def generateEmbeddingsTitan(self, sentences):
-        bedrock_client = boto3.client("bedrock-runtime", region_name=os.environ.get("AWS_DEFAULT_REGION", None))
-        model = TitanEmbeddings(bedrock_client=bedrock_client)
-        for i in range(len(sentences)):
-            sentences[i]['embedding'] = model.generate_embeddings(sentences[i]['sentence_with_context'])[0]
-
-    def calculate_distances(self, sentences):
-        distances=[]
-        for i in range(len(sentences)-1):
-            current_embedding = sentences[i]['embedding']
-            next_embedding = sentences[i+1]['embedding']
+        # titan requests are sent concurrently with retries on throttling, returns a (n_sentences, dimensions) matrix
+        # shared pooled bedrock client (fmodels.get_bedrock_client)
+        model = TitanEmbeddings()
+        embeddings = model.generate_embeddings_batch(
+            [sentence['sentence_with_context'] for sentence in sentences],
+            max_workers=self.maxWorkers,
+            max_per_second=self.maxRequestsPerSecond
+        )
+        return embeddings
+
+    def calculate_distances(self, embeddings):
+        # cosine distance between every pair of adjacent sentence embeddings, returns an array of length n_sentences-1
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        # normalize the rows once so the cosine similarity is just a dot product
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        normalized = embeddings / np.maximum(norms, 1e-12)
+        # rowwise dot product of each row with the next one
+        similarities = np.einsum('ij,ij->i', normalized[:-1], normalized[1:])
+        return 1 - similarities
+
+    def find_breakpoints(self, distances):
+        # indices of the sentences after which a chunk ends, where the distance to the next sentence is above the percentile threshold
+        if len(distances) == 0:
+            return np.zeros(0, dtype=np.int64)
+        breakpoint_distance = np.percentile(distances, self.breakpointPercentile)
+        return np.flatnonzero(distances > breakpoint_distance)
 
-            similarity = cos_sim(current_embedding, next_embedding)
-            distance = 1-(similarity[0].item())
+    def build_chunks(self, sentences, breakpoint_indices, file_name):
+        # groups the sentences between breakpoints into chunks in json format
+        # a chunk ends after every breakpoint index, any remaining sentences after the last breakpoint form the final chunk
+        if not sentences:
+            return []
+        ends = [int(index)+1 for index in breakpoint_indices]
+        if not ends or ends[-1] < len(sentences):
+            ends.append(len(sentences))
 
-            distances.append(distance)
-            sentences[i]['distance_to_next'] = distance
-        return distances, sentences
+        chunks = []
+        start_index = 0
+        for chunk_index, end_index in enumerate(ends):
+            group = sentences[start_index:end_index]
+            chunk_page = group[0]['page']
+            chunks.append({
+                "_id" : f"{file_name[:-4]}:{chunk_index}:{chunk_page}",
+                "text": ' '.join(sentence['text'] for sentence in group),
+                "metadata":{
+                    "page": chunk_page+1,
+                    "file": group[0]['file']
+                }
+            })
+            start_index = end_index
+        return chunks
 
     def chunk(self, doc, file_name=None):
         if file_name is None:
@@ -77,7 +191,6 @@ class SemanticChunker():
         sentences = []
         print("\nSplitting Sentences...")
         for page in doc:
-            # print(page)
             text = page.get_textpage().extractTEXT()
             sentence_list = self.sentence_splitter(text_data=text)
             # add each sentence along with the page number as metadata
@@ -88,7 +201,6 @@ class SemanticChunker():
                     'file':file_name
                 }
                 sentences.append(sentence_data)
-            # print(sentences[0]['file'])
 
         print("\nAdding Buffer...")
         # add n sentences (based on buffer size) before and after each sentence as context
@@ -96,133 +208,36 @@ class SemanticChunker():
         self.combine_sentences(sentences=sentences)
 
         print("\nGenerating Embeddings...")
-        # generate embeddings for each sentence
-        self.generateEmbeddingsTitan(sentences)
+        # generate embeddings for each sentence, one row per sentence
+        embeddings = self.generateEmbeddingsTitan(sentences)
         # calculate cosine distances between embeddings
-        distances, sentences = self.calculate_distances(sentences)
+        distances = self.calculate_distances(embeddings)
 
         print("\nChunking...")
         # chunk based on calculated breakpoints
-        breakpoint_distance = np.percentile(distances, self.breakpointPercentile)
-        breakpoint_indices = []
-        # create a list of indices where the distance is greater than the threshold
-        for i in range(len(distances)):
-            if distances[i] > breakpoint_distance:
-                breakpoint_indices.append(i)
-
-        print("\nBreakpoint Indices: ")
-        print(breakpoint_indices)
-
-        # Start chunking based on breakpoint indices
-        start_index = 0
-        chunk_index = 0
-        chunks = []
-        for index in breakpoint_indices:
-            end_index = index
-            # group the sentences that will form a chunk
-            group = sentences[start_index:end_index+1]
-            chunk_text = ''
-            chunk_page = group[0]['page']
-            chunk_id = f"{file_name[0:-4]}:{chunk_index}:{chunk_page}"
-            # add each sentence in the group to a string
-            for sentence in group:
-                chunk_text += (' ' + sentence['text'])
-            # create a chunk and it to the list of chunks in json format
-            chunks.append({
-                "_id" : chunk_id,
-                "text": chunk_text,
-                "metadata":{
-                    "page": chunk_page+1,
-                    "file": group[0]['file']
-                }
-            })
-            start_index = index+1
-            chunk_index += 1
-        # any remaining sentences after the last breakpoint index will form the final group
-        if start_index < len(sentences):
-            group = sentences[start_index:]
-            chunk_text=''
-            chunk_page = group[0]['page']
-            chunk_id = f"{file_name[:-4]}:{chunk_index}:{chunk_page}"
-            for sentence in group:
-                chunk_text += (' ' + sentence['text'])
-
-            chunks.append({
-                "_id" : chunk_id,
-                "text": chunk_text,
-                "metadata":{
-                    "page": chunk_page+1,
-                    "file": group[0]['file']
-                }
-            })
+        breakpoint_indices = self.find_breakpoints(distances)
+        chunks = self.build_chunks(sentences, breakpoint_indices, file_name)
 
         print("\nNumber of chunks: " + str(len(chunks)))
-
-        for chunk in chunks:
-            print('\n\n')
-            print(chunk)
-
         return chunks
 
 class LateChunker():
-    def __init__(self):
-        # load model and tokenizer
-        self.tokenizer = AutoTokenizer.from_pretrained('jinaai/jina-embeddings-v2-base-en', trust_remote_code=True)
-        self.model = AutoModel.from_pretrained('jinaai/jina-embeddings-v2-base-en', trust_remote_code=True)
-
-    def jina_segmenter(self, text):
-        # call the jina segmenter api
-        url = 'https://segment.jina.ai/'
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {os.environ.get('JINA', None)}'
-        }
-        data = {
-            "content": text,
-            "return_tokens": True,
-            "return_chunks": True,
-            "max_chunk_length": 1000
-        }
-        response_data = requests.post(url, headers=headers, json=data).json()
-        chunks = response_data.get('chunks', [])
-        chunk_positions = [(start, end) for start, end in response_data.get('chunk_positions', [])]
-        # print(chunk_positions)
-
-        # Unfortunately, chunk positions are based on character count rather than token count. We need the chunk positions with respect to tokens
-        # Hence the following code:
-        # tokenize the text
-        inputs = self.tokenizer(text, return_tensors='pt', return_offsets_mapping=True)
-        # return the start and end character indices for each token
-        token_offsets = inputs['offset_mapping'][0].tolist()  # (start, end) positions for each token
-        # the first and last items in the token offsets are (0,0) so we remove them
-        token_offsets.pop(len(token_offsets)-1)
-        token_offsets.pop(0)
-        print(inputs)
-
-        # create a list to store every token index where a chunk ends
-        chunk_end_index = []
-        # for each chunk get the start and end character indices
-        for (chunk_start, chunk_end) in chunk_positions:
-            # iterate through all the start and end character indices of the tokens
-            for i, (start, end) in enumerate(token_offsets):
-                # if it is the last token in the token list, add it to the list
-                if i == len(token_offsets)-1:
-                    chunk_end_index.append(i)
-                # if the chunk end character position is lesser than the current token end position:
-                elif chunk_end <= end:
-                    # add the current token as the end of a chunk
-                    chunk_end_index.append(i)
-                    break   # break to move onto the next chunk end character position
-
-        # now, populate the span annotations with the span of each chunk in terms of tokens
-        span_annotations = []
-        start = 0
-        for index in chunk_end_index:
-            span_annotations.append((start, index))
-            start = index+1
-        print(span_annotations)
-
-        return chunks, span_annotations
+    def __init__(self, model_id='jinaai/jina-embeddings-v2-base-en', max_length=8192, window_overlap=512, long_late_chunking=True, pooling='mean', segmenter=None):
+        # model and tokenizer are loaded once per process and shared between chunkers
+        self.model_id = model_id
+        self.tokenizer = registry.tokenizer(model_id)
+        self.model = registry.model(model_id)
+        # max number of tokens the model can take in one forward pass (including [CLS] and [SEP])
+        self.max_length = max_length
+        # number of tokens shared by neighbouring windows in long late chunking
+        self.window_overlap = window_overlap
+        # long late chunking embeds documents longer than max_length in overlapping windows instead of truncating them
+        self.long_late_chunking = long_late_chunking
+        # how token embeddings are pooled into chunk embeddings: 'mean', 'max' or 'cls'
+        self.pooling = pooling
+        # splits the document into chunks, defaults to the local segmenter so no network calls are needed
+        # pass segmenter.JinaSegmenter() to use the jina segmenter api instead
+        self.segmenter = segmenter if segmenter is not None else LocalSegmenter()
 
     def late_chunking(self, model_output, span_annotations, max_length=None):
         # this function is adapted and repurposed from the jina ai late chunking repo: https://github.com/jina-ai/late-chunking
@@ -238,41 +253,128 @@ class LateChunker():
                     if start < (max_length - 1)
                 ]
 
-            # mean pooling of chunk embeddings
-            pooled_embeddings = [
-                embeddings[start:end].sum(dim=0) / (end - start)
-                for start, end in annotations
-                if (end - start) >= 1
-            ]
-
-            # convert from tensor to python array
-            pooled_embeddings = [
-                embedding.detach().cpu().numpy() for embedding in pooled_embeddings
-            ]
-            outputs.append(pooled_embeddings)
+            # pool all the chunk embeddings at once, returns a (n_chunks, hidden_size) float32 array
+            outputs.append(pool_spans(embeddings, annotations, self.pooling))
 
         return outputs
 
-    def get_chunk_embeddings(self, doc):
-        print('extract text from pdf')
-        text = ''
-        for page in doc:
-            text += page.get_textpage().extractTEXT()
-        # remove unnecesary line breaks to clean up the text and chunk it better
-        text = text.replace(' \n ', '')
-        pattern = r"(?<![.!?])\n"
-        text = re.sub(pattern, "", text)
+    def late_chunking_windows(self, input_ids, span_annotations):
+        # late chunks a tokenized document of any length, returns one embedding per span like late_chunking
+        # the document is split into overlapping macro windows of at most max_length tokens, and the spans are pooled window by window
+        # into running per span sums (or maxima), so peak memory depends on the window size and the number of chunks but never
+        # holds the token embeddings of the whole document
+        # each window gets its own [CLS] and [SEP] tokens and only the middle of each window is kept,
+        # tokens in the overlap are taken from the window that gives them the most context on both sides
+        # based on the long late chunking approach from the jina ai late chunking repo: https://github.com/jina-ai/late-chunking
+        n_tokens = len(input_ids)
+        if n_tokens <= self.max_length:
+            with torch.no_grad():
+                token_embeddings = self.model(input_ids=input_ids.unsqueeze(0))[0][0]
+            return pool_spans(token_embeddings, span_annotations, self.pooling)
+
+        if self.pooling not in ('mean', 'max', 'cls'):
+            raise ValueError(f"Unknown pooling strategy {self.pooling}, expected 'mean', 'max' or 'cls'")
+        spans = [(start, end) for start, end in span_annotations if (end - start) >= 1]
+        span_starts = np.array([start for start, _ in spans], dtype=np.int64)
+        span_ends = np.array([end for _, end in spans], dtype=np.int64)
+
+        # the first and last tokens are [CLS] and [SEP], everything in between is the content of the document
+        cls_id = input_ids[:1]
+        sep_id = input_ids[-1:]
+        content = input_ids[1:-1]
+        window_size = self.max_length - 2
+        if not 0 <= self.window_overlap < window_size:
+            raise ValueError(f"window_overlap must be between 0 and {window_size - 1}, got {self.window_overlap}")
+        step = window_size - self.window_overlap
+        half_overlap = self.window_overlap // 2
+
+        # per span accumulators, allocated once we know the hidden size of the model
+        pooled = None
+        counts = np.zeros(len(spans), dtype=np.int64)
+        start = 0
+        while True:
+            end = min(start + window_size, len(content))
+            window_ids = torch.cat([cls_id, content[start:end], sep_id])
+            with torch.no_grad():
+                window_embeddings = self.model(input_ids=window_ids.unsqueeze(0))[0][0]
+            if pooled is None:
+                fill = -np.inf if self.pooling == 'max' else 0.0
+                pooled = np.full((len(spans), window_embeddings.shape[-1]), fill, dtype=np.float32)
+
+            # tokens of the document kept from this window, [CLS] comes from the first window and [SEP] from the last
+            # document position p is at position p - start in the window
+            keep_start = 0 if start == 0 else 1 + start + half_overlap
+            keep_end = n_tokens if end == len(content) else 1 + end - (self.window_overlap - half_overlap)
+            clipped_starts = np.maximum(span_starts, keep_start)
+            clipped_ends = np.minimum(span_ends, keep_end)
+            if self.pooling == 'cls':
+                # only the window that keeps the first token of a span
+                active = np.flatnonzero((span_starts >= keep_start) & (span_starts < keep_end))
+            else:
+                active = np.flatnonzero(clipped_ends > clipped_starts)
+            if len(active):
+                window_spans = list(zip((clipped_starts[active] - start).tolist(), (clipped_ends[active] - start).tolist()))
+                if self.pooling == 'mean':
+                    pooled[active] += pool_spans(window_embeddings, window_spans, 'sum')
+                    counts[active] += clipped_ends[active] - clipped_starts[active]
+                elif self.pooling == 'max':
+                    pooled[active] = np.maximum(pooled[active], pool_spans(window_embeddings, window_spans, 'max'))
+                else:
+                    pooled[active] = pool_spans(window_embeddings, window_spans, 'cls')
+
+            if end == len(content):
+                break
+            start += step
+
+        if self.pooling == 'mean':
+            pooled /= np.maximum(counts, 1)[:, None]
+        return pooled
+
+    def cache_key(self):
+        # everything that changes the chunks and embeddings produced for a text, used in embedding cache keys
+        segmenter_config = {k: v for k, v in vars(self.segmenter).items() if isinstance(v, (int, float, str, tuple))}
+        return json.dumps([
+            self.model_id, self.max_length, self.window_overlap, self.long_late_chunking, self.pooling,
+            type(self.segmenter).__name__, segmenter_config
+        ], sort_keys=True)
+
+    def embed_text(self, text, token_inputs=None):
+        # segments and late chunks a block of cleaned text
+        # returns the chunk texts, their embeddings and the character position where each chunk starts in the text
+        # tokenize the text once, the offsets are used to map chunks to tokens and the token ids are passed to the model
+        # token_inputs can be passed in when the text has already been tokenized (see ingest.group_pages and join_token_inputs)
+        if token_inputs is None:
+            token_inputs = self.tokenizer(text, return_tensors='pt', return_offsets_mapping=True)
 
         # chunk the text and return the start and end indices of the tokens of each chunk
-        print('jina segmenter')
-        chunks, span_annotations = self.jina_segmenter(text=text)
+        chunks, span_annotations = self.segmenter.segment(text, token_inputs)
+        # chunks without a token of their own (a few characters sharing a token with the previous chunk) get no embedding from
+        # pool_spans, their text is merged into the previous chunk (or the next one at the start) so every embedding stays with its chunk
+        chunks, span_annotations = merge_empty_spans(chunks, span_annotations)
+        token_offsets = token_inputs['offset_mapping'][0].tolist()
+        chunk_starts = [token_offsets[start][0] for start, _ in span_annotations]
+
+        # chunk token embeddings together based on the indices in the previous step
+        if self.long_late_chunking:
+            # embed the whole text window by window, spans that cross a window boundary are pooled over every window they are kept in
+            chunk_embeddings = self.late_chunking_windows(token_inputs['input_ids'][0], span_annotations)
+        else:
+            # single forward pass, any chunks past max_length are dropped
+            with torch.no_grad():
+                model_output = self.model(input_ids=token_inputs['input_ids'], attention_mask=token_inputs['attention_mask'])
+            chunk_embeddings = self.late_chunking(model_output, [span_annotations], self.max_length)[0]
+
+        return chunks, chunk_embeddings, chunk_starts
+
+    def get_chunk_embeddings(self, doc):
+        # embeds the whole document in one go, see ingest.IngestionPipeline for the page by page version
+        print('extract text from pdf')
+        text = ''.join(page.get_textpage().extractTEXT() for page in doc)
+        text = clean_text(text)
 
-        # call the tokenizer on the input text and chunk token embeddings together based on the indices in the previous step
         print('late chunking')
-        token_inputs = self.tokenizer(text, return_tensors='pt')
-        model_output = self.model(**token_inputs)
-        chunk_embeddings = self.late_chunking(model_output, [span_annotations], 8000)[0]
+        chunks, chunk_embeddings, _ = self.embed_text(text)
+        print(f"{len(chunk_embeddings)} chunks")
 
         # return the chunks and the chunk embeddings
-        print('done hehe')
         return chunks, chunk_embeddings
@@ -0,0 +1,101 @@
+import re
+
+from retrieval import select_within_budget
+
+# Builds the messages sent to the chat model for a turn: the question with the retrieved chunks, and as much of the recent
+# conversation as fits in the token budget. Older turns are dropped, or replaced by a short summary when a summarizer is given.
+
+
+def shingles(text, size=3):
+    # set of overlapping word triples, used to measure how much text two chunks share
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i+size]) for i in range(len(words) - size + 1)}
+
+
+def dedupe_chunks(chunks, threshold=0.8):
+    # drops chunks whose text is mostly (threshold of its shingles) contained in a better ranked chunk
+    # chunks from overlapping windows or repeated passages would otherwise spend the budget on the same text twice
+    kept = []
+    kept_shingles = []
+    for chunk in chunks:
+        chunk_shingles = shingles(chunk['text'])
+        if any(len(chunk_shingles & other) >= threshold * max(len(chunk_shingles), 1) for other in kept_shingles):
+            continue
+        kept.append(chunk)
+        kept_shingles.append(chunk_shingles)
+    return kept
+
+
+def message_text(message):
+    return ''.join(content.get('text', '') for content in message['content'])
+
+
+class ContextAssembler():
+    def __init__(self, count_tokens, chunk_budget=1500, history_budget=1000, dedupe_threshold=0.8, summarize=None, baseline_chunks=3):
+        # count_tokens(text) -> number of tokens
+        self.count_tokens = count_tokens
+        # tokens that can be spent on retrieved chunks and on earlier turns of the conversation
+        self.chunk_budget = chunk_budget
+        self.history_budget = history_budget
+        self.dedupe_threshold = dedupe_threshold
+        # optional summarize(messages) -> text, called with the turns that didn't fit in the history budget
+        self.summarize = summarize
+        # chunks the prompt had before packing (the top 3 search results), the baseline of tokens_saved
+        self.baseline_chunks = baseline_chunks
+
+    def pack_chunks(self, chunks):
+        # best chunks first, without near duplicates, until the chunk budget is used up
+        chunks = dedupe_chunks(chunks, self.dedupe_threshold)
+        return select_within_budget(chunks, self.count_tokens, self.chunk_budget)
+
+    def pack_history(self, messages):
+        # keeps the most recent (user, assistant) turns that fit in the history budget, returns (kept messages, dropped messages, tokens)
+        # whole turns are kept so the messages still alternate starting with a user message, as the converse api requires
+        turns = [messages[i:i+2] for i in range(0, len(messages), 2)]
+        kept = []
+        used = 0
+        for turn in reversed(turns):
+            tokens = sum(self.count_tokens(message_text(message)) for message in turn)
+            if used + tokens > self.history_budget:
+                break
+            kept.insert(0, turn)
+            used += tokens
+        kept_messages = [message for turn in kept for message in turn]
+        dropped_messages = messages[:len(messages) - len(kept_messages)]
+        return kept_messages, dropped_messages, used
+
+    def build(self, question, chunks, messages):
+        # returns (messages to send, stats), messages is the chat history before this question
+        # stats compares the packed prompt with the unpacked one, which resent the whole history and the top baseline_chunks chunks
+        selected, chunk_tokens = self.pack_chunks(chunks)
+        history, dropped, history_tokens = self.pack_history(messages)
+
+        prompt = question
+        if selected:
+            context_to_add = ", ".join(f"chunk {i}:{chunk['text']}" for i, chunk in enumerate(selected, start=1))
+            prompt = f"Answer <{question}> using relevant context from <Context from pdf->{context_to_add}>"
+
+        summary_tokens = 0
+        if dropped and self.summarize is not None:
+            summary = self.summarize(dropped)
+            summary_tokens = self.count_tokens(summary)
+            prompt = f"Summary of the earlier conversation: {summary}\n\n{prompt}"
+
+        full_tokens = (
+            sum(self.count_tokens(message_text(message)) for message in messages)
+            + sum(self.count_tokens(chunk['text']) for chunk in chunks[:self.baseline_chunks])
+        )
+        packed_tokens = history_tokens + chunk_tokens + summary_tokens
+        stats = {
+            "chunks": len(selected),
+            "chunk_tokens": chunk_tokens,
+            "history_messages": len(history),
+            "dropped_messages": len(dropped),
+            "history_tokens": history_tokens,
+            "summary_tokens": summary_tokens,
+            # negative when the budget fits more context than the unpacked prompt had
+            "tokens_saved": full_tokens - packed_tokens
+        }
+        return history + [{'role': 'user', 'content': [{'text': prompt}]}], stats
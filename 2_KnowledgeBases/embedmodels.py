@@ -0,0 +1,103 @@
+import resource
+import sys
+import threading
+import time
+
+from sentence_transformers import CrossEncoder
+from sentence_transformers import SentenceTransformer
+from transformers import AutoModel
+from transformers import AutoTokenizer
+
+# Process wide registry for the local embedding models
+# Loading the jina model takes seconds and hundreds of MB, so every model is loaded once per process and shared
+# by the LateChunker, the SemanticChunker and the query embedding in the chat app
+
+JINA_MODEL_ID = 'jinaai/jina-embeddings-v2-base-en'
+MINILM_MODEL_ID = 'sentence-transformers/all-MiniLM-L6-v2'
+# small (22M parameter) cross-encoder trained on ms marco passage ranking, fast enough to re-rank a few dozen chunks on cpu
+RERANKER_MODEL_ID = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+
+
+def peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def param_bytes(model):
+    # memory taken up by the weights of a torch model (tokenizers don't have parameters)
+    if not hasattr(model, 'parameters'):
+        return 0
+    return sum(p.numel() * p.element_size() for p in model.parameters())
+
+
+class ModelRegistry():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+        self._warm = set()
+        # load time and memory metrics for every model that has been loaded, keyed by (kind, model id)
+        self.metrics = {}
+
+    def _load(self, key, loader):
+        # fast path, model is already loaded
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        with self._lock:
+            # check again in case another thread loaded the model while we were waiting for the lock
+            if key not in self._models:
+                rss_before = peak_rss_bytes()
+                start = time.perf_counter()
+                model = loader()
+                load_seconds = time.perf_counter() - start
+                self._models[key] = model
+                self.metrics[key] = {
+                    'load_seconds': load_seconds,
+                    'param_bytes': param_bytes(model),
+                    'peak_rss_increase_bytes': peak_rss_bytes() - rss_before
+                }
+                print(f"Loaded {key[0]} {key[1]} in {load_seconds:.2f}s")
+            return self._models[key]
+
+    def tokenizer(self, model_id=JINA_MODEL_ID):
+        return self._load(('tokenizer', model_id), lambda: AutoTokenizer.from_pretrained(model_id, trust_remote_code=True))
+
+    def model(self, model_id=JINA_MODEL_ID):
+        def loader():
+            model = AutoModel.from_pretrained(model_id, trust_remote_code=True)
+            # inference only, disables dropout
+            model.eval()
+            return model
+        return self._load(('model', model_id), loader)
+
+    def sentence_transformer(self, model_id=MINILM_MODEL_ID):
+        return self._load(('sentence_transformer', model_id), lambda: SentenceTransformer(model_id))
+
+    def cross_encoder(self, model_id=RERANKER_MODEL_ID):
+        return self._load(('cross_encoder', model_id), lambda: CrossEncoder(model_id, device='cpu'))
+
+    def warm_up(self, model_id=JINA_MODEL_ID):
+        # load the tokenizer and model at startup and run one tiny forward pass so the first real request doesn't pay for it
+        if model_id in self._warm:
+            return
+        self.tokenizer(model_id)
+        model = self.model(model_id)
+        start = time.perf_counter()
+        model.encode('warm up')
+        self.metrics[('warm_up', model_id)] = {'load_seconds': time.perf_counter() - start}
+        self._warm.add(model_id)
+
+    def get_metrics(self):
+        # flatten the metrics into a list of rows that can be displayed or logged
+        rows = []
+        for (kind, model_id), values in self.metrics.items():
+            rows.append({'kind': kind, 'model': model_id, **values})
+        return rows
+
+
+# single registry shared by the whole process
+registry = ModelRegistry()
@@ -1,4 +1,18 @@
+import asyncio
+import functools
 import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import numpy as np
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+from botocore.exceptions import HTTPClientError
 
 # Classes for Amazon Bedrock Foundation Models
 # Follows the Bedrock documentation. Amazon models work differently compared to Anthropic models hence the different classes
@@ -7,9 +21,180 @@ class ResponseError(Exception):
     def __init__(self, message):
         self.message = message
 
+# exception events a bedrock response stream can end with, the answer is cut off when one arrives
+STREAM_EXCEPTIONS = (
+    "internalServerException", "modelStreamErrorException", "validationException", "throttlingException", "modelTimeoutException",
+    "serviceUnavailableException"
+)
+
+def stream_exception(event):
+    # ResponseError for an exception event of a response stream, None for any other event
+    for name in STREAM_EXCEPTIONS:
+        if name in event:
+            return ResponseError(f"Stream error. Error is {name}: {event[name].get('message', '')}")
+    return None
+
+# bedrock error codes that are worth retrying after a short wait, any 5xx error is retried as well
+RETRYABLE_ERRORS = {
+    "ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException", "ModelNotReadyException", "InternalServerException",
+    "ModelTimeoutException"
+}
+# errors raised before a response arrives: connection failures and timeouts (EndpointConnectionError, ConnectTimeoutError,
+# ReadTimeoutError, ConnectionClosedError)
+RETRYABLE_EXCEPTIONS = (BotocoreConnectionError, HTTPClientError)
+
+def retryable(error):
+    # whether a failed bedrock request is worth retrying after a short wait
+    if isinstance(error, RETRYABLE_EXCEPTIONS):
+        return True
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return code in RETRYABLE_ERRORS or status >= 500
+    return False
+
+# one bedrock-runtime client per region for the whole process, boto3 clients are thread safe and share their connection pool
+_bedrock_clients = {}
+_bedrock_clients_lock = threading.Lock()
+# limits the number of bedrock requests in flight across the process (BEDROCK_MAX_CONCURRENCY)
+BEDROCK_MAX_CONCURRENCY = int(os.environ.get("BEDROCK_MAX_CONCURRENCY", 16))
+_bedrock_slots = threading.BoundedSemaphore(BEDROCK_MAX_CONCURRENCY)
+# threads the asyncio api runs the blocking boto3 calls on
+_bedrock_executor = ThreadPoolExecutor(max_workers=BEDROCK_MAX_CONCURRENCY)
+
+# retries of throttled, unavailable and timed out bedrock requests, made by bedrock_call (see call_with_retry)
+# botocore is set to a single attempt per request (BEDROCK_MAX_ATTEMPTS, as total_max_attempts) so the two layers don't multiply
+# and no retry waits while holding a concurrency slot
+BEDROCK_MAX_RETRIES = int(os.environ.get("BEDROCK_MAX_RETRIES", 5))
+
+def get_bedrock_client(region_name=None):
+    # shared bedrock-runtime client, created on first use
+    # BEDROCK_MAX_POOL_CONNECTIONS sets the connection pool size and BEDROCK_MAX_ATTEMPTS the total number of attempts botocore
+    # makes per request, including the first one (botocore's max_attempts would count retries only), retries with backoff are left to bedrock_call
+    region_name = region_name or os.environ.get("AWS_DEFAULT_REGION", None)
+    with _bedrock_clients_lock:
+        client = _bedrock_clients.get(region_name)
+        if client is None:
+            config = Config(
+                max_pool_connections=int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", 50)),
+                retries={"total_max_attempts": int(os.environ.get("BEDROCK_MAX_ATTEMPTS", 1)), "mode": "standard"},
+                connect_timeout=int(os.environ.get("BEDROCK_CONNECT_TIMEOUT", 10)),
+                read_timeout=int(os.environ.get("BEDROCK_READ_TIMEOUT", 120))
+            )
+            client = boto3.client("bedrock-runtime", region_name=region_name, config=config)
+            _bedrock_clients[region_name] = client
+        return client
+
+def bedrock_call(fn, *args, limiter=None, max_retries=None, **kwargs):
+    # calls a bedrock client method once a concurrency slot is free, retrying throttling errors with backoff (call_with_retry)
+    # the slot is only held during an attempt, not while backing off. limiter is an optional RateLimiter waited on before every attempt
+    def attempt():
+        with _bedrock_slots:
+            return fn(*args, **kwargs)
+    return call_with_retry(attempt, max_retries=BEDROCK_MAX_RETRIES if max_retries is None else max_retries, limiter=limiter)
+
+class BedrockCallProxy():
+    # wraps a bedrock client so every method call goes through bedrock_call (concurrency limit and retries)
+    # for libraries that make the calls themselves, e.g. langchain_aws.ChatBedrock(client=BedrockCallProxy(get_bedrock_client()))
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+        return functools.wraps(attribute)(functools.partial(bedrock_call, attribute))
+
+async def run_async(fn, *args, **kwargs):
+    # runs a blocking call on the shared executor so it can be awaited, many calls can be in flight at once with asyncio.gather
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_bedrock_executor, functools.partial(fn, *args, **kwargs))
+
+class RateLimiter():
+    # thread safe limiter that spaces out calls so no more than max_per_second start every second
+    def __init__(self, max_per_second=None):
+        self.interval = 1.0 / max_per_second if max_per_second else 0.0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        if self.interval == 0.0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+def call_with_retry(fn, max_retries=5, base_delay=0.5, max_delay=20.0, limiter=None):
+    # calls fn, retrying throttling, availability, 5xx, connection and timeout errors (see retryable) with exponential backoff and jitter
+    # an optional RateLimiter is waited on before every attempt, so retries count towards the rate as well
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            return fn()
+        except (ClientError, *RETRYABLE_EXCEPTIONS) as e:
+            if not retryable(e) or attempt == max_retries:
+                raise
+            delay = min(max_delay, base_delay * (2 ** attempt))
+            time.sleep(random.uniform(0, delay))
+
+class ResponseStream():
+    # iterates over the text pieces of a streaming bedrock response as they arrive, and records the full text, token counts and timings
+    # parse_event(event) -> (text, input_tokens, output_tokens), any of which can be None
+    def __init__(self, events, parse_event, start=None):
+        self.events = events
+        self.parse_event = parse_event
+        # time the request was sent, so time to first token includes the request latency
+        self.start = start if start is not None else time.perf_counter()
+        self.text = ""
+        self.input_tokens = None
+        self.output_tokens = None
+        self.first_token_seconds = None
+        self.total_seconds = None
+
+    def __iter__(self):
+        # raises ResponseError if the stream fails part way, self.text is then an incomplete answer
+        events = iter(self.events)
+        while True:
+            try:
+                event = next(events)
+            except StopIteration:
+                break
+            except ClientError as e:
+                # botocore raises exception events as an EventStreamError while reading the stream
+                raise ResponseError(f"Stream error. Error is {e}")
+            exception = stream_exception(event)
+            if exception is not None:
+                raise exception
+            text, input_tokens, output_tokens = self.parse_event(event)
+            if input_tokens is not None:
+                self.input_tokens = input_tokens
+            if output_tokens is not None:
+                self.output_tokens = output_tokens
+            if text:
+                if self.first_token_seconds is None:
+                    self.first_token_seconds = time.perf_counter() - self.start
+                self.text += text
+                yield text
+        self.total_seconds = time.perf_counter() - self.start
+
+    def metrics(self):
+        # time to first token, and output tokens per second while generating (after the first token)
+        generation_seconds = (self.total_seconds or 0.0) - (self.first_token_seconds or 0.0)
+        return {
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "time_to_first_token": self.first_token_seconds,
+            "total_seconds": self.total_seconds,
+            "tokens_per_second": self.output_tokens / generation_seconds if self.output_tokens and generation_seconds > 0 else None
+        }
+
 class Claude3_Haiku():
-    def __init__(self,  bedrock_client, temperature=0.5, topP=0.8, topK=250, maxTokenCount=4096):
-        self.bedrock = bedrock_client
+    def __init__(self,  bedrock_client=None, temperature=0.5, topP=0.8, topK=250, maxTokenCount=4096):
+        self.bedrock = bedrock_client or get_bedrock_client()
         self.model_id = "anthropic.claude-3-haiku-20240307-v1:0"
         self.model_params = {
             "maxTokenCount":maxTokenCount,
@@ -31,7 +216,8 @@ class Claude3_Haiku():
             "top_k": model_params["topK"]
         }
 
-        response = self.bedrock.converse(
+        response = bedrock_call(
+            self.bedrock.converse,
             modelId=self.model_id,
             messages=messages,
             inferenceConfig=inference_params,
@@ -44,9 +230,45 @@ class Claude3_Haiku():
 
         return output, input_tokens, output_tokens
 
+    async def aconverse(self, messages, model_params):
+        # asyncio version of converse
+        return await run_async(self.converse, messages, model_params)
+
+    def converse_stream(self, messages, model_params):
+        # same as converse but returns a ResponseStream that yields the text as it is generated
+        # the full output message is {'role':'assistant', 'content':[{'text':stream.text}]} once the stream has been read
+        inference_params={
+            "maxTokens":model_params["maxTokenCount"],
+            "temperature": model_params["temperature"]
+        }
+        additional_params={
+            "top_p": model_params["topP"],
+            "top_k": model_params["topK"]
+        }
+
+        start = time.perf_counter()
+        # the concurrency slot is only held until the stream starts
+        response = bedrock_call(
+            self.bedrock.converse_stream,
+            modelId=self.model_id,
+            messages=messages,
+            inferenceConfig=inference_params,
+            additionalModelRequestFields=additional_params
+        )
+
+        def parse_event(event):
+            if "contentBlockDelta" in event:
+                return event["contentBlockDelta"]["delta"].get("text"), None, None
+            if "metadata" in event:
+                usage = event["metadata"]["usage"]
+                return None, usage["inputTokens"], usage["outputTokens"]
+            return None, None, None
+
+        return ResponseStream(response["stream"], parse_event, start)
+
 class TitanText():
-    def __init__(self, bedrock_client, maxTokenCount=3072, temp=0.7, topP=0.9):
-        self.bedrock = bedrock_client
+    def __init__(self, bedrock_client=None, maxTokenCount=3072, temp=0.7, topP=0.9):
+        self.bedrock = bedrock_client or get_bedrock_client()
         self.model_id = "amazon.titan-text-premier-v1:0"
         self.model_params = {
             "maxTokenCount":maxTokenCount,
@@ -59,7 +281,7 @@ class TitanText():
             "inputText": prompt,
             "textGenerationConfig": self.model_params
         })
-        response = self.bedrock.invoke_model(body=body, modelId=self.model_id)
+        response = bedrock_call(self.bedrock.invoke_model, body=body, modelId=self.model_id)
         response_body = json.loads(response.get("body").read())
 
         finish_reason = response_body.get("error")
@@ -76,9 +298,32 @@ class TitanText():
 
         return output, input_tokens, output_tokens
 
+    async def agenerate_response(self, prompt):
+        # asyncio version of generate_response
+        return await run_async(self.generate_response, prompt)
+
+    def generate_response_stream(self, prompt):
+        # same as generate_response but returns a ResponseStream that yields the text as it is generated
+        body = json.dumps({
+            "inputText": prompt,
+            "textGenerationConfig": self.model_params
+        })
+        start = time.perf_counter()
+        response = bedrock_call(self.bedrock.invoke_model_with_response_stream, body=body, modelId=self.model_id)
+
+        def parse_event(event):
+            chunk = json.loads(event["chunk"]["bytes"])
+            if chunk.get("error") is not None:
+                raise ResponseError(f"Text generation error. Error is {chunk['error']}")
+            # the last chunk has the token counts for the whole response
+            metrics = chunk.get("amazon-bedrock-invocationMetrics", {})
+            return chunk.get("outputText"), metrics.get("inputTokenCount"), metrics.get("outputTokenCount")
+
+        return ResponseStream(response["body"], parse_event, start)
+
 class TitanEmbeddings():
-    def __init__(self, bedrock_client, dimensions=1024, normalize=True, embeddingTypes=['float']):
-        self.bedrock = bedrock_client
+    def __init__(self, bedrock_client=None, dimensions=1024, normalize=True, embeddingTypes=['float']):
+        self.bedrock = bedrock_client or get_bedrock_client()
         self.model_id = "amazon.titan-embed-text-v2:0"
         self.model_params = {
             "dimensions":dimensions,
@@ -86,7 +331,8 @@ class TitanEmbeddings():
             "embeddingTypes":embeddingTypes
         }
 
-    def generate_embeddings(self, text):
+    def generate_embeddings(self, text, limiter=None, max_retries=None):
+        # limiter and max_retries are passed on to bedrock_call
         body =  {
             "inputText":text,
             "dimensions": self.model_params["dimensions"],
@@ -94,7 +340,34 @@ class TitanEmbeddings():
             "embeddingTypes": self.model_params["embeddingTypes"]
         }
         body = json.dumps(body)
-        response = self.bedrock.invoke_model(body=body, modelId=self.model_id)
+        response = bedrock_call(self.bedrock.invoke_model, body=body, modelId=self.model_id, limiter=limiter, max_retries=max_retries)
         response_body = json.loads(response.get('body').read())
 
         return response_body['embedding'], response_body['inputTextTokenCount']
+
+    async def agenerate_embeddings(self, text):
+        # asyncio version of generate_embeddings
+        return await run_async(self.generate_embeddings, text)
+
+    async def agenerate_embeddings_batch(self, texts, max_retries=None):
+        # asyncio version of generate_embeddings_batch, every text is in flight at once up to BEDROCK_MAX_CONCURRENCY
+        results = await asyncio.gather(*[run_async(self.generate_embeddings, text, max_retries=max_retries) for text in texts])
+        embeddings = [embedding for embedding, _ in results]
+        if not embeddings:
+            return np.zeros((0, self.model_params["dimensions"]), dtype=np.float32)
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def generate_embeddings_batch(self, texts, max_workers=8, max_per_second=None, max_retries=None):
+        # embeds many texts concurrently, titan only takes one text per request so requests are fanned out over a bounded thread pool
+        # throttled requests are retried with backoff, returns a (len(texts), dimensions) float32 matrix in the same order as texts
+        limiter = RateLimiter(max_per_second)
+
+        def embed(text):
+            return self.generate_embeddings(text, limiter=limiter, max_retries=max_retries)[0]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            embeddings = list(executor.map(embed, texts))
+
+        if not embeddings:
+            return np.zeros((0, self.model_params["dimensions"]), dtype=np.float32)
+        return np.asarray(embeddings, dtype=np.float32)
@@ -0,0 +1,228 @@
+import threading
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import content_hash
+from chunker import clean_text
+from chunker import join_token_inputs
+
+# Streaming ingestion pipeline for pdf documents
+# extract -> clean -> segment -> embed -> upsert
+# every stage is a generator that pulls from the previous one, so only one block of pages is held in memory at a time
+# and the first chunks are in the database before the rest of the document has been embedded
+
+
+# model windows per block with long late chunking, the memory of the forward pass doesn't depend on it (chunker.late_chunking_windows)
+BLOCK_WINDOWS = 4
+
+# pymupdf isn't thread safe, documents ingested at the same time (jobs.IngestionQueue) take turns reading a page
+pdf_lock = threading.Lock()
+
+
+def extract_pages(doc, page_numbers=None):
+    # yields (page_number, text) one page at a time, for every page or only the given ones
+    for page_number in (range(len(doc)) if page_numbers is None else page_numbers):
+        with pdf_lock:
+            text = doc[page_number].get_textpage().extractTEXT()
+        yield page_number, text
+
+
+def clean_pages(pages):
+    for page_number, text in pages:
+        yield page_number, clean_text(text)
+
+
+def group_pages(pages, tokenizer, block_tokens):
+    # buffers pages into blocks of at most block_tokens tokens (a single longer page forms its own block)
+    # yields (text, page_starts, page_numbers, token_inputs) where page_starts is the character position where each page starts in the text
+    # every page is tokenized once, the tokens are reused as the model inputs of the block (see chunker.join_token_inputs)
+    texts, page_starts, page_numbers = [], [], []
+    input_ids, offsets = [], []
+    length = 0
+    for page_number, text in pages:
+        page_inputs = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        # the block is full, send it down the pipeline before adding this page
+        if texts and len(input_ids) + len(page_inputs['input_ids']) > block_tokens:
+            yield ''.join(texts), page_starts, page_numbers, join_token_inputs(tokenizer, input_ids, offsets)
+            texts, page_starts, page_numbers = [], [], []
+            input_ids, offsets = [], []
+            length = 0
+        texts.append(text)
+        page_starts.append(length)
+        page_numbers.append(page_number)
+        input_ids.extend(page_inputs['input_ids'])
+        # token offsets are relative to the page, shift them to the block
+        offsets.extend((start + length, end + length) for start, end in page_inputs['offset_mapping'])
+        length += len(text)
+
+    if texts:
+        yield ''.join(texts), page_starts, page_numbers, join_token_inputs(tokenizer, input_ids, offsets)
+
+
+class IngestionPipeline():
+    def __init__(self, chunker, vector_store, block_tokens=None, batch_size=None, cache=None, embed_text=None):
+        # LateChunker used to segment and embed each block
+        self.chunker = chunker
+        # embed_text(text, token_inputs) -> (chunks, chunk_embeddings, chunk_starts), defaults to chunker.embed_text in this process
+        # jobs.IngestionQueue passes a function that runs it in a worker process instead
+        self.embed_text = embed_text if embed_text is not None else chunker.embed_text
+        # database the chunks are upserted into (anything with a load_chunks method)
+        self.vector_store = vector_store
+        # late chunking context size. with long late chunking a block spans several overlapping model windows (BLOCK_WINDOWS of them),
+        # so chunks only lose context from their neighbours at the much rarer block edges. otherwise one forward pass of the model
+        if block_tokens is None:
+            block_tokens = (chunker.max_length - 2) * (BLOCK_WINDOWS if chunker.long_late_chunking else 1)
+        self.block_tokens = block_tokens
+        # number of chunks passed to load_chunks at once, by default enough for MongoDB.load_chunks to write a full batch on each of
+        # its worker threads (stores without parallel writes get 64)
+        if batch_size is None:
+            batch_size = getattr(vector_store, 'batch_size', 64) * getattr(vector_store, 'max_workers', 1)
+        self.batch_size = batch_size
+        # optional cache.EmbeddingCache, whole documents and individual blocks that were embedded before are read back instead
+        self.cache = cache
+
+    def document_key(self, pdf_hash):
+        # cache key for a whole document, pdf_hash is the content hash of the pdf file
+        return content_hash('document', self.chunker.cache_key(), str(self.block_tokens), pdf_hash)
+
+    def embed_block(self, text, token_inputs=None):
+        # late chunks a block, using the cached chunks and embeddings if the same text was embedded with the same settings before
+        if self.cache is None:
+            return self.embed_text(text, token_inputs)
+
+        key = content_hash('block', self.chunker.cache_key(), text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            data, chunk_embeddings = cached
+            return data['chunks'], chunk_embeddings, data['chunk_starts']
+
+        chunks, chunk_embeddings, chunk_starts = self.embed_text(text, token_inputs)
+        # chunks past max_length are dropped when long late chunking is off, only cache the chunks that have embeddings
+        n_chunks = len(chunk_embeddings)
+        self.cache.put(key, {'chunks': chunks[:n_chunks], 'chunk_starts': chunk_starts[:n_chunks]}, chunk_embeddings)
+        return chunks, chunk_embeddings, chunk_starts
+
+    def cached_blocks(self, doc_key):
+        # block keys and page layout of a document that was fully embedded before, or None
+        cached = self.cache.get(doc_key)
+        if cached is None:
+            return None
+        blocks = cached[0]['blocks']
+        # the blocks might have been evicted since
+        if not all(self.cache.contains(block['key']) for block in blocks):
+            return None
+        return blocks
+
+    def embed_blocks(self, blocks, file_name, tenant=None):
+        # late chunks every block and yields one database entry per chunk
+        embedded = (
+            self.embed_block(text, token_inputs) + (page_starts, page_numbers) for text, page_starts, page_numbers, token_inputs in blocks
+        )
+        return self.entries(embedded, file_name, tenant)
+
+    def entries(self, embedded_blocks, file_name, tenant=None):
+        # turns (chunks, chunk_embeddings, chunk_starts, page_starts, page_numbers) blocks into database entries
+        # chunks uploaded by a tenant get the tenant in their metadata (to filter searches on) and in their id, so tenants
+        # uploading files with the same name don't overwrite each other's chunks
+        id_prefix = f"{tenant}:{file_name}" if tenant is not None else file_name
+        metadata = {"tenant": tenant} if tenant is not None else {}
+        chunk_index = 0
+        for chunks, chunk_embeddings, chunk_starts, page_starts, page_numbers in embedded_blocks:
+            for chunk_text, chunk_embedding, chunk_start in zip(chunks, chunk_embeddings, chunk_starts):
+                # page the chunk starts on
+                page_number = page_numbers[bisect_right(page_starts, chunk_start) - 1]
+                yield {
+                    "_id": f"{id_prefix}:{chunk_index}",
+                    "text": chunk_text,
+                    "embedding": chunk_embedding.tolist(),
+                    "metadata": {
+                        "file": file_name,
+                        "page": page_number + 1,
+                        **metadata
+                    }
+                }
+                chunk_index += 1
+
+    def batches(self, entries):
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def replay_blocks(self, blocks, pages_done, doc):
+        # yields the blocks of a cached document without extracting any text, the chunks come from the block cache
+        # a block evicted since cached_blocks checked it is extracted from doc and embedded again
+        for block in blocks:
+            pages_done.extend(block['page_numbers'])
+            cached = self.cache.get(block['key'])
+            if cached is not None:
+                data, chunk_embeddings = cached
+                chunks, chunk_starts = data['chunks'], data['chunk_starts']
+            else:
+                pages = clean_pages(extract_pages(doc, block['page_numbers']))
+                text, _, _, token_inputs = next(group_pages(pages, self.chunker.tokenizer, float('inf')))
+                chunks, chunk_embeddings, chunk_starts = self.embed_block(text, token_inputs)
+            yield chunks, chunk_embeddings, chunk_starts, block['page_starts'], block['page_numbers']
+
+    def record_blocks(self, blocks, doc_key):
+        # passes blocks through and stores the document layout in the cache once every block has been seen
+        layout = []
+        for text, page_starts, page_numbers, token_inputs in blocks:
+            layout.append({
+                'key': content_hash('block', self.chunker.cache_key(), text),
+                'page_starts': page_starts,
+                'page_numbers': page_numbers
+            })
+            yield text, page_starts, page_numbers, token_inputs
+        self.cache.put(doc_key, {'blocks': layout})
+
+    def run(self, doc, file_name, pdf_hash=None, tenant=None):
+        # runs the whole pipeline, yields a progress report after every batch that has been upserted
+        # pdf_hash is the content hash of the pdf file, re-uploads of a cached document skip extraction and embedding entirely
+        # tenant namespaces the chunks (see entries), None for chunks shared by everyone
+        pages_done = []
+
+        def track(pages):
+            # pass pages through while keeping count of how many have been extracted
+            for page_number, text in pages:
+                pages_done.append(page_number)
+                yield page_number, text
+
+        doc_key = self.document_key(pdf_hash) if self.cache is not None and pdf_hash is not None else None
+        cached_blocks = self.cached_blocks(doc_key) if doc_key is not None else None
+        if cached_blocks is not None:
+            entries = self.entries(self.replay_blocks(cached_blocks, pages_done, doc), file_name, tenant)
+        else:
+            pages = clean_pages(track(extract_pages(doc)))
+            blocks = group_pages(pages, self.chunker.tokenizer, self.block_tokens)
+            if doc_key is not None:
+                blocks = self.record_blocks(blocks, doc_key)
+            entries = self.embed_blocks(blocks, file_name, tenant)
+
+        def report(chunks_done, result):
+            return {
+                "pages_done": len(pages_done),
+                "page_count": len(doc),
+                "chunks_done": chunks_done,
+                "cached": cached_blocks is not None,
+                "cache": self.cache.stats() if self.cache is not None else None,
+                "result": result
+            }
+
+        # batches are written in a background thread, so the next block is embedded while the previous batch is being upserted
+        chunks_done = 0
+        pending = None
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            for batch in self.batches(entries):
+                future = writer.submit(self.vector_store.load_chunks, batch)
+                if pending is not None:
+                    chunks_done += pending[0]
+                    yield report(chunks_done, pending[1].result())
+                pending = (len(batch), future)
+            if pending is not None:
+                chunks_done += pending[0]
+                yield report(chunks_done, pending[1].result())
@@ -0,0 +1,196 @@
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+import pymupdf
+from ingest import IngestionPipeline
+from ingest import pdf_lock
+
+# Background ingestion of uploaded pdfs
+# every upload becomes a job that runs the IngestionPipeline on a worker thread, so the app stays responsive and several documents
+# can be ingested at once. the late chunking forward pass is cpu bound and can run in worker processes, each with its own copy
+# of the embedding model, while the threads handle pdf extraction and database writes
+
+
+# late chunker of a worker process, created once by _init_worker
+_worker_chunker = None
+
+def _init_worker(chunker_settings, n_threads):
+    global _worker_chunker
+    import torch
+    from chunker import LateChunker
+    # split the cores between the worker processes instead of every process using all of them
+    torch.set_num_threads(n_threads)
+    _worker_chunker = LateChunker(**chunker_settings)
+
+def _embed_text(text, token_inputs=None):
+    return _worker_chunker.embed_text(text, token_inputs)
+
+
+class IngestionJob():
+    # state of one upload: queued -> ingesting -> indexing -> done, or failed
+    def __init__(self, file_name, path, pdf_hash, tenant=None):
+        self.id = uuid.uuid4().hex
+        self.file_name = file_name
+        self.tenant = tenant
+        self.path = path
+        self.pdf_hash = pdf_hash
+        self.status = 'queued'
+        self.pages_done = 0
+        self.page_count = 0
+        self.chunks_done = 0
+        # chunks written to the database, chunks skipped because they were already there unchanged, and time spent writing
+        self.chunks_written = 0
+        self.chunks_skipped = 0
+        self.write_seconds = 0.0
+        # error messages of the chunks the database refused, the job fails if there are any
+        self.write_errors = []
+        # set once the search indexes have been created after the first batch
+        self.index_created = False
+        self.cached = False
+        # 'ExceptionType: message' and the formatted traceback of a failed job
+        self.error = None
+        self.traceback = None
+        # seconds spent in every stage, filled in as the job moves on
+        self.stage_seconds = {}
+        self.stage_started = time.monotonic()
+
+    def set_status(self, status):
+        now = time.monotonic()
+        self.stage_seconds[self.status] = now - self.stage_started
+        self.status = status
+        self.stage_started = now
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    @property
+    def searchable(self):
+        # whether chunks of this document can be found: it is done, or batches are in the database and the indexes were created
+        # (they might still be building, see MongoDB.index_status)
+        return self.status == 'done' or (self.index_created and self.chunks_written + self.chunks_skipped > 0)
+
+    @property
+    def progress(self):
+        # fraction of the pages read, 1.0 once the job is finished
+        if self.finished:
+            return 1.0
+        return self.pages_done / self.page_count if self.page_count else 0.0
+
+
+class IngestionQueue():
+    def __init__(self, chunker, vector_store, cache=None, max_jobs=2, embed_processes=0, create_indexes=None, index_names=('vector_index',),
+                 max_finished=100):
+        self.chunker = chunker
+        self.vector_store = vector_store
+        # optional cache.EmbeddingCache shared by every job
+        self.cache = cache
+        # create_indexes() is called once the first chunks of a document are in the database, then the job waits for index_names
+        self.create_indexes = create_indexes
+        self.index_names = index_names
+        self.jobs = OrderedDict()
+        # finished jobs kept for get() and list(), the oldest ones are forgotten past max_finished
+        self.max_finished = max_finished
+        self.lock = threading.Lock()
+        # documents ingested at the same time
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs)
+        # worker processes for the forward pass, 0 to embed on the job threads in this process
+        self.embed_executor = None
+        if embed_processes:
+            chunker_settings = {
+                'model_id': chunker.model_id,
+                'max_length': chunker.max_length,
+                'window_overlap': chunker.window_overlap,
+                'long_late_chunking': chunker.long_late_chunking,
+                'pooling': chunker.pooling,
+                'segmenter': chunker.segmenter
+            }
+            n_threads = max(1, (os.cpu_count() or 1) // embed_processes)
+            # spawn rather than fork, forking a process that already has torch threads running can deadlock
+            self.embed_executor = ProcessPoolExecutor(
+                max_workers=embed_processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(chunker_settings, n_threads)
+            )
+
+    def embed_text(self, text, token_inputs=None):
+        return self.embed_executor.submit(_embed_text, text, token_inputs).result()
+
+    def submit(self, path, file_name, pdf_hash=None, tenant=None):
+        # queues the pdf at path (deleted once the job has finished), returns the job id
+        job = IngestionJob(file_name, path, pdf_hash, tenant)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.prune()
+        self.executor.submit(self.run, job)
+        return job.id
+
+    def run(self, job):
+        job.set_status('ingesting')
+        try:
+            pipeline = IngestionPipeline(
+                self.chunker,
+                self.vector_store,
+                cache=self.cache,
+                embed_text=self.embed_text if self.embed_executor is not None else None
+            )
+            with pdf_lock:
+                doc = pymupdf.open(job.path)
+            try:
+                for report in pipeline.run(doc, job.file_name, job.pdf_hash, job.tenant):
+                    job.pages_done = report['pages_done']
+                    job.page_count = report['page_count']
+                    job.chunks_done = report['chunks_done']
+                    job.cached = report['cached']
+                    job.chunks_written += report['result']['upserted'] + report['result']['modified']
+                    job.chunks_skipped += report['result']['skipped']
+                    job.write_seconds += report['result']['seconds']
+                    job.write_errors.extend(report['result']['errors'])
+                    # create the search indexes as soon as the first chunks are in, so they can be searched while the rest is processed
+                    if not job.index_created:
+                        if self.create_indexes is not None:
+                            self.create_indexes()
+                        job.index_created = True
+            finally:
+                with pdf_lock:
+                    doc.close()
+
+            if job.write_errors:
+                raise RuntimeError(f"{len(job.write_errors)} chunks could not be written, first error: {job.write_errors[0]}")
+
+            job.set_status('indexing')
+            for index_name in self.index_names:
+                self.vector_store.wait_for_index(index_name)
+            # the indexes lag behind the writes, results cached while the last batches were being indexed may be missing them
+            self.vector_store.bump_version()
+            job.set_status('done')
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.traceback = traceback.format_exc()
+            job.set_status('failed')
+        finally:
+            os.remove(job.path)
+
+    def prune(self):
+        # forgets the oldest finished jobs past max_finished, called with the lock held
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def active(self):
+        return [job for job in self.list() if not job.finished]
@@ -0,0 +1,65 @@
+import re
+
+import numpy as np
+from scipy import sparse
+
+# Keyword search with BM25, the lexical half of hybrid retrieval for the local vector store
+# (atlas collections use an atlas search index instead, see vectordb.MongoDB.text_search)
+# https://en.wikipedia.org/wiki/Okapi_BM25
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25():
+    def __init__(self, texts, k1=1.2, b=0.75):
+        # k1 controls how quickly repeated terms stop adding to the score, b how much long documents are penalised
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        rows, columns = [], []
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text or '')
+            lengths[row] = len(tokens)
+            for token in tokens:
+                rows.append(row)
+                columns.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+
+        # term frequencies, duplicate (row, column) pairs are summed when converting to csr
+        shape = (len(texts), max(len(self.vocabulary), 1))
+        tf = sparse.coo_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=shape).tocsr()
+        tf.sum_duplicates()
+
+        document_frequency = np.bincount(tf.indices, minlength=shape[1])
+        self.idf = np.log(1 + (len(texts) - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+
+        # the bm25 weight of every (document, term) pair only depends on the document, so it is computed once here
+        # and a query is scored by summing the columns of its terms
+        average_length = max(lengths.mean(), 1.0) if len(texts) else 1.0
+        row_of_entry = np.repeat(np.arange(len(texts)), np.diff(tf.indptr))
+        normalization = self.k1 * (1 - self.b + self.b * lengths[row_of_entry] / average_length)
+        tf.data = self.idf[tf.indices] * tf.data * (self.k1 + 1) / (tf.data + normalization)
+        self.weights = tf.tocsc()
+
+    def scores(self, query):
+        # bm25 score of every document for the query, repeated query terms count once per occurrence
+        columns = [self.vocabulary[token] for token in tokenize(query) if token in self.vocabulary]
+        if not columns:
+            return np.zeros(self.weights.shape[0], dtype=np.float32)
+        return np.asarray(self.weights[:, columns].sum(axis=1)).ravel()
+
+    def top_k(self, query, k, rows=None):
+        # (row, score) of the k best matching documents, documents without any query term are left out
+        # rows optionally restricts the search to some of the documents
+        scores = self.scores(query)
+        matches = np.flatnonzero(scores > 0)
+        if rows is not None:
+            matches = np.intersect1d(matches, rows)
+        if len(matches) > k:
+            matches = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+        matches = matches[np.argsort(-scores[matches])]
+        return [(int(row), float(scores[row])) for row in matches]
@@ -0,0 +1,448 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from cache import bump_collection_version
+from cache import chunk_hash
+from cache import collection_version
+from lexical import BM25
+from quantize import code_count
+from quantize import concat
+from quantize import get_quantizer
+from quantize import kmeans
+from quantize import nearest_centroids
+from quantize import take
+
+# Local in process vector store, a drop in for vectordb.MongoDB (same load_chunks/ create_index/ retrieve interface)
+# embeddings are kept in a contiguous float32 matrix memory mapped from disk, chunk texts and metadata in an append only jsonl file
+# retrieval is an exact brute force top k with numpy, or an approximate IVF index (k-means lists) for large collections
+# optionally the search runs over compressed embeddings (see quantize.py) kept in memory and only the best candidates are
+# re-ranked with the full precision vectors read from disk
+
+
+def similarity_scores(vectors, norms, query, similarity):
+    # scores normalized the same way as atlas vector search, higher is better
+    # https://www.mongodb.com/docs/atlas/atlas-vector-search/vector-search-stage/#atlas-vector-search-score
+    if similarity == 'cosine':
+        cosine = (vectors @ query) / np.maximum(norms * np.linalg.norm(query), 1e-12)
+        return (1 + cosine) / 2
+    if similarity == 'dotProduct':
+        return (1 + vectors @ query) / 2
+    if similarity == 'euclidean':
+        distances = np.sqrt(np.maximum(norms ** 2 - 2 * (vectors @ query) + query @ query, 0))
+        return 1 / (1 + distances)
+    raise ValueError(f"Unknown similarity {similarity}, expected 'cosine', 'dotProduct' or 'euclidean'")
+
+
+def field_value(doc, path):
+    # value at a dotted path such as 'metadata.file', None if it is missing
+    for key in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+class LocalVectorStore():
+    # the ivf lists are retrained once the collection has grown to RETRAIN_GROWTH times the rows they were trained on, so the
+    # number of lists keeps up with ~sqrt of the collection size and a search keeps scoring a small fraction of the rows
+    RETRAIN_GROWTH = 2
+
+    def __init__(self, database_name, collection_name, path=None, embedding_field='embedding', index_type='exact', n_lists=None, n_probe=8,
+                 compression=None, rerank_factor=4):
+        # directory with the data of this collection
+        if path is None:
+            path = os.environ.get("LOCAL_VECTOR_DIR", os.path.join(os.path.expanduser("~"), ".cache", "chatpdf", "vectors"))
+        self.path = os.path.join(path, database_name, collection_name)
+        os.makedirs(self.path, exist_ok=True)
+        self.namespace = (database_name, collection_name)
+        # field of each chunk that holds the embedding, it is stored in the matrix rather than with the rest of the chunk
+        self.embedding_field = embedding_field
+        # 'exact' for brute force search or 'ivf' for the approximate index
+        self.index_type = index_type
+        # number of ivf lists (defaults to ~sqrt of the collection size) and number of lists searched per query
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        # None for full precision search, or 'float16', 'int8' or 'pq' to search compressed embeddings
+        self.compression = compression
+        # number of candidates re-ranked with full precision, as a multiple of the number of results
+        self.rerank_factor = rerank_factor
+        self.lock = threading.RLock()
+        self.open()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def open(self):
+        # read the chunks, map the embedding matrix and load the index definitions
+        self.docs = []
+        self.rows = {}
+        # bm25 index over the chunk texts, built on the first keyword search after a write
+        self.bm25 = None
+        # metadata path -> {value: rows}, built on the first filtered search on that path after a write
+        self.field_index = {}
+        if os.path.exists(self._file('docs.jsonl')):
+            with open(self._file('docs.jsonl'), 'r', encoding='utf-8') as f:
+                for line in f:
+                    row, doc = json.loads(line)
+                    # later lines overwrite earlier ones for the same chunk
+                    if row == len(self.docs):
+                        self.docs.append(doc)
+                    else:
+                        self.docs[row] = doc
+                    self.rows[doc['_id']] = row
+
+        self.indexes = {}
+        self.build_seconds = {}
+        if os.path.exists(self._file('indexes.json')):
+            with open(self._file('indexes.json'), 'r', encoding='utf-8') as f:
+                self.indexes = json.load(f)
+
+        self.matrix = None
+        self.norms = np.zeros(0, dtype=np.float32)
+        if os.path.exists(self._file('meta.json')):
+            with open(self._file('meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            self._map(meta['dimensions'], meta['capacity'])
+            self.norms = np.linalg.norm(self.matrix[:len(self.docs)], axis=1)
+
+        self.ivf = None
+        if os.path.exists(self._file('ivf.npz')):
+            ivf = np.load(self._file('ivf.npz'))
+            self.ivf = {
+                'centroids': ivf['centroids'], 'assignments': ivf['assignments'], 'normalized': bool(ivf['normalized']),
+                # lists saved without their training size were trained on about n_lists ** 2 rows
+                'trained_rows': int(ivf['trained_rows']) if 'trained_rows' in ivf else len(ivf['centroids']) ** 2
+            }
+            self._assign_rows()
+
+        # compressed embeddings are rebuilt from the full precision matrix the first time they are needed
+        self.quantizer = get_quantizer(self.compression)
+        self.codes = None
+        self.codes_normalized = None
+        if self.compression == 'pq' and os.path.exists(self._file('pq.npz')):
+            pq = np.load(self._file('pq.npz'))
+            self.quantizer.codebooks = pq['codebooks']
+            self.codes_normalized = bool(pq['normalized'])
+
+    def _map(self, dimensions, capacity):
+        # memory map the embedding matrix, the file is grown by doubling its capacity
+        mode = 'r+' if os.path.exists(self._file('embeddings.f32')) else 'w+'
+        self.matrix = np.memmap(self._file('embeddings.f32'), dtype=np.float32, mode=mode, shape=(capacity, dimensions))
+        with open(self._file('meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'dimensions': dimensions, 'capacity': capacity}, f)
+
+    def _ensure_capacity(self, n_rows, dimensions):
+        if self.matrix is None:
+            self._map(dimensions, max(1024, n_rows))
+            return
+        if self.matrix.shape[1] != dimensions:
+            raise ValueError(f"Embeddings have {dimensions} dimensions, the collection has {self.matrix.shape[1]}")
+        if n_rows > self.matrix.shape[0]:
+            capacity = max(n_rows, 2 * self.matrix.shape[0])
+            self.matrix.flush()
+            del self.matrix
+            with open(self._file('embeddings.f32'), 'r+b') as f:
+                f.truncate(capacity * dimensions * 4)
+            self._map(dimensions, capacity)
+
+    def health_check(self, max_age=30):
+        # same as MongoDB.health_check, a local store is always reachable
+        return True
+
+    @property
+    def version(self):
+        return collection_version(self.namespace)
+
+    def bump_version(self):
+        bump_collection_version(self.namespace)
+
+    def load_chunks(self, chunks, batch_size=None, max_workers=None):
+        # upsert chunks by _id, same as MongoDB.load_chunks (batch_size and max_workers are accepted for compatibility, writes are in memory)
+        start = time.perf_counter()
+        with self.lock:
+            # skip chunks stored with the same content hash
+            chunks = [dict(chunk, content_hash=chunk_hash(chunk, self.embedding_field)) for chunk in chunks]
+            n_chunks = len(chunks)
+            chunks = [
+                chunk for chunk in chunks
+                if chunk['_id'] not in self.rows or self.docs[self.rows[chunk['_id']]].get('content_hash') != chunk['content_hash']
+            ]
+            new_ids = {chunk['_id'] for chunk in chunks if chunk['_id'] not in self.rows}
+            if not chunks:
+                return {'upserted': 0, 'modified': 0, 'skipped': n_chunks, 'errors': [], 'seconds': time.perf_counter() - start,
+                        'chunks_per_second': 0.0, 'batches': []}
+            dimensions = len(chunks[0][self.embedding_field])
+            self._ensure_capacity(len(self.docs) + len(new_ids), dimensions)
+
+            lines = []
+            changed_rows = []
+            for chunk in chunks:
+                doc = {key: value for key, value in chunk.items() if key != self.embedding_field}
+                row = self.rows.get(chunk['_id'])
+                if row is None:
+                    row = len(self.docs)
+                    self.docs.append(doc)
+                    self.rows[chunk['_id']] = row
+                else:
+                    self.docs[row] = doc
+                    changed_rows.append(row)
+                self.matrix[row] = np.asarray(chunk[self.embedding_field], dtype=np.float32)
+                lines.append(json.dumps([row, doc]) + '\n')
+
+            self.bm25 = None
+            self.field_index = {}
+            self.matrix.flush()
+            with open(self._file('docs.jsonl'), 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+            self.norms = np.linalg.norm(self.matrix[:len(self.docs)], axis=1)
+            if self.ivf is not None:
+                if self._ivf_outgrown():
+                    self._train_ivf(self.ivf['normalized'])
+                else:
+                    self._assign_rows(changed_rows)
+                    np.savez(self._file('ivf.npz'), **self.ivf)
+            if changed_rows:
+                # overwritten embeddings need new codes, they are rebuilt on the next search
+                self.codes = None
+
+        self.bump_version()
+        seconds = time.perf_counter() - start
+        batch = {'size': len(chunks), 'upserted': len(new_ids), 'modified': len(chunks) - len(new_ids), 'errors': [],
+                 'seconds': seconds, 'chunks_per_second': len(chunks) / seconds if seconds > 0 else 0.0}
+        return {'upserted': batch['upserted'], 'modified': batch['modified'], 'skipped': n_chunks - len(chunks), 'errors': [],
+                'seconds': seconds, 'chunks_per_second': batch['chunks_per_second'], 'batches': [batch]}
+
+    def _search_vectors(self, rows, normalized):
+        # full precision vectors of the given rows (a slice or an index array), unit length if the index uses cosine similarity
+        vectors = np.asarray(self.matrix[rows])
+        if normalized:
+            vectors = vectors / np.maximum(self.norms[rows][:, None], 1e-12)
+        return vectors
+
+    def _assign_rows(self, changed_rows=()):
+        # rows added after the ivf index was trained, and rows whose embedding changed, go into the list of their nearest centroid
+        assignments = self.ivf['assignments']
+        if len(assignments) < len(self.docs):
+            new_rows = self._search_vectors(slice(len(assignments), len(self.docs)), self.ivf['normalized'])
+            assignments = np.concatenate([assignments, nearest_centroids(new_rows, self.ivf['centroids'])])
+        if len(changed_rows):
+            changed_rows = np.asarray(changed_rows)
+            assignments[changed_rows] = nearest_centroids(self._search_vectors(changed_rows, self.ivf['normalized']), self.ivf['centroids'])
+        self.ivf['assignments'] = assignments
+
+    def _ivf_outgrown(self):
+        return self.ivf is not None and len(self.docs) >= self.RETRAIN_GROWTH * max(self.ivf['trained_rows'], 1)
+
+    def _train_ivf(self, normalized):
+        # trains the ivf lists on the current rows and assigns every row to its nearest centroid
+        data = self._search_vectors(slice(0, len(self.docs)), normalized)
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(data))))
+        # train on a sample for large collections, then assign every row
+        sample = data[np.random.default_rng(0).permutation(len(data))[:256 * n_lists]]
+        centroids, _ = kmeans(sample, n_lists)
+        self.ivf = {
+            'centroids': centroids, 'assignments': nearest_centroids(data, centroids), 'normalized': normalized, 'trained_rows': len(data)
+        }
+        np.savez(self._file('ivf.npz'), **self.ivf)
+
+    def _ensure_codes(self, normalized, block_size=65536):
+        # compressed embeddings for every row, trained (pq only) and encoded the first time they are needed
+        if self.codes_normalized != normalized:
+            self.codes = None
+            if self.compression == 'pq':
+                self.quantizer.codebooks = None
+        if self.compression == 'pq' and self.quantizer.codebooks is None:
+            sample = np.random.default_rng(0).permutation(len(self.docs))[:256 * self.quantizer.n_centroids]
+            self.quantizer.fit(self._search_vectors(np.sort(sample), normalized))
+            np.savez(self._file('pq.npz'), codebooks=self.quantizer.codebooks, normalized=normalized)
+        self.codes_normalized = normalized
+
+        # encode the rows that don't have codes yet in blocks to bound memory
+        for start in range(code_count(self.codes), len(self.docs), block_size):
+            block = self._search_vectors(slice(start, min(start + block_size, len(self.docs))), normalized)
+            self.codes = concat(self.codes, self.quantizer.encode(block))
+
+    def create_index(self, index_name, dimensions, similarity="cosine", embedding_field='embeddings', filter_fields=None):
+        # stores the index definition, and trains the ivf lists when the approximate index is used
+        # returns 'created', 'updated' or 'unchanged' like MongoDB.create_index, the index is ready as soon as this returns
+        # any metadata path can be filtered on locally, so filter_fields is only accepted for compatibility
+        with self.lock:
+            if embedding_field != self.embedding_field:
+                raise ValueError(f"This store keeps embeddings in '{self.embedding_field}', not '{embedding_field}'")
+            definition = {'dimensions': dimensions, 'similarity': similarity, 'path': embedding_field}
+            # new rows are added to the trained ivf lists by load_chunks, so an unchanged index only needs retraining once the
+            # collection has outgrown the lists (load_chunks retrains then as well)
+            trained = self.index_type != 'ivf' or (self.ivf is not None and not self._ivf_outgrown())
+            if self.indexes.get(index_name) == definition and trained:
+                return 'unchanged'
+            action = 'updated' if index_name in self.indexes else 'created'
+            start = time.perf_counter()
+            self.indexes[index_name] = definition
+            with open(self._file('indexes.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.indexes, f)
+
+            normalized = similarity == 'cosine'
+            if self.index_type == 'ivf' and self.docs:
+                self._train_ivf(normalized)
+
+            # build the compressed embeddings now rather than on the first search
+            if self.quantizer is not None and self.docs:
+                self._ensure_codes(normalized)
+            self.build_seconds[index_name] = time.perf_counter() - start
+            return action
+
+    def index_status(self, index_name):
+        # same as MongoDB.index_status, local indexes are built synchronously by create_index
+        if index_name not in self.indexes:
+            return {'ready': False, 'status': 'DOES_NOT_EXIST', 'build_seconds': None}
+        return {'ready': True, 'status': 'READY', 'build_seconds': self.build_seconds.get(index_name)}
+
+    def wait_for_index(self, index_name, timeout=300, poll_interval=2):
+        return self.index_status(index_name)
+
+    def create_text_index(self, index_name, text_field='text', filter_fields=None):
+        # same as MongoDB.create_text_index, the bm25 index itself is built lazily by text_search
+        # any metadata path can be filtered on locally, so filter_fields is only accepted for compatibility
+        with self.lock:
+            definition = {'type': 'search', 'path': text_field}
+            if self.indexes.get(index_name) == definition:
+                return 'unchanged'
+            action = 'updated' if index_name in self.indexes else 'created'
+            self.indexes[index_name] = definition
+            with open(self._file('indexes.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.indexes, f)
+            return action
+
+    def filter_rows(self, filter):
+        # rows matching a filter in the same form as MongoDB.retrieve: {path: value} or {path: {'$in': [values]}}, every path has to match
+        rows = None
+        for path, condition in filter.items():
+            if path not in self.field_index:
+                values = {}
+                for row, doc in enumerate(self.docs):
+                    value = field_value(doc, path)
+                    values.setdefault(value, []).append(row)
+                self.field_index[path] = {value: np.asarray(path_rows) for value, path_rows in values.items()}
+            if isinstance(condition, dict) and '$in' in condition:
+                matches = [self.field_index[path].get(value, []) for value in condition['$in']]
+                path_rows = np.unique(np.concatenate(matches)).astype(np.int64) if matches else np.zeros(0, dtype=np.int64)
+            else:
+                value = condition['$eq'] if isinstance(condition, dict) else condition
+                path_rows = np.asarray(self.field_index[path].get(value, []), dtype=np.int64)
+            rows = path_rows if rows is None else np.intersect1d(rows, path_rows)
+        return rows if rows is not None else np.arange(len(self.docs))
+
+    def text_search(self, index_name, query_text, text_field='text', limit=5, filter=None):
+        # same results as MongoDB.text_search: the text, metadata and bm25 score of the best keyword matches
+        with self.lock:
+            if index_name not in self.indexes:
+                raise ValueError(f"Index {index_name} does not exist, call create_text_index first")
+            text_field = self.indexes[index_name]['path']
+            if self.bm25 is None:
+                self.bm25 = BM25([doc.get(text_field) for doc in self.docs])
+            rows = self.filter_rows(filter) if filter else None
+            return [
+                {'text': self.docs[row].get('text'), 'metadata': self.docs[row].get('metadata'), 'score': score}
+                for row, score in self.bm25.top_k(query_text, limit, rows=rows)
+            ]
+
+    def candidate_rows(self, query, similarity):
+        # rows to score for a query, every row for exact search or the rows in the n_probe nearest ivf lists
+        if self.index_type != 'ivf' or self.ivf is None:
+            return np.arange(len(self.docs))
+        if similarity == 'cosine':
+            query = query / max(np.linalg.norm(query), 1e-12)
+        lists = nearest_centroids(query[None, :], self.ivf['centroids'], n=min(self.n_probe, len(self.ivf['centroids'])))[0]
+        return np.flatnonzero(np.isin(self.ivf['assignments'], lists))
+
+    def retrieve(self, index_name, query_embedding, embedding_field='embedding', num_neighbors=100, limit=5, filter=None):
+        # same results as MongoDB.retrieve: the text, metadata and similarity score of the most similar chunks
+        # filter restricts the search to matching chunks before scoring, see filter_rows
+        with self.lock:
+            if index_name not in self.indexes:
+                raise ValueError(f"Index {index_name} does not exist, call create_index first")
+            if not self.docs:
+                return []
+            similarity = self.indexes[index_name]['similarity']
+            query = np.asarray(query_embedding, dtype=np.float32)
+
+            if filter:
+                rows = self.filter_rows(filter)
+                # a selective filter is searched exactly, a broad one only within the ivf lists nearest to the query
+                if len(rows) > 10 * max(num_neighbors, limit):
+                    rows = np.intersect1d(rows, self.candidate_rows(query, similarity))
+                if len(rows) == 0:
+                    return []
+            else:
+                rows = self.candidate_rows(query, similarity)
+
+            # pick the best candidates using the compressed embeddings, only those are read from disk and scored exactly
+            n_rerank = limit * self.rerank_factor
+            if self.quantizer is not None and len(rows) > n_rerank:
+                normalized = similarity == 'cosine'
+                self._ensure_codes(normalized)
+                codes = self.codes if len(rows) == len(self.docs) else take(self.codes, rows)
+                search_query = query / max(np.linalg.norm(query), 1e-12) if normalized else query
+                approximate = self.quantizer.scores(codes, search_query)
+                if similarity == 'euclidean':
+                    # -|x - q|^2 up to a constant, so higher is still better
+                    approximate = 2 * approximate - self.norms[rows] ** 2
+                # sorted rows read the memory mapped file in order
+                rows = np.sort(rows[np.argpartition(-approximate, n_rerank - 1)[:n_rerank]])
+
+            if len(rows) == len(self.docs):
+                vectors, norms = self.matrix[:len(self.docs)], self.norms
+            else:
+                vectors, norms = self.matrix[rows], self.norms[rows]
+            scores = similarity_scores(vectors, norms, query, similarity)
+
+            # top k without sorting every score
+            k = min(limit, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                {'text': self.docs[rows[i]].get('text'), 'metadata': self.docs[rows[i]].get('metadata'), 'score': float(scores[i])}
+                for i in top
+            ]
+
+    def delete_many(self, filter):
+        # delete the chunks matching a filter (same form as retrieve), returns how many were deleted
+        # the remaining rows are compacted to the front of the matrix and the chunk file is rewritten without the deleted ones
+        with self.lock:
+            deleted = self.filter_rows(filter) if filter else np.arange(len(self.docs))
+            if len(deleted) == 0:
+                return 0
+            keep = np.setdiff1d(np.arange(len(self.docs)), deleted)
+            self.docs = [self.docs[row] for row in keep]
+            self.rows = {doc['_id']: row for row, doc in enumerate(self.docs)}
+            if len(keep):
+                self.matrix[:len(keep)] = self.matrix[keep]
+                self.matrix.flush()
+            self.norms = self.norms[keep]
+            with open(self._file('docs.jsonl.tmp'), 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps([row, doc]) + '\n' for row, doc in enumerate(self.docs))
+            os.replace(self._file('docs.jsonl.tmp'), self._file('docs.jsonl'))
+            if self.ivf is not None:
+                self.ivf['assignments'] = self.ivf['assignments'][keep]
+                np.savez(self._file('ivf.npz'), **self.ivf)
+            if self.codes is not None:
+                # codes cover a prefix of the rows (see _ensure_codes), so the kept rows that have codes are still a prefix
+                self.codes = take(self.codes, keep[keep < code_count(self.codes)])
+            self.bm25 = None
+            self.field_index = {}
+        self.bump_version()
+        return len(deleted)
+
+    def drop(self):
+        # delete the whole collection
+        with self.lock:
+            if self.matrix is not None:
+                del self.matrix
+            for name in ['docs.jsonl', 'embeddings.f32', 'meta.json', 'indexes.json', 'ivf.npz', 'pq.npz']:
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+            self.open()
+        self.bump_version()
@@ -0,0 +1,142 @@
+import numpy as np
+
+# Compressed embedding formats for search
+# every quantizer turns float32 vectors into compact codes and scores a query against the codes with an approximate dot product
+# the approximate scores are only used to pick candidates, which are then re-ranked with the full precision vectors
+
+
+def kmeans(data, n_clusters, n_iter=20, seed=0):
+    # plain Lloyd's k-means, returns (centroids, assignments)
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(data))
+    centroids = data[rng.choice(len(data), size=n_clusters, replace=False)].astype(np.float32)
+    assignments = np.zeros(len(data), dtype=np.int64)
+    for _ in range(n_iter):
+        assignments = nearest_centroids(data, centroids)
+        # mean of the members of every cluster, one bincount per dimension instead of a loop over clusters
+        counts = np.bincount(assignments, minlength=n_clusters)
+        sums = np.stack([np.bincount(assignments, weights=data[:, d], minlength=n_clusters) for d in range(data.shape[1])], axis=1)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # empty clusters are moved to random points
+        centroids[empty] = data[rng.integers(len(data), size=int(empty.sum()))]
+    return centroids, assignments
+
+
+def nearest_centroids(data, centroids, n=1):
+    # index of the n nearest centroids (euclidean) of every row, shape (len(data),) for n=1 or (len(data), n)
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, |x|^2 is the same for every centroid so it can be left out
+    distances = -2 * data @ centroids.T + (centroids ** 2).sum(axis=1)
+    if n == 1:
+        return distances.argmin(axis=1)
+    return np.argsort(distances, axis=1)[:, :n]
+
+
+class Float16Quantizer():
+    # half precision, 2 bytes per dimension
+    def fit(self, data):
+        return self
+
+    def encode(self, data):
+        return np.asarray(data, dtype=np.float16)
+
+    def scores(self, codes, query):
+        return codes.astype(np.float32) @ query
+
+    def bytes_per_vector(self, dimensions):
+        return 2 * dimensions
+
+
+class Int8Quantizer():
+    # symmetric scalar quantization, every vector is scaled so its largest value maps to 127
+    # 1 byte per dimension plus one float32 scale per vector
+    def fit(self, data):
+        return self
+
+    def encode(self, data):
+        data = np.asarray(data, dtype=np.float32)
+        scales = np.maximum(np.abs(data).max(axis=1), 1e-12) / 127
+        codes = np.round(data / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def scores(self, codes, query):
+        codes, scales = codes
+        return (codes.astype(np.float32) @ query) * scales
+
+    def bytes_per_vector(self, dimensions):
+        return dimensions + 4
+
+
+class ProductQuantizer():
+    # product quantization: the vector is split into n_subvectors pieces and each piece is replaced by the index of its nearest
+    # centroid in a codebook of n_centroids (at most 256 so every code fits in one byte)
+    # https://ieeexplore.ieee.org/document/5432202
+    def __init__(self, n_subvectors=96, n_centroids=256, n_iter=20, codebooks=None):
+        self.n_subvectors = n_subvectors
+        self.n_centroids = n_centroids
+        self.n_iter = n_iter
+        self.codebooks = codebooks
+
+    def _split(self, data):
+        dimensions = data.shape[1]
+        if dimensions % self.n_subvectors != 0:
+            raise ValueError(f"{dimensions} dimensions can't be split into {self.n_subvectors} subvectors")
+        return data.reshape(len(data), self.n_subvectors, dimensions // self.n_subvectors)
+
+    def fit(self, data):
+        # one k-means codebook per subvector
+        pieces = self._split(np.asarray(data, dtype=np.float32))
+        self.codebooks = np.stack([
+            kmeans(np.ascontiguousarray(pieces[:, j]), self.n_centroids, n_iter=self.n_iter, seed=j)[0]
+            for j in range(self.n_subvectors)
+        ])
+        return self
+
+    def encode(self, data):
+        pieces = self._split(np.asarray(data, dtype=np.float32))
+        codes = np.empty((len(pieces), self.n_subvectors), dtype=np.uint8)
+        for j, codebook in enumerate(self.codebooks):
+            # nearest centroid of every piece, |x - c|^2 without the |x|^2 term
+            distances = -2 * pieces[:, j] @ codebook.T + (codebook ** 2).sum(axis=1)
+            codes[:, j] = distances.argmin(axis=1)
+        return codes
+
+    def scores(self, codes, query):
+        # asymmetric distance computation: dot product of each query piece with every centroid, then a table lookup per code
+        query_pieces = query.reshape(self.n_subvectors, -1)
+        tables = np.einsum('jd,jkd->jk', query_pieces, self.codebooks)
+        return tables[np.arange(self.n_subvectors), codes].sum(axis=1)
+
+    def bytes_per_vector(self, dimensions):
+        return self.n_subvectors
+
+
+def get_quantizer(compression, **kwargs):
+    # 'float16', 'int8' or 'pq', None for no compression
+    if compression is None:
+        return None
+    quantizers = {'float16': Float16Quantizer, 'int8': Int8Quantizer, 'pq': ProductQuantizer}
+    if compression not in quantizers:
+        raise ValueError(f"Unknown compression {compression}, expected one of {list(quantizers)}")
+    return quantizers[compression](**kwargs)
+
+
+def take(codes, rows):
+    # selects rows from codes, int8 codes are a (codes, scales) pair
+    if isinstance(codes, tuple):
+        return tuple(part[rows] for part in codes)
+    return codes[rows]
+
+
+def concat(codes, new_codes):
+    if codes is None:
+        return new_codes
+    if isinstance(codes, tuple):
+        return tuple(np.concatenate([a, b]) for a, b in zip(codes, new_codes))
+    return np.concatenate([codes, new_codes])
+
+
+def code_count(codes):
+    if codes is None:
+        return 0
+    return len(codes[0]) if isinstance(codes, tuple) else len(codes)
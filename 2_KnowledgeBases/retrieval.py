@@ -0,0 +1,155 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Retrieval stages for the chat app: search (vector or hybrid) -> cross-encoder re-ranking -> selection under a token budget
+# hybrid retrieval runs a keyword search and a vector search in parallel and merges their rankings with
+# reciprocal rank fusion, chunks found by both searches (exact terms and similar meaning) end up at the top
+# https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf
+
+# threads shared by every retriever in the process, each query runs its searches on two of them
+_executor = ThreadPoolExecutor(max_workers=8)
+
+
+def reciprocal_rank_fusion(rankings, k=60, weights=None):
+    # rankings is a list of result lists (best first), every result is scored sum(weight / (k + rank)) over the lists it appears in
+    # results are matched by their text, the returned results keep the fields of their first occurrence plus the fused 'score'
+    weights = weights if weights is not None else [1.0] * len(rankings)
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, result in enumerate(ranking, start=1):
+            if result['text'] not in fused:
+                fused[result['text']] = dict(result, score=0.0)
+            fused[result['text']]['score'] += weight / (k + rank)
+    return sorted(fused.values(), key=lambda result: result['score'], reverse=True)
+
+
+class HybridRetriever():
+    def __init__(self, vector_store, vector_index='vector_index', text_index='text_index', num_candidates=100, vector_limit=20, text_limit=20,
+                 rrf_k=60, weights=(1.0, 1.0)):
+        # vector_store is a vectordb.MongoDB or localdb.LocalVectorStore with both indexes created
+        self.vector_store = vector_store
+        self.vector_index = vector_index
+        self.text_index = text_index
+        # candidates considered by the approximate vector search, and number of results taken from each search before fusion
+        self.num_candidates = num_candidates
+        self.vector_limit = vector_limit
+        self.text_limit = text_limit
+        # rrf constant, larger values flatten the difference between the top ranks
+        self.rrf_k = rrf_k
+        # (vector, keyword) weights in the fusion
+        self.weights = weights
+
+    def vector_search(self, query_embedding, filter=None):
+        start = time.perf_counter()
+        results = list(self.vector_store.retrieve(
+            index_name=self.vector_index,
+            query_embedding=query_embedding,
+            embedding_field='embedding',
+            num_neighbors=max(self.num_candidates, self.vector_limit),
+            limit=self.vector_limit,
+            filter=filter
+        ))
+        return results, time.perf_counter() - start
+
+    def text_search(self, query_text, filter=None):
+        start = time.perf_counter()
+        results = list(self.vector_store.text_search(self.text_index, query_text, limit=self.text_limit, filter=filter))
+        return results, time.perf_counter() - start
+
+    def retrieve(self, query_text, query_embedding, limit=3, filter=None):
+        # returns (results, stats), the limit best fused results and the latency and result count of each search
+        # filter (see vectordb.MongoDB.retrieve) restricts both searches to the matching chunks
+        vector_future = _executor.submit(self.vector_search, query_embedding, filter)
+        text_future = _executor.submit(self.text_search, query_text, filter)
+        vector_results, vector_seconds = vector_future.result()
+        text_results, text_seconds = text_future.result()
+        results = reciprocal_rank_fusion([vector_results, text_results], k=self.rrf_k, weights=self.weights)[:limit]
+        stats = {
+            "vector_results": len(vector_results),
+            "vector_seconds": vector_seconds,
+            "text_results": len(text_results),
+            "text_seconds": text_seconds
+        }
+        return results, stats
+
+
+class Reranker():
+    def __init__(self, model, batch_size=32):
+        # model is a sentence_transformers CrossEncoder (see embedmodels.registry.cross_encoder)
+        self.model = model
+        self.batch_size = batch_size
+
+    def rerank(self, query_text, results):
+        # scores every (query, chunk) pair together and returns the results sorted by 'rerank_score', best first
+        if not results:
+            return []
+        scores = self.model.predict([(query_text, result['text']) for result in results], batch_size=self.batch_size)
+        reranked = [dict(result, rerank_score=float(score)) for result, score in zip(results, scores)]
+        return sorted(reranked, key=lambda result: result['rerank_score'], reverse=True)
+
+
+def select_within_budget(results, count_tokens, token_budget, max_chunks=None):
+    # takes results in order until the next one would go over token_budget, so short chunks leave room for more of them
+    # the first result is always kept, even if it is over budget on its own
+    selected = []
+    used = 0
+    for result in results:
+        if max_chunks is not None and len(selected) >= max_chunks:
+            break
+        tokens = count_tokens(result['text'])
+        if selected and used + tokens > token_budget:
+            break
+        selected.append(result)
+        used += tokens
+    return selected, used
+
+
+class RetrievalPipeline():
+    def __init__(self, vector_store, count_tokens, hybrid_retriever=None, reranker=None, over_fetch=20, token_budget=1500, max_chunks=8,
+                 num_candidates=100):
+        # vector_store is searched directly unless a HybridRetriever is given
+        self.vector_store = vector_store
+        self.hybrid_retriever = hybrid_retriever
+        # optional Reranker, without it the search order is kept
+        self.reranker = reranker
+        # count_tokens(text) -> number of tokens, used to fill the token budget
+        self.count_tokens = count_tokens
+        # number of candidates fetched for re-ranking, more candidates improve recall but make re-ranking slower
+        self.over_fetch = over_fetch
+        # prompt tokens that can be spent on retrieved chunks, and an upper bound on the number of chunks
+        # with token_budget=None every re-ranked candidate is returned, for callers that pack the prompt themselves (context.ContextAssembler)
+        self.token_budget = token_budget
+        self.max_chunks = max_chunks
+        self.num_candidates = num_candidates
+
+    def retrieve(self, query_text, query_embedding, filter=None):
+        # returns (chunks, stats), stats has the latency of every stage in seconds and the number of chunks/ tokens selected
+        # filter restricts the search to matching chunks (e.g. one tenant's documents), see vectordb.MongoDB.retrieve
+        stats = {}
+        start = time.perf_counter()
+        if self.hybrid_retriever is not None:
+            candidates, _ = self.hybrid_retriever.retrieve(query_text, query_embedding, limit=self.over_fetch, filter=filter)
+        else:
+            candidates = list(self.vector_store.retrieve(
+                index_name='vector_index',
+                query_embedding=query_embedding,
+                embedding_field='embedding',
+                num_neighbors=max(self.num_candidates, self.over_fetch),
+                limit=self.over_fetch,
+                filter=filter
+            ))
+        stats['search_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if self.reranker is not None:
+            candidates = self.reranker.rerank(query_text, candidates)
+        stats['rerank_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if self.token_budget is None:
+            chunks, tokens = candidates[:self.max_chunks], None
+        else:
+            chunks, tokens = select_within_budget(candidates, self.count_tokens, self.token_budget, self.max_chunks)
+        stats['select_seconds'] = time.perf_counter() - start
+        stats.update(candidates=len(candidates), chunks=len(chunks), context_tokens=tokens)
+        return chunks, stats
@@ -0,0 +1,122 @@
+import os
+# binary search over token offsets
+from bisect import bisect_left
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Segmenters split a document into chunks for late chunking
+# every segmenter has a segment(text, token_inputs) method that takes the text and its tokenized inputs (with the offset mapping) and returns
+# the chunk texts along with the token span (start, end) of each chunk, end exclusive, indexing the model output directly
+
+
+def align_chunks_to_tokens(chunk_positions, token_offsets):
+    # maps character level chunk positions [(start_char, end_char), ...] to token spans [(start_token, end_token), ...] (end exclusive)
+    # token_offsets is the offset mapping returned by the tokenizer, special tokens like [CLS] and [SEP] have the offset (0, 0)
+    # the returned spans index the tokens in token_offsets directly, so they can be used on the model output as is
+    # content tokens are the ones with a non empty offset, they sit between the special tokens
+    content = [i for i, (start, end) in enumerate(token_offsets) if end > start]
+    if not content:
+        return []
+    first, last = content[0], content[-1]
+    # character position where each content token starts, sorted since tokens come in order
+    token_starts = [start for start, _ in token_offsets[first:last+1]]
+
+    span_annotations = []
+    start = first
+    for _, chunk_end in chunk_positions:
+        # the last token of the chunk is the last token that starts before the end of the chunk
+        # chunk ends are increasing, so the search only looks at the tokens after the previous chunk
+        index = first + bisect_left(token_starts, chunk_end, lo=start-first) - 1
+        # chunks that end past the last token end on the last token
+        index = min(index, last)
+        span_annotations.append((start, index+1))
+        start = index+1
+    return span_annotations
+
+
+class LocalSegmenter():
+    def __init__(self, max_chunk_tokens=256, min_chunk_tokens=32):
+        # a chunk never has more tokens than this, long sentences are split
+        self.max_chunk_tokens = max_chunk_tokens
+        # paragraph breaks only end a chunk once it has at least this many tokens
+        self.min_chunk_tokens = min_chunk_tokens
+
+    def segment(self, text, token_inputs):
+        # splits on sentence and paragraph boundaries directly in token space, no network calls and no character to token remapping
+        token_offsets = token_inputs['offset_mapping'][0].tolist()
+        content = [i for i, (start, end) in enumerate(token_offsets) if end > start]
+        if not content:
+            return [], []
+        first, last = content[0], content[-1]
+
+        span_annotations = []
+        chunk_start = first
+        # last sentence end inside the current chunk, used as the cut point when the chunk runs over the token budget
+        last_sentence_end = None
+        for i in range(first, last+1):
+            # adding this token would go over the budget, end the chunk at the last sentence end (or right before this token)
+            if i - chunk_start + 1 > self.max_chunk_tokens:
+                cut = last_sentence_end if last_sentence_end is not None else i-1
+                span_annotations.append((chunk_start, cut+1))
+                chunk_start = cut+1
+                last_sentence_end = None
+
+            # a sentence ends on . ? or ! followed by whitespace, a paragraph when that whitespace has a line break
+            end = token_offsets[i][1]
+            if text[end-1] in '.?!' and (end == len(text) or text[end].isspace()):
+                next_start = token_offsets[i+1][0] if i < last else len(text)
+                if '\n' in text[end:next_start] and i - chunk_start + 1 >= self.min_chunk_tokens:
+                    span_annotations.append((chunk_start, i+1))
+                    chunk_start = i+1
+                    last_sentence_end = None
+                else:
+                    last_sentence_end = i
+
+        # whatever is left after the last boundary forms the final chunk
+        if chunk_start <= last:
+            span_annotations.append((chunk_start, last+1))
+
+        chunks = [text[token_offsets[start][0]:token_offsets[end-1][1]] for start, end in span_annotations]
+        return chunks, span_annotations
+
+
+class JinaSegmenter():
+    def __init__(self, max_chunk_length=1000, timeout=(5, 60), max_retries=3, backoff_factor=1.0):
+        # remote segmenter api from jina ai: https://jina.ai/segmenter/
+        self.url = 'https://segment.jina.ai/'
+        self.max_chunk_length = max_chunk_length
+        # (connect, read) timeout in seconds
+        self.timeout = timeout
+        # retry connection errors, rate limits and server errors with exponential backoff
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['POST']
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(max_retries=retry))
+
+    def segment(self, text, token_inputs):
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f"Bearer {os.environ.get('JINA', None)}"
+        }
+        data = {
+            "content": text,
+            "return_tokens": True,
+            "return_chunks": True,
+            "max_chunk_length": self.max_chunk_length
+        }
+        response = self.session.post(self.url, headers=headers, json=data, timeout=self.timeout)
+        response.raise_for_status()
+        response_data = response.json()
+        chunks = response_data.get('chunks', [])
+        chunk_positions = [(start, end) for start, end in response_data.get('chunk_positions', [])]
+
+        # Unfortunately, chunk positions are based on character count rather than token count. We need the chunk positions with respect to tokens
+        token_offsets = token_inputs['offset_mapping'][0].tolist()
+        span_annotations = align_chunks_to_tokens(chunk_positions, token_offsets)
+        return chunks, span_annotations
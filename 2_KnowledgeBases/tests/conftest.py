@@ -0,0 +1,35 @@
+import os
+import re
+import sys
+
+import pytest
+import torch
+
+# the modules under test import each other by name, like the apps do when run from 2_KnowledgeBases
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class WordTokenizer():
+    # stand in for a hf tokenizer with one token per word, the id of a word is its length
+    # [CLS] and [SEP] are added unless add_special_tokens=False and get the offset (0, 0), return_tensors='pt' returns batched tensors
+    cls_token_id = 101
+    sep_token_id = 102
+
+    def __call__(self, text, add_special_tokens=True, return_offsets_mapping=False, return_tensors=None):
+        words = list(re.finditer(r"\S+", text))
+        input_ids = [len(word.group()) for word in words]
+        offsets = [word.span() for word in words]
+        if add_special_tokens:
+            input_ids = [self.cls_token_id] + input_ids + [self.sep_token_id]
+            offsets = [(0, 0)] + offsets + [(0, 0)]
+        inputs = {'input_ids': input_ids, 'attention_mask': [1] * len(input_ids)}
+        if return_offsets_mapping:
+            inputs['offset_mapping'] = offsets
+        if return_tensors == 'pt':
+            inputs = {name: torch.tensor([values], dtype=torch.long) for name, values in inputs.items()}
+        return inputs
+
+
+@pytest.fixture
+def word_tokenizer():
+    return WordTokenizer()
@@ -0,0 +1,53 @@
+import os
+import time
+
+import numpy as np
+
+from cache import EmbeddingCache
+from cache import LRUCache
+from cache import content_hash
+
+
+def test_content_hash_separates_parts():
+    assert content_hash('ab', 'c') != content_hash('a', 'bc')
+    assert content_hash('a', b'b') == content_hash(b'a', 'b')
+
+
+def test_embedding_cache_round_trip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    embeddings = np.arange(6, dtype=np.float32).reshape(2, 3)
+    cache.put('key', {'chunks': ['a', 'b']}, embeddings)
+    data, cached = cache.get('key')
+    assert data['chunks'] == ['a', 'b']
+    np.testing.assert_array_equal(cached, embeddings)
+    assert cache.get('missing') is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_embedding_cache_evicts_least_recently_used(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), max_bytes=2500)
+    for i in range(3):
+        cache.put(str(i), {'i': i}, np.zeros((4, 32), dtype=np.float32))
+        # mtimes are the recency, keep them apart
+        os.utime(os.path.join(str(tmp_path), f"{i}.json"), (time.time() - 100 + i, time.time() - 100 + i))
+        os.utime(os.path.join(str(tmp_path), f"{i}.npy"), (time.time() - 100 + i, time.time() - 100 + i))
+    cache.get('0')
+    cache.put('3', {'i': 3}, np.zeros((4, 32), dtype=np.float32))
+    assert cache.contains('0') and cache.contains('3')
+    assert not cache.contains('1')
+    assert cache.total_bytes <= 2500
+
+
+def test_lru_cache_size_and_ttl():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+    expiring = LRUCache(ttl=0.0)
+    expiring.put('a', 1)
+    time.sleep(0.01)
+    assert expiring.get('a') is None
@@ -0,0 +1,22 @@
+import chatpdf
+
+
+def test_load_resources_builds_the_resources_once_per_process(monkeypatch):
+    built = []
+    warmed = []
+
+    class FakeResources():
+        def __init__(self):
+            built.append(self)
+
+    monkeypatch.setattr(chatpdf, "Resources", FakeResources)
+    monkeypatch.setattr(chatpdf.registry, "warm_up", lambda: warmed.append(True))
+    chatpdf.load_resources.clear()
+    try:
+        first = chatpdf.load_resources()
+        # later reruns and other sessions get the same object back
+        assert chatpdf.load_resources() is first
+        assert built == [first] and warmed == [True]
+        assert first.load_seconds is not None
+    finally:
+        chatpdf.load_resources.clear()
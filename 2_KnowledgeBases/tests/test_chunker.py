@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+import torch
+
+from chunker import LateChunker
+from chunker import SemanticChunker
+from chunker import merge_empty_spans
+from chunker import pool_spans
+from segmenter import align_chunks_to_tokens
+
+
+class IdModel():
+    # the embedding of every token is its id, so a mean pooled span is the mean of its ids
+    def __call__(self, input_ids, attention_mask=None):
+        return (input_ids.unsqueeze(-1).float(),)
+
+
+class FixedSegmenter():
+    def __init__(self, chunk_positions):
+        self.chunk_positions = chunk_positions
+
+    def segment(self, text, token_inputs):
+        spans = align_chunks_to_tokens(self.chunk_positions, token_inputs['offset_mapping'][0].tolist())
+        return [text[start:end] for start, end in self.chunk_positions], spans
+
+
+def late_chunker(segmenter, tokenizer=None, max_length=8192, window_overlap=0, pooling='mean'):
+    chunker = LateChunker.__new__(LateChunker)
+    chunker.tokenizer = tokenizer
+    chunker.model = IdModel()
+    chunker.max_length = max_length
+    chunker.window_overlap = window_overlap
+    chunker.long_late_chunking = True
+    chunker.pooling = pooling
+    chunker.segmenter = segmenter
+    return chunker
+
+
+def test_pool_spans_mean_max_cls():
+    embeddings = torch.arange(12, dtype=torch.float32).reshape(6, 2)
+    spans = [(0, 2), (2, 5), (5, 6)]
+    np.testing.assert_allclose(pool_spans(embeddings, spans), [[1, 2], [6, 7], [10, 11]])
+    np.testing.assert_allclose(pool_spans(embeddings, spans, 'sum'), [[2, 4], [18, 21], [10, 11]])
+    np.testing.assert_allclose(pool_spans(embeddings, spans, 'max'), [[2, 3], [8, 9], [10, 11]])
+    np.testing.assert_allclose(pool_spans(embeddings, spans, 'cls'), [[0, 1], [4, 5], [10, 11]])
+
+
+@pytest.mark.parametrize("spans", [[(1, 3), (5, 6), (6, 9)], [(4, 8), (0, 5), (2, 3)]])
+@pytest.mark.parametrize("pooling", ['mean', 'sum', 'max'])
+def test_pool_spans_with_gaps_and_overlaps(spans, pooling):
+    # spans in order with gaps between them are reduced in place, any others are gathered first, both give the per span result
+    embeddings = torch.randn(10, 4)
+    reduce = {'mean': lambda x: x.mean(0), 'sum': lambda x: x.sum(0), 'max': lambda x: x.max(0).values}[pooling]
+    expected = torch.stack([reduce(embeddings[start:end]) for start, end in spans])
+    np.testing.assert_allclose(pool_spans(embeddings, spans, pooling), expected, rtol=1e-5, atol=1e-6)
+
+
+def test_pool_spans_skips_empty_spans():
+    embeddings = torch.ones(4, 3)
+    assert pool_spans(embeddings, [(0, 2), (2, 2), (2, 4)]).shape == (2, 3)
+    assert pool_spans(embeddings, []).shape == (0, 3)
+
+
+def test_late_chunking_returns_one_embedding_per_span_within_max_length():
+    # (batch, n_tokens, hidden_size) model output, spans past max_length are dropped and the one crossing it is cut short
+    model_output = (torch.randn(2, 16, 5),)
+    chunker = late_chunker(None)
+    outputs = chunker.late_chunking(model_output, [[(1, 4), (4, 9), (9, 15)], [(1, 2)]], max_length=8)
+    assert [output.shape for output in outputs] == [(2, 5), (1, 5)]
+    assert all(output.dtype == np.float32 and output.flags['C_CONTIGUOUS'] for output in outputs)
+    np.testing.assert_allclose(outputs[0][1], model_output[0][0, 4:7].mean(0), rtol=1e-5)
+
+
+def test_embed_text_keeps_embeddings_with_their_chunks(word_tokenizer):
+    # the second chunk ends inside the first word, so it has no token of its own and is merged into the first chunk
+    # the ids of the word tokenizer are the word lengths: 2, 1, 3, 4
+    text = "xx y zzz wwww"
+    chunker = late_chunker(FixedSegmenter([(0, 1), (1, 2), (2, 8), (8, 13)]), word_tokenizer)
+    chunks, embeddings, starts = chunker.embed_text(text)
+    assert chunks == ["xx", " y zzz", " wwww"]
+    assert starts == [0, 3, 9]
+    np.testing.assert_allclose(embeddings[:, 0], [2.0, 2.0, 4.0])
+
+
+def test_merge_empty_spans():
+    # a leading empty chunk goes into the next chunk, any other into the previous one
+    chunks, spans = merge_empty_spans(['a', 'b', 'c', 'd'], [(1, 1), (1, 3), (3, 3), (3, 4)])
+    assert chunks == ['abc', 'd']
+    assert spans == [(1, 3), (3, 4)]
+
+
+@pytest.mark.parametrize("pooling", ['mean', 'max', 'cls'])
+def test_late_chunking_windows_matches_single_pass(pooling):
+    # with the id model every window sees the same embeddings, so pooling window by window must give the single pass result
+    input_ids = torch.arange(40)
+    spans = [(0, 3), (3, 3), (3, 17), (17, 18), (18, 40)]
+    chunker = late_chunker(None, max_length=12, window_overlap=4, pooling=pooling)
+    expected = pool_spans(input_ids.unsqueeze(-1).float(), spans, pooling)
+    np.testing.assert_allclose(chunker.late_chunking_windows(input_ids, spans), expected, rtol=1e-6)
+
+
+class FakeTextPage():
+    def __init__(self, text):
+        self.text = text
+
+    def extractTEXT(self):
+        return self.text
+
+
+class FakePage():
+    def __init__(self, number, text):
+        self.number = number
+        self.text = text
+
+    def get_textpage(self):
+        return FakeTextPage(self.text)
+
+
+def test_semantic_chunker_splits_where_the_topic_changes(monkeypatch):
+    # sentences about cats, then dogs, then fish: the embeddings only change direction at the topic changes
+    doc = [FakePage(0, "Cats purr. Cats nap. Cats climb. Dogs bark."), FakePage(1, "Dogs fetch. Dogs dig. Fish swim. Fish glide.")]
+    topics = {'Cats': [1.0, 0.0, 0.0], 'Dogs': [0.0, 1.0, 0.0], 'Fish': [0.0, 0.0, 1.0]}
+    chunker = SemanticChunker(bufferSize=0, breakpointPercentile=50)
+    monkeypatch.setattr(chunker, "generateEmbeddingsTitan", lambda sentences: np.array([topics[s['text'].split()[0]] for s in sentences]))
+    chunks = chunker.chunk(doc, "animals.pdf")
+    assert [chunk['text'] for chunk in chunks] == [
+        "Cats purr. Cats nap. Cats climb.", "Dogs bark. Dogs fetch. Dogs dig.", "Fish swim. Fish glide."
+    ]
+    # a chunk is on the page its first sentence is on
+    assert [(chunk['_id'], chunk['metadata']['page']) for chunk in chunks] == [("animals:0:0", 1), ("animals:1:0", 1), ("animals:2:1", 2)]
+
+
+def test_semantic_chunker_breakpoints_match_the_percentile():
+    chunker = SemanticChunker(breakpointPercentile=75)
+    distances = chunker.calculate_distances(np.array([[1.0, 0.0], [1.0, 0.1], [0.0, 1.0], [0.0, 1.0], [-1.0, 0.0]]))
+    np.testing.assert_allclose(distances, [1 - 1 / np.sqrt(1.01), 1 - 0.1 / np.sqrt(1.01), 0.0, 1.0], atol=1e-6)
+    assert chunker.find_breakpoints(distances).tolist() == [3]
+    assert chunker.find_breakpoints(np.zeros(0)).tolist() == []
@@ -0,0 +1,63 @@
+from context import ContextAssembler
+from context import dedupe_chunks
+from context import message_text
+from context import shingles
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def chunk(text):
+    return {'text': text, 'metadata': {}}
+
+
+def turn(question, answer):
+    return [{'role': 'user', 'content': [{'text': question}]}, {'role': 'assistant', 'content': [{'text': answer}]}]
+
+
+def test_shingles():
+    assert shingles("a b c d") == {('a', 'b', 'c'), ('b', 'c', 'd')}
+    assert shingles("A b") == {('a', 'b')}
+    assert shingles("") == set()
+
+
+def test_dedupe_chunks_drops_near_duplicates_of_better_chunks():
+    chunks = [chunk("the quick brown fox jumps over the lazy dog"), chunk("quick brown fox jumps over the lazy dog"), chunk("something else entirely here")]
+    assert [c['text'] for c in dedupe_chunks(chunks)] == [chunks[0]['text'], chunks[2]['text']]
+
+
+def test_pack_history_keeps_whole_recent_turns():
+    assembler = ContextAssembler(count_words, history_budget=5)
+    messages = turn("one two", "three four") + turn("five", "six seven")
+    kept, dropped, used = assembler.pack_history(messages)
+    # the older turn would go over the budget, so only the latest turn is kept
+    assert kept == messages[2:] and dropped == messages[:2] and used == 3
+
+
+def test_build_packs_chunks_into_the_prompt():
+    assembler = ContextAssembler(count_words, chunk_budget=4, history_budget=100)
+    history = turn("hi", "hello")
+    chunks = [chunk("alpha beta"), chunk("gamma delta"), chunk("epsilon zeta eta")]
+    messages, stats = assembler.build("question?", chunks, history)
+    assert messages[:2] == history
+    prompt = message_text(messages[-1])
+    assert "chunk 1:alpha beta" in prompt and "chunk 2:gamma delta" in prompt and "epsilon" not in prompt
+    assert stats['chunks'] == 2 and stats['chunk_tokens'] == 4
+
+
+def test_tokens_saved_is_measured_against_the_top_three_chunks():
+    assembler = ContextAssembler(count_words, chunk_budget=2, history_budget=0)
+    history = turn("one two three", "four five")
+    # over-fetched candidates past the third don't count towards the baseline
+    chunks = [chunk("a b"), chunk("c d"), chunk("e f"), chunk("g h i j k l m n o p")]
+    _, stats = assembler.build("question?", chunks, history)
+    # baseline: 5 history tokens + 6 chunk tokens, packed: 2 chunk tokens
+    assert stats['tokens_saved'] == 9
+
+
+def test_build_summarizes_dropped_turns():
+    assembler = ContextAssembler(count_words, history_budget=2, summarize=lambda dropped: f"{len(dropped)} messages")
+    messages, stats = assembler.build("question?", [], turn("a b c", "d e f") + turn("g", "h"))
+    assert message_text(messages[-1]).startswith("Summary of the earlier conversation: 2 messages")
+    assert stats['dropped_messages'] == 2 and stats['summary_tokens'] == 2
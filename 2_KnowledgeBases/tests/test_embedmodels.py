@@ -0,0 +1,65 @@
+import threading
+import time
+
+import embedmodels
+from chunker import LateChunker
+from embedmodels import ModelRegistry
+
+
+class FakeModel():
+    def __init__(self, model_id):
+        self.model_id = model_id
+        self.training = True
+
+    def eval(self):
+        self.training = False
+        return self
+
+
+def fake_loaders(monkeypatch):
+    # counts how many times each model is loaded from the hub
+    loads = []
+
+    class FakeAutoModel():
+        @staticmethod
+        def from_pretrained(model_id, trust_remote_code=False):
+            loads.append(('model', model_id))
+            # slow enough for the other threads to ask for the model while it is loading
+            time.sleep(0.05)
+            return FakeModel(model_id)
+
+    class FakeAutoTokenizer():
+        @staticmethod
+        def from_pretrained(model_id, trust_remote_code=False):
+            loads.append(('tokenizer', model_id))
+            return object()
+
+    monkeypatch.setattr(embedmodels, "AutoModel", FakeAutoModel)
+    monkeypatch.setattr(embedmodels, "AutoTokenizer", FakeAutoTokenizer)
+    return loads
+
+
+def test_chunkers_share_one_model_per_process(monkeypatch):
+    loads = fake_loaders(monkeypatch)
+    registry = ModelRegistry()
+    monkeypatch.setattr("chunker.registry", registry)
+    first, second = LateChunker(), LateChunker(long_late_chunking=False)
+    assert first.model is second.model and first.tokenizer is second.tokenizer
+    # the query path of the chat app asks the same registry
+    assert registry.model(first.model_id) is first.model
+    assert not first.model.training
+    assert sorted(loads) == [('model', first.model_id), ('tokenizer', first.model_id)]
+    assert ('model', first.model_id) in registry.metrics
+
+
+def test_concurrent_first_use_loads_once(monkeypatch):
+    loads = fake_loaders(monkeypatch)
+    registry = ModelRegistry()
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(registry.model('some/model'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == [('model', 'some/model')]
+    assert all(model is models[0] for model in models)
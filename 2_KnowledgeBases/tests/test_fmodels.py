@@ -0,0 +1,132 @@
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+from botocore.exceptions import EndpointConnectionError
+from botocore.exceptions import ReadTimeoutError
+
+import fmodels
+from fmodels import ResponseError
+from fmodels import ResponseStream
+
+
+def parse_event(event):
+    if "contentBlockDelta" in event:
+        return event["contentBlockDelta"]["delta"].get("text"), None, None
+    if "metadata" in event:
+        return None, event["metadata"]["usage"]["inputTokens"], event["metadata"]["usage"]["outputTokens"]
+    return None, None, None
+
+
+def delta(text):
+    return {"contentBlockDelta": {"delta": {"text": text}}}
+
+
+def test_response_stream_yields_text_and_records_metrics():
+    stream = ResponseStream([delta("Hello"), delta(" world"), {"metadata": {"usage": {"inputTokens": 3, "outputTokens": 2}}}], parse_event)
+    assert list(stream) == ["Hello", " world"]
+    assert stream.text == "Hello world"
+    metrics = stream.metrics()
+    assert metrics["input_tokens"] == 3 and metrics["output_tokens"] == 2
+    assert metrics["time_to_first_token"] is not None
+
+
+def test_response_stream_raises_on_exception_events():
+    stream = ResponseStream([delta("Hel"), {"modelStreamErrorException": {"message": "broken"}}], parse_event)
+    with pytest.raises(ResponseError, match="modelStreamErrorException"):
+        list(stream)
+    assert stream.text == "Hel"
+
+
+def test_response_stream_raises_on_event_stream_errors():
+    def events():
+        yield delta("Hel")
+        raise ClientError({"Error": {"Code": "throttlingException", "Message": "slow down"}}, "ConverseStream")
+
+    with pytest.raises(ResponseError, match="throttlingException"):
+        list(ResponseStream(events(), parse_event))
+
+
+def throttling_error():
+    return ClientError({"Error": {"Code": "ThrottlingException", "Message": "slow down"}}, "InvokeModel")
+
+
+def test_bedrock_call_retries_throttling_and_gives_up(monkeypatch):
+    monkeypatch.setattr(fmodels.time, "sleep", lambda seconds: None)
+    attempts = []
+
+    def throttled(value, fail_times):
+        attempts.append(value)
+        if len(attempts) <= fail_times:
+            raise throttling_error()
+        return value
+
+    assert fmodels.bedrock_call(throttled, 'ok', fail_times=2, max_retries=5) == 'ok'
+    assert len(attempts) == 3
+
+    attempts.clear()
+    with pytest.raises(ClientError):
+        fmodels.bedrock_call(throttled, 'ok', fail_times=10, max_retries=2)
+    assert len(attempts) == 3
+
+
+@pytest.mark.parametrize("error, retried", [
+    (ReadTimeoutError(endpoint_url="https://bedrock"), True),
+    (EndpointConnectionError(endpoint_url="https://bedrock"), True),
+    (ClientError({"Error": {"Code": "InternalServerException"}, "ResponseMetadata": {"HTTPStatusCode": 500}}, "InvokeModel"), True),
+    (ClientError({"Error": {"Code": "SomethingNew"}, "ResponseMetadata": {"HTTPStatusCode": 503}}, "InvokeModel"), True),
+    (ClientError({"Error": {"Code": "ValidationException"}, "ResponseMetadata": {"HTTPStatusCode": 400}}, "InvokeModel"), False),
+    (ValueError("bad input"), False),
+])
+def test_call_with_retry_retries_timeouts_connection_and_server_errors(monkeypatch, error, retried):
+    monkeypatch.setattr(fmodels.time, "sleep", lambda seconds: None)
+    attempts = []
+
+    def failing():
+        attempts.append(1)
+        raise error
+
+    with pytest.raises(type(error)):
+        fmodels.call_with_retry(failing, max_retries=2)
+    assert len(attempts) == (3 if retried else 1)
+
+
+def test_bedrock_client_makes_a_single_attempt(monkeypatch):
+    # botocore's max_attempts counts retries, total_max_attempts counts every attempt
+    monkeypatch.setattr(fmodels, "_bedrock_clients", {})
+    client = fmodels.get_bedrock_client("us-east-1")
+    assert client.meta.config.retries["total_max_attempts"] == 1
+    assert fmodels.get_bedrock_client("us-east-1") is client
+
+
+def test_bedrock_call_releases_the_slot_while_backing_off(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(fmodels, "_bedrock_slots", slots)
+    held_while_sleeping = []
+    monkeypatch.setattr(fmodels.time, "sleep", lambda seconds: held_while_sleeping.append(not slots.acquire(blocking=False)) or slots.release())
+    calls = []
+
+    def throttled():
+        calls.append(1)
+        if len(calls) < 3:
+            raise throttling_error()
+        return 'ok'
+
+    assert fmodels.bedrock_call(throttled) == 'ok'
+    assert held_while_sleeping == [False, False]
+
+
+def test_bedrock_call_proxy_routes_methods_through_bedrock_call(monkeypatch):
+    calls = []
+    monkeypatch.setattr(fmodels, "bedrock_call", lambda fn, *args, **kwargs: calls.append(fn.__name__) or fn(*args, **kwargs))
+
+    class Client():
+        region = 'us-east-1'
+
+        def invoke_model(self, body):
+            return body
+
+    proxy = fmodels.BedrockCallProxy(Client())
+    assert proxy.invoke_model(body='x') == 'x'
+    assert proxy.region == 'us-east-1'
+    assert calls == ['invoke_model']
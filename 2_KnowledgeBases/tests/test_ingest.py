@@ -0,0 +1,92 @@
+import os
+import re
+
+import numpy as np
+
+from cache import EmbeddingCache
+from ingest import IngestionPipeline
+from ingest import group_pages
+
+
+def test_group_pages_fills_blocks_up_to_the_token_budget(word_tokenizer):
+    pages = [(0, "one two "), (1, "three "), (2, "four five six "), (3, "seven")]
+    blocks = list(group_pages(pages, word_tokenizer, block_tokens=3))
+    assert [(text, page_starts, page_numbers) for text, page_starts, page_numbers, _ in blocks] == [
+        ("one two three ", [0, 8], [0, 1]),
+        ("four five six ", [0], [2]),
+        ("seven", [0], [3])
+    ]
+
+
+def test_group_pages_reuses_the_page_tokens_as_model_inputs(word_tokenizer):
+    pages = [(0, "one two "), (1, "three")]
+    text, _, _, token_inputs = next(group_pages(pages, word_tokenizer, block_tokens=10))
+    assert token_inputs['input_ids'][0].tolist() == [101, 3, 3, 5, 102]
+    offsets = token_inputs['offset_mapping'][0].tolist()
+    # special tokens get (0, 0), the page offsets are shifted to the block
+    assert offsets == [[0, 0], [0, 3], [4, 7], [8, 13], [0, 0]]
+    assert [text[start:end] for start, end in offsets[1:-1]] == ["one", "two", "three"]
+
+
+class FakeTextPage():
+    def __init__(self, text):
+        self.text = text
+
+    def extractTEXT(self):
+        return self.text
+
+
+class FakePage():
+    def __init__(self, text):
+        self.text = text
+
+    def get_textpage(self):
+        return FakeTextPage(self.text)
+
+
+class WordChunker():
+    # one chunk per word, embedded as its length
+    max_length = 8
+    long_late_chunking = False
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.calls = 0
+
+    def cache_key(self):
+        return 'word-chunker'
+
+    def embed_text(self, text, token_inputs=None):
+        self.calls += 1
+        words = list(re.finditer(r"\S+", text))
+        return [word.group() for word in words], np.array([[len(word.group())] for word in words], dtype=np.float32), [word.start() for word in words]
+
+
+class MemoryStore():
+    def __init__(self):
+        self.chunks = {}
+
+    def load_chunks(self, chunks):
+        self.chunks.update((chunk['_id'], chunk) for chunk in chunks)
+        return {'upserted': len(chunks), 'modified': 0, 'skipped': 0, 'errors': [], 'seconds': 0.0}
+
+
+def test_cached_document_re_embeds_evicted_blocks(tmp_path, word_tokenizer):
+    doc = [FakePage("one two three. "), FakePage("four five six. "), FakePage("seven eight.")]
+    cache = EmbeddingCache(str(tmp_path))
+    chunker = WordChunker(word_tokenizer)
+    first = MemoryStore()
+    list(IngestionPipeline(chunker, first, cache=cache).run(doc, 'doc.pdf', pdf_hash='abc'))
+    calls = chunker.calls
+
+    # a block is evicted after cached_blocks checked that every block is there
+    pipeline = IngestionPipeline(chunker, MemoryStore(), cache=cache)
+    blocks = pipeline.cached_blocks(pipeline.document_key('abc'))
+    for path in cache._paths(blocks[1]["key"]):
+        os.remove(path)
+    pipeline.cached_blocks = lambda doc_key: blocks
+    reports = list(pipeline.run(doc, 'doc.pdf', pdf_hash='abc'))
+
+    assert reports[-1]['cached']
+    assert chunker.calls == calls + 1
+    assert pipeline.vector_store.chunks == first.chunks
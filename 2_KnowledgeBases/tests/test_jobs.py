@@ -0,0 +1,91 @@
+import numpy as np
+import pymupdf
+
+from jobs import IngestionJob
+from jobs import IngestionQueue
+
+
+class IdleChunker():
+    # settings the pipeline reads, jobs that fail while opening the pdf never embed anything
+    max_length = 512
+    long_late_chunking = False
+
+    def embed_text(self, text, token_inputs=None):
+        raise AssertionError("nothing should be embedded")
+
+
+def queue(max_finished=100):
+    return IngestionQueue(chunker=IdleChunker(), vector_store=None, max_finished=max_finished)
+
+
+def test_failed_job_keeps_the_exception_type_and_traceback(tmp_path):
+    path = tmp_path / "broken.pdf"
+    path.write_bytes(b"not a pdf")
+    jobs = queue()
+    job = IngestionJob("broken.pdf", str(path), None)
+    jobs.run(job)
+    assert job.status == 'failed'
+    assert job.error.split(':')[0].isidentifier() and 'nothing should be embedded' not in job.error
+    assert 'Traceback' in job.traceback
+    assert not job.searchable
+    assert not path.exists()
+
+
+def test_searchable_once_a_batch_is_written_and_indexes_created():
+    job = IngestionJob("a.pdf", "a.pdf", None)
+    job.chunks_written = 10
+    assert not job.searchable
+    job.index_created = True
+    assert job.searchable
+    job = IngestionJob("b.pdf", "b.pdf", None)
+    job.status = 'done'
+    assert job.searchable
+
+
+def test_finished_jobs_are_pruned():
+    jobs = queue(max_finished=2)
+    finished = []
+    for i in range(4):
+        job = IngestionJob(f"{i}.pdf", f"{i}.pdf", None)
+        job.status = 'done'
+        finished.append(job)
+        jobs.jobs[job.id] = job
+    running = IngestionJob("running.pdf", "running.pdf", None)
+    jobs.jobs[running.id] = running
+    with jobs.lock:
+        jobs.prune()
+    assert jobs.list() == finished[2:] + [running]
+
+
+class EmptyChunker(IdleChunker):
+    # finds no chunks, so the job goes straight from reading the pdf to waiting for the indexes
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def embed_text(self, text, token_inputs=None):
+        return [], np.zeros((0, 1), dtype=np.float32), []
+
+
+class IndexingStore():
+    def __init__(self):
+        self.calls = []
+
+    def wait_for_index(self, index_name):
+        self.calls.append(('wait_for_index', index_name))
+
+    def bump_version(self):
+        self.calls.append(('bump_version',))
+
+
+def test_finished_job_invalidates_cached_retrievals(tmp_path, word_tokenizer):
+    path = str(tmp_path / "empty.pdf")
+    doc = pymupdf.open()
+    doc.new_page()
+    doc.save(path)
+    store = IndexingStore()
+    jobs = IngestionQueue(chunker=EmptyChunker(word_tokenizer), vector_store=store)
+    job = IngestionJob("empty.pdf", path, None)
+    jobs.run(job)
+    assert job.status == 'done', job.traceback
+    # the version is bumped after the indexes have caught up
+    assert store.calls == [('wait_for_index', 'vector_index'), ('bump_version',)]
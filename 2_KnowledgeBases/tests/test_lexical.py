@@ -0,0 +1,40 @@
+import numpy as np
+
+from lexical import BM25
+from lexical import tokenize
+
+
+TEXTS = [
+    "The cat sat on the mat.",
+    "Dogs and cats living together.",
+    "A cat, a cat and another cat!",
+    "Nothing to see here."
+]
+
+
+def test_tokenize_lowercases_words():
+    assert tokenize("The Cat, sat!") == ['the', 'cat', 'sat']
+
+
+def test_bm25_ranks_by_term_frequency_and_rarity():
+    bm25 = BM25(TEXTS)
+    results = bm25.top_k("cat", k=10)
+    # "cats" is a different token, the document with the most "cat" comes first
+    assert [row for row, _ in results] == [2, 0]
+    assert results[0][1] > results[1][1] > 0
+
+
+def test_bm25_leaves_out_documents_without_query_terms():
+    bm25 = BM25(TEXTS)
+    assert bm25.top_k("unicorn", k=3) == []
+    assert np.all(bm25.scores("unicorn") == 0)
+    assert len(bm25.top_k("cat sat", k=1)) == 1
+
+
+def test_bm25_top_k_within_rows():
+    bm25 = BM25(TEXTS)
+    assert [row for row, _ in bm25.top_k("cat", k=10, rows=np.array([0, 1, 3]))] == [0]
+
+
+def test_bm25_on_empty_corpus():
+    assert BM25([]).top_k("cat", k=3) == []
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from localdb import LocalVectorStore
+
+
+def chunk(i, tenant, file_name='a.pdf'):
+    embedding = np.zeros(8)
+    embedding[i % 8] = 1.0
+    embedding[(i + 1) % 8] = 0.5
+    return {'_id': f"{tenant}:{file_name}:{i}", 'text': f"chunk {i} about topic {i % 3}", 'embedding': embedding.tolist(),
+            'metadata': {'file': file_name, 'page': 1, 'tenant': tenant}}
+
+
+def store(tmp_path, **kwargs):
+    vectordb = LocalVectorStore('db', 'chunks', path=str(tmp_path), **kwargs)
+    vectordb.load_chunks([chunk(i, 'alice') for i in range(10)] + [chunk(i, 'bob', 'b.pdf') for i in range(10)])
+    vectordb.create_index('vector_index', dimensions=8, embedding_field='embedding')
+    vectordb.create_text_index('text_index')
+    return vectordb
+
+
+def tenants(results):
+    return {result['metadata']['tenant'] for result in results}
+
+
+def test_filters(tmp_path):
+    vectordb = store(tmp_path)
+    query = chunk(3, None)['embedding']
+    assert tenants(vectordb.retrieve('vector_index', query, limit=20, filter={'metadata.tenant': 'bob'})) == {'bob'}
+    assert len(vectordb.retrieve('vector_index', query, limit=20, filter={'metadata.file': {'$in': ['a.pdf', 'b.pdf']}})) == 20
+    assert vectordb.retrieve('vector_index', query, filter={'metadata.tenant': 'carol'}) == []
+    assert tenants(vectordb.text_search('text_index', "topic", limit=20, filter={'metadata.tenant': 'alice'})) == {'alice'}
+
+
+@pytest.mark.parametrize("kwargs", [{}, {'index_type': 'ivf', 'n_lists': 2}, {'compression': 'int8', 'rerank_factor': 1}])
+def test_delete_many_only_deletes_matching_chunks(tmp_path, kwargs):
+    vectordb = store(tmp_path, **kwargs)
+    version = vectordb.version
+    query = chunk(3, None)['embedding']
+    # build the lazy indexes and codes first so they have to follow the deletion
+    vectordb.retrieve('vector_index', query, limit=20, filter={'metadata.tenant': 'bob'})
+    assert vectordb.delete_many({'metadata.tenant': 'alice'}) == 10
+    assert vectordb.delete_many({'metadata.tenant': 'alice'}) == 0
+    assert vectordb.version > version
+
+    results = vectordb.retrieve('vector_index', query, limit=20)
+    assert tenants(results) == {'bob'} and len(results) == 10
+    # the best match is still the chunk with the query's embedding
+    assert results[0]['text'] == "chunk 3 about topic 0"
+    assert tenants(vectordb.text_search('text_index', "topic", limit=20)) == {'bob'}
+
+    # the deletion is on disk, and the store keeps working for new chunks
+    reopened = LocalVectorStore('db', 'chunks', path=str(tmp_path), **kwargs)
+    assert len(reopened.docs) == 10
+    reopened.load_chunks([chunk(3, 'alice')])
+    assert reopened.retrieve('vector_index', query, limit=2)[0]['score'] == pytest.approx(1.0)
+
+
+def test_ivf_lists_are_retrained_as_the_collection_grows(tmp_path):
+    vectordb = LocalVectorStore('db', 'chunks', path=str(tmp_path), index_type='ivf')
+    vectordb.load_chunks([chunk(i, 'alice') for i in range(20)])
+    assert vectordb.create_index('vector_index', dimensions=8, embedding_field='embedding') == 'created'
+    assert len(vectordb.ivf['centroids']) == 4
+    vectordb.load_chunks([chunk(i, 'bob') for i in range(20)])
+    # doubling the collection retrains the lists on every row
+    assert len(vectordb.ivf['centroids']) == 6 and vectordb.ivf['trained_rows'] == 40
+    assert vectordb.create_index('vector_index', dimensions=8, embedding_field='embedding') == 'unchanged'
+    reopened = LocalVectorStore('db', 'chunks', path=str(tmp_path), index_type='ivf')
+    assert reopened.ivf['trained_rows'] == 40 and len(reopened.ivf['assignments']) == 40
+
+    # lists that fell behind (e.g. written by an older version) make create_index retrain instead of reporting 'unchanged'
+    reopened.ivf['trained_rows'] = 10
+    assert reopened.create_index('vector_index', dimensions=8, embedding_field='embedding') == 'updated'
+    assert reopened.ivf['trained_rows'] == 40
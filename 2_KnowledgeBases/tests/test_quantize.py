@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from quantize import ProductQuantizer
+from quantize import code_count
+from quantize import concat
+from quantize import get_quantizer
+from quantize import kmeans
+from quantize import take
+
+
+def random_vectors(n=500, dimensions=32, seed=0):
+    return np.random.default_rng(seed).normal(size=(n, dimensions)).astype(np.float32)
+
+
+def test_kmeans_finds_separated_clusters():
+    rng = np.random.default_rng(0)
+    data = np.concatenate([rng.normal(loc, 0.1, size=(50, 2)) for loc in (-5, 0, 5)]).astype(np.float32)
+    _, assignments = kmeans(data, 3)
+    # every group of 50 points ends up in its own cluster
+    assert len({tuple(np.unique(assignments[i:i+50])) for i in range(0, 150, 50)}) == 3
+    assert all(len(np.unique(assignments[i:i+50])) == 1 for i in range(0, 150, 50))
+
+
+@pytest.mark.parametrize("compression, tolerance", [('float16', 1e-2), ('int8', 0.1)])
+def test_scalar_quantizers_approximate_the_dot_product(compression, tolerance):
+    data = random_vectors()
+    query = random_vectors(1, seed=1)[0]
+    quantizer = get_quantizer(compression).fit(data)
+    scores = quantizer.scores(quantizer.encode(data), query)
+    np.testing.assert_allclose(scores, data @ query, atol=tolerance * np.abs(data @ query).max())
+
+
+def test_product_quantizer_keeps_the_nearest_neighbours_in_the_candidates():
+    data = random_vectors(1000)
+    query = data[0] + 0.01
+    quantizer = ProductQuantizer(n_subvectors=8, n_centroids=64).fit(data)
+    codes = quantizer.encode(data)
+    assert codes.shape == (1000, 8) and codes.dtype == np.uint8
+    candidates = np.argsort(-quantizer.scores(codes, query))[:50]
+    exact = np.argsort(-(data @ query))[:5]
+    assert set(exact) <= set(candidates)
+
+
+def test_product_quantizer_needs_divisible_dimensions():
+    with pytest.raises(ValueError):
+        ProductQuantizer(n_subvectors=5).fit(random_vectors(20))
+
+
+def test_code_helpers_handle_int8_pairs():
+    quantizer = get_quantizer('int8')
+    codes = concat(None, quantizer.encode(random_vectors(3)))
+    codes = concat(codes, quantizer.encode(random_vectors(2, seed=1)))
+    assert code_count(codes) == 5
+    assert code_count(take(codes, np.array([0, 4]))) == 2
+    assert get_quantizer(None) is None
+    with pytest.raises(ValueError):
+        get_quantizer('int4')
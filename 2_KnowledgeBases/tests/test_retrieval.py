@@ -0,0 +1,56 @@
+import pytest
+
+from retrieval import HybridRetriever
+from retrieval import reciprocal_rank_fusion
+from retrieval import select_within_budget
+
+
+def results(*texts):
+    return [{'text': text, 'metadata': {}} for text in texts]
+
+
+def test_rrf_puts_results_found_by_both_searches_first():
+    fused = reciprocal_rank_fusion([results('a', 'b', 'c'), results('c', 'd')], k=60)
+    assert [result['text'] for result in fused] == ['c', 'a', 'b', 'd']
+    assert fused[0]['score'] == pytest.approx(1 / 63 + 1 / 61)
+
+
+def test_rrf_weights():
+    fused = reciprocal_rank_fusion([results('a'), results('b')], weights=[1.0, 2.0])
+    assert [result['text'] for result in fused] == ['b', 'a']
+
+
+def test_select_within_budget_stops_at_the_budget():
+    count_tokens = len
+    selected, used = select_within_budget(results('aaaa', 'bb', 'cccc', 'd'), count_tokens, token_budget=7)
+    # 'cccc' would go over the budget, selection stops there rather than skipping ahead to 'd'
+    assert [result['text'] for result in selected] == ['aaaa', 'bb']
+    assert used == 6
+
+
+def test_select_within_budget_keeps_the_first_result_and_max_chunks():
+    selected, used = select_within_budget(results('aaaaaaaa', 'b'), len, token_budget=3)
+    assert [result['text'] for result in selected] == ['aaaaaaaa'] and used == 8
+    selected, _ = select_within_budget(results('a', 'b', 'c'), len, token_budget=10, max_chunks=2)
+    assert len(selected) == 2
+
+
+class FakeStore():
+    def __init__(self):
+        self.filters = []
+
+    def retrieve(self, index_name, query_embedding, embedding_field, num_neighbors, limit, filter=None):
+        self.filters.append(filter)
+        return results('vector only', 'both')
+
+    def text_search(self, index_name, query_text, limit, filter=None):
+        self.filters.append(filter)
+        return results('both', 'keyword only')
+
+
+def test_hybrid_retriever_fuses_both_searches_with_the_same_filter():
+    store = FakeStore()
+    fused, stats = HybridRetriever(store).retrieve("query", [0.0], limit=2, filter={'metadata.tenant': 't'})
+    assert [result['text'] for result in fused] == ['both', 'vector only']
+    assert store.filters == [{'metadata.tenant': 't'}] * 2
+    assert stats['vector_results'] == 2 and stats['text_results'] == 2
@@ -0,0 +1,41 @@
+from segmenter import LocalSegmenter
+from segmenter import align_chunks_to_tokens
+
+
+def word_offsets(tokenizer, text):
+    return tokenizer(text, return_offsets_mapping=True)['offset_mapping']
+
+
+def test_align_chunks_to_tokens_covers_the_content_tokens(word_tokenizer):
+    text = "one two. three four five. six"
+    spans = align_chunks_to_tokens([(0, 8), (8, 25), (25, 29)], word_offsets(word_tokenizer, text))
+    # [CLS] is token 0 and [SEP] token 7, the spans cover tokens 1 to 6 without gaps
+    assert spans == [(1, 3), (3, 6), (6, 7)]
+
+
+def test_align_chunks_to_tokens_gives_an_empty_span_to_a_chunk_inside_a_token(word_tokenizer):
+    # the second chunk ends inside the first word, its span is empty and the next chunk starts where it would have
+    spans = align_chunks_to_tokens([(0, 3), (3, 5), (5, 16)], word_offsets(word_tokenizer, "alpha beta gamma"))
+    assert spans == [(1, 2), (2, 2), (2, 4)]
+
+
+def test_align_chunks_to_tokens_without_content():
+    assert align_chunks_to_tokens([(0, 0)], [(0, 0), (0, 0)]) == []
+
+
+def test_local_segmenter_splits_on_paragraphs_and_the_token_budget(word_tokenizer):
+    text = "a b c.\nd e f. g h i. j k l m n o p"
+    segmenter = LocalSegmenter(max_chunk_tokens=6, min_chunk_tokens=2)
+    chunks, spans = segmenter.segment(text, word_tokenizer(text, return_tensors='pt', return_offsets_mapping=True))
+    # a paragraph break after "c.", then a cut at the last sentence end before going over 6 tokens, then a hard cut
+    assert chunks == ["a b c.", "d e f. g h i.", "j k l m n o", "p"]
+    assert spans == [(1, 4), (4, 10), (10, 16), (16, 17)]
+    assert all(end - start <= 6 for start, end in spans)
+
+
+def test_local_segmenter_keeps_short_paragraphs_together(word_tokenizer):
+    text = "a.\nb c d."
+    token_inputs = word_tokenizer(text, return_tensors='pt', return_offsets_mapping=True)
+    chunks, spans = LocalSegmenter(max_chunk_tokens=10, min_chunk_tokens=3).segment(text, token_inputs)
+    assert chunks == ["a.\nb c d."]
+    assert spans == [(1, 5)]
@@ -0,0 +1,121 @@
+import pytest
+
+import vectordb
+from vectordb import MongoDB
+
+# a local uri, MongoClient connects in the background so nothing here needs a running server
+URI = "mongodb://localhost:27017"
+
+
+class FakeCollection():
+    # the search index calls of a pymongo collection, indexes start out building and become queryable with finish_builds
+    def __init__(self):
+        self.indexes = {}
+        self.calls = []
+
+    def list_search_indexes(self, name):
+        return [self.indexes[name]] if name in self.indexes else []
+
+    def create_search_index(self, model):
+        self.calls.append('create')
+        definition = model.document
+        self.indexes[definition['name']] = {'name': definition['name'], 'latestDefinition': definition['definition'],
+                                            'status': 'BUILDING', 'queryable': False}
+
+    def update_search_index(self, name, definition):
+        self.calls.append('update')
+        self.indexes[name].update(latestDefinition=definition, status='BUILDING', queryable=False)
+
+    def finish_builds(self):
+        for index in self.indexes.values():
+            index.update(status='READY', queryable=True)
+
+
+@pytest.fixture
+def mongodb(monkeypatch):
+    monkeypatch.setattr(vectordb, "_index_builds", {})
+    db = MongoDB('test_db', 'test_collection', uri=URI)
+    db.collection = FakeCollection()
+    return db
+
+
+def test_index_becoming_queryable_invalidates_cached_retrievals(mongodb):
+    mongodb.create_index('vector_index', dimensions=4, embedding_field='embedding')
+    version = mongodb.version
+    assert not mongodb.index_status('vector_index')['ready']
+    assert mongodb.version == version
+    mongodb.collection.finish_builds()
+    assert mongodb.index_status('vector_index')['ready']
+    assert mongodb.version > version
+    # known to be ready from now on, without looking it up or bumping again
+    version = mongodb.version
+    assert mongodb.index_status('vector_index')['ready']
+    assert mongodb.version == version
+
+
+def test_get_client_shares_one_client_per_uri(monkeypatch):
+    monkeypatch.setattr(vectordb, "_clients", {})
+    client = vectordb.get_client(URI)
+    try:
+        assert vectordb.get_client(URI) is client
+        other = vectordb.get_client("mongodb://localhost:27018")
+        assert other is not client
+        other.close()
+        # every store on the same uri uses the shared client and its connection pool
+        assert MongoDB('test_db', 'other_collection', uri=URI).client is client
+    finally:
+        client.close()
+
+
+class FakeAdmin():
+    def __init__(self):
+        self.pings = 0
+        self.fail = False
+
+    def command(self, name):
+        self.pings += 1
+        if self.fail:
+            raise ConnectionError("unreachable")
+        return {'ok': 1}
+
+
+class FakeClient():
+    def __init__(self):
+        self.admin = FakeAdmin()
+
+
+def test_health_check_pings_at_most_once_per_max_age(monkeypatch, mongodb):
+    monkeypatch.setattr(vectordb, "_health", {})
+    now = [1000.0]
+    monkeypatch.setattr(vectordb.time, "monotonic", lambda: now[0])
+    mongodb.client = FakeClient()
+    assert mongodb.health_check(max_age=30)
+    assert mongodb.health_check(max_age=30)
+    assert mongodb.client.admin.pings == 1
+    # once the last result is older than max_age the deployment is pinged again
+    now[0] += 31
+    mongodb.client.admin.fail = True
+    assert not mongodb.health_check(max_age=30)
+    assert mongodb.client.admin.pings == 2
+
+
+def test_create_index_only_sends_changed_definitions(mongodb):
+    assert mongodb.create_index('vector_index', dimensions=4, embedding_field='embedding') == 'created'
+    assert mongodb.create_index('vector_index', dimensions=4, embedding_field='embedding') == 'unchanged'
+    assert mongodb.create_index('vector_index', dimensions=8, embedding_field='embedding') == 'updated'
+    assert mongodb.create_text_index('text_index') == 'created'
+    assert mongodb.create_text_index('text_index') == 'unchanged'
+    # an unchanged definition never makes atlas rebuild the index
+    assert mongodb.collection.calls == ['create', 'update', 'create']
+
+
+def test_wait_for_index_polls_until_the_index_is_queryable(monkeypatch, mongodb):
+    assert mongodb.index_status('vector_index') == {'ready': False, 'status': 'DOES_NOT_EXIST', 'build_seconds': None}
+    mongodb.create_index('vector_index', dimensions=4, embedding_field='embedding')
+    assert mongodb.index_status('vector_index')['status'] == 'BUILDING'
+    polls = []
+    # the build finishes during the second poll interval
+    monkeypatch.setattr(vectordb.time, "sleep", lambda seconds: polls.append(seconds) or (len(polls) == 2 and mongodb.collection.finish_builds()))
+    status = mongodb.wait_for_index('vector_index', timeout=60, poll_interval=2)
+    assert status['ready'] and status['build_seconds'] is not None
+    assert polls == [2, 2]